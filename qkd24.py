@@ -1,15 +1,27 @@
 # qkd24_throughput.py
 # 段階24：E91 QKD のスループット最適化（bit/s）
 
+import functools
 import math
 import numpy as np
 
 try:
-    from scipy.stats import beta as sp_beta
+    from scipy.special import betaincinv
     HAVE_SCIPY=True
 except:
     HAVE_SCIPY=False
 
+try:
+    from numba import njit
+    HAVE_NUMBA=True
+except ImportError:
+    HAVE_NUMBA=False
+    def njit(*args, **kwargs):
+        # numba が無ければ素の Python 関数として使う
+        if args and callable(args[0]): return args[0]
+        return lambda f: f
+
+@njit(cache=True)
 def h2(x):
     if x<=0 or x>=1: return 0.0
     return -(x*math.log2(x)+(1-x)*math.log2(1-x))
@@ -17,8 +29,9 @@ def h2(x):
 def clopper_pearson_interval(k, n, alpha=1e-3):
     if n==0: return (0.0,1.0)
     if HAVE_SCIPY:
-        lo = 0.0 if k==0 else float(sp_beta.ppf(alpha/2, k, n-k+1))
-        hi = 1.0 if k==n else float(sp_beta.ppf(1-alpha/2, k+1, n-k))
+        # Beta 分布の分位点 = 正則化不完全ベータ関数の逆（stats.beta.ppf を経由しない）
+        lo = 0.0 if k==0 else float(betaincinv(k, n-k+1, alpha/2))
+        hi = 1.0 if k==n else float(betaincinv(k+1, n-k, 1-alpha/2))
         return (lo,hi)
     # fallback: Wilson近似
     p = k/n; z=3.29
@@ -27,16 +40,39 @@ def clopper_pearson_interval(k, n, alpha=1e-3):
     half=z*math.sqrt(p*(1-p)/n+z*z/(4*n*n))/denom
     return (max(0,center-half), min(1,center+half))
 
+def clopper_pearson_upper_arr(k, n, alpha=1e-3):
+    """clopper_pearson_interval の上側だけを配列でまとめて計算（n==0, k==n は 1.0）。"""
+    k=np.asarray(k, dtype=float); n=np.asarray(n, dtype=float)
+    if HAVE_SCIPY:
+        hi=betaincinv(k+1, np.maximum(n-k,1), 1-alpha/2)
+    else:
+        n_safe=np.maximum(n,1)
+        p=k/n_safe; z=3.29
+        denom=1+z*z/n_safe
+        center=(p+z*z/(2*n_safe))/denom
+        half=z*np.sqrt(p*(1-p)/n_safe+z*z/(4*n_safe*n_safe))/denom
+        hi=np.minimum(1,center+half)
+    return np.where((n==0)|(k==n), 1.0, hi)
+
 # ==== 物理モデル ====
 def eta_fiber(L_km, alpha_db=0.2, eta_det=0.2):
     return eta_det * 10**(-alpha_db*L_km/10)
 
-def eta_satellite(R_km, lambda_nm=850, extra_losses_db=12, eta_det=0.5):
+@functools.lru_cache(maxsize=None)
+def _sat_const(lambda_nm, extra_losses_db, eta_det):
+    # 距離に依らない部分: eta_det * (λ/4π)**2 * 10**(-extra/10)
     lambda_m=lambda_nm*1e-9
+    return eta_det*(lambda_m/(4*math.pi))**2*10**(-extra_losses_db/10)
+
+def eta_satellite(R_km, lambda_nm=850, extra_losses_db=12, eta_det=0.5):
+    # 自由空間損失 Lfs=20*log10(4πR/λ) は 10**(-Lfs/10) = (λ/4πR)**2 と同じ
     R=R_km*1000
-    Lfs=20*math.log10(4*math.pi*R/lambda_m)
-    Ltot=Lfs+extra_losses_db
-    return eta_det*10**(-Ltot/10)
+    return _sat_const(lambda_nm, extra_losses_db, eta_det)/(R*R)
+
+def eta_satellite_arr(R_km_arr, lambda_nm=850, extra_losses_db=12, eta_det=0.5):
+    # R の配列をまとめて評価（掃引用）
+    R=np.asarray(R_km_arr, dtype=float)*1000
+    return _sat_const(lambda_nm, extra_losses_db, eta_det)/(R*R)
 
 # ==== 鍵率計算（有限サイズ近似） ====
 def final_key_length(n_total, q_err, f_ec=1.16, eps_sec=1e-6, alpha=1e-3):
@@ -47,11 +83,24 @@ def final_key_length(n_total, q_err, f_ec=1.16, eps_sec=1e-6, alpha=1e-3):
     k_err=int(q_err*testN)
     _,qU=clopper_pearson_interval(k_err,testN,alpha)
     e_u=qU
+    return _m_from_n(keepN, q_err, e_u, f_ec, eps_sec)
+
+@njit(cache=True)
+def _m_from_n(keepN, q_err, e_u, f_ec, eps_sec):
+    # 数値カーネル部分（SciPy を使う Clopper–Pearson は呼び出し側）
     leak_ec=int(math.ceil(f_ec*keepN*h2(q_err)))
     delta=int(math.ceil(2*math.log2(1/eps_sec)))
     m=max(0,int(math.floor(keepN*(1-h2(e_u))-leak_ec-delta)))
     return m
 
+@njit(cache=True)
+def _throughput_kernel(keepN, q_err, e_u, f_ec, eps_sec, T):
+    # 配列の各点について m と鍵レートを計算（Python ループを JIT 側に移す）
+    m=np.empty(keepN.size, dtype=np.int64)
+    for i in range(keepN.size):
+        m[i]=_m_from_n(keepN[i], q_err, e_u[i], f_ec, eps_sec)
+    return m, m/T
+
 # ==== シミュレーション ====
 def simulate_throughput(mode="fiber", L=100, R_pulse=1e7, T=1.0, p_noise=0.03):
     """
@@ -69,6 +118,30 @@ def simulate_throughput(mode="fiber", L=100, R_pulse=1e7, T=1.0, p_noise=0.03):
     R_key=m/T
     return dict(N=N, m=m, R_key=R_key, eta_pair=eta_pair)
 
+def simulate_throughput_arr(mode="fiber", L=100, R_pulse=1e7, T=1.0, p_noise=0.03,
+                            f_ec=1.16, eps_sec=1e-6, alpha=1e-3):
+    """
+    simulate_throughput の配列版。L と R_pulse は配列可（ブロードキャスト）、
+    戻り値の各値も同じ形の配列。掃引（ヒートマップ等）用。
+    """
+    L=np.asarray(L, dtype=float)
+    if mode=="fiber":
+        eta=eta_fiber(L)
+    else:
+        eta=eta_satellite_arr(L)
+    eta_pair=eta*eta
+    N=np.floor(np.asarray(R_pulse, dtype=float)*T*eta_pair).astype(np.int64)
+    # final_key_length と同じ手順（test=20%、誤り数は期待値で近似）
+    testN=np.floor(0.2*N).astype(np.int64)
+    keepN=N-testN
+    k_err=np.floor(p_noise*testN).astype(np.int64)
+    e_u=clopper_pearson_upper_arr(k_err, testN, alpha)
+    shape=keepN.shape
+    m, R_key=_throughput_kernel(keepN.ravel(), p_noise, np.broadcast_to(e_u, shape).ravel(),
+                                f_ec, eps_sec, T)
+    return dict(N=N, m=m.reshape(shape), R_key=R_key.reshape(shape),
+                eta_pair=np.broadcast_to(eta_pair, shape))
+
 def main():
     R_pulse=1e7; T=1.0; p_noise=0.03
     for L in [50,100,150]:
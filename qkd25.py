@@ -2,8 +2,8 @@
 # 教育用：光ファイバ区間と衛星リンクのスループット（秘密鍵生成率）を簡易モデルで評価・可視化
 
 from __future__ import annotations
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 
 # ---- 基本ユーティリティ ----
 def h2(p: float) -> float:
@@ -87,8 +87,9 @@ def simulate_satellite(
         "sift_bits": rsift * T,
     }
 
-# ---- メイン：ハイブリッド（ローカルファイバ＋衛星） ----
-def main():
+# ---- 計算：ハイブリッド（ローカルファイバ＋衛星） ----
+def compute() -> dict:
+    """数値計算のみ（matplotlib 不要）。結果を dict で返す。"""
     # --- パラメータ（必要に応じて変更可） ---
     L_pulse = 1e9          # 送信パルスレート [Hz]（教育用に高め）
     T_fiber = 24 * 3600    # ファイバは1日連続 [s]
@@ -133,15 +134,23 @@ def main():
     R_day_fiber = res_locals["bits"]            # [bit/day]
     R_day_total = R_day_fiber + T_sat_total
 
-    # --- 結果表示 ---
-    print("== Hybrid QKD throughput (education) ==")
-    print(f"Local fiber  {fiber_local:.1f} km : {R_day_fiber:.1e} bits/day")
-    print(f"Satellite    ~{mid_r:.0f} km x{passes_per_day} passes : {T_sat_total:.1e} bits/day")
-    print(f"Day total: {R_day_total:.1e} bits/day")
+    return {
+        "fiber_local": fiber_local,
+        "passes_per_day": passes_per_day,
+        "sat_range": sat_range,
+        "R_sat": R_sat,
+        "mid_r": mid_r,
+        "R_day_fiber": R_day_fiber,
+        "T_sat_total": T_sat_total,
+        "R_day_total": R_day_total,
+    }
+
+# ---- 図：衛星距離 vs 秘密鍵生成率（対数スケール） ----
+def plot(results: dict):
+    import matplotlib.pyplot as plt
 
-    # --- 図：衛星距離 vs 秘密鍵生成率（対数スケール） ---
     plt.figure()
-    plt.semilogy(sat_range, R_sat, 'o-', label="Satellite downlink (R_sec)")
+    plt.semilogy(results["sat_range"], results["R_sat"], 'o-', label="Satellite downlink (R_sec)")
     plt.xlabel("Satellite slant range (km)")
     plt.ylabel("Secret key rate (per pair, log)")
     plt.title("E91 over Satellite Link (educational model)")
@@ -150,7 +159,23 @@ def main():
 
     plt.show()
 
+# ---- メイン ----
+def main():
+    ap = argparse.ArgumentParser(description="段階25 ハイブリッドQKD（ファイバ＋衛星）")
+    ap.add_argument("--no-plot", dest="plot", action="store_false", help="図を描かない（数値のみ）")
+    args = ap.parse_args()
+
+    res = compute()
+
+    # --- 結果表示 ---
+    print("== Hybrid QKD throughput (education) ==")
+    print(f"Local fiber  {res['fiber_local']:.1f} km : {res['R_day_fiber']:.1e} bits/day")
+    print(f"Satellite    ~{res['mid_r']:.0f} km x{res['passes_per_day']} passes : {res['T_sat_total']:.1e} bits/day")
+    print(f"Day total: {res['R_day_total']:.1e} bits/day")
+
+    if args.plot:
+        plot(res)
+
 # エントリポイント
 if __name__ == "__main__":
     main()
-
@@ -1,8 +1,8 @@
 # qkd26_hybrid.py
 # 段階26: ハイブリッドQKD (ファイバ + 衛星リンク + 天候可視性)
 
+import argparse
 import numpy as np
-import matplotlib.pyplot as plt
 
 # 2値エントロピー
 def h2(p: float) -> float:
@@ -56,9 +56,9 @@ def simulate(kind: str, length_km: float, R_pulse: float, T: float, p_noise: flo
     }
 
 # ------------------------------------------------
-# メイン処理
+# 計算（matplotlib 不要）
 # ------------------------------------------------
-def main():
+def compute() -> dict:
     # 共通パラメータ
     R_pulse = 1e9
     p_noise = 0.03
@@ -93,21 +93,48 @@ def main():
     R_day_sat   = R_sat   * T_eff
     R_day_total = R_day_fiber + R_day_sat
 
-    # 結果表示
-    print("=== Hybrid QKD throughput (段階26) ===")
-    print(f"Fiber {fiber_local} km : {R_day_fiber:.2e} bits/day")
-    print(f"Satellite {sat_range} km (×{passes_per_day}, clear={p_clear*100:.0f}%) : {R_day_sat:.2e} bits/day")
-    print(f"Total per day : {R_day_total:.2e} bits/day")
+    return {
+        "fiber_local": fiber_local,
+        "sat_range": sat_range,
+        "passes_per_day": passes_per_day,
+        "p_clear": p_clear,
+        "R_day_fiber": R_day_fiber,
+        "R_day_sat": R_day_sat,
+        "R_day_total": R_day_total,
+    }
+
+# ------------------------------------------------
+# 簡易プロット
+# ------------------------------------------------
+def plot(results: dict):
+    import matplotlib.pyplot as plt
 
-    # 簡易プロット
     plt.bar(["Fiber/day", "Satellite/day", "Total/day"],
-            [R_day_fiber, R_day_sat, R_day_total])
+            [results["R_day_fiber"], results["R_day_sat"], results["R_day_total"]])
     plt.ylabel("Secret key bits per day (log scale)")
     plt.yscale("log")
     plt.title("Hybrid QKD Throughput (Fiber + Satellite, 段階26)")
     plt.show()
 
+# ------------------------------------------------
+# メイン処理
+# ------------------------------------------------
+def main():
+    ap = argparse.ArgumentParser(description="段階26 ハイブリッドQKD (ファイバ + 衛星)")
+    ap.add_argument("--no-plot", dest="plot", action="store_false", help="図を描かない（数値のみ）")
+    args = ap.parse_args()
+
+    res = compute()
+
+    # 結果表示
+    print("=== Hybrid QKD throughput (段階26) ===")
+    print(f"Fiber {res['fiber_local']} km : {res['R_day_fiber']:.2e} bits/day")
+    print(f"Satellite {res['sat_range']} km (×{res['passes_per_day']}, clear={res['p_clear']*100:.0f}%) : {res['R_day_sat']:.2e} bits/day")
+    print(f"Total per day : {res['R_day_total']:.2e} bits/day")
+
+    if args.plot:
+        plot(res)
+
 # ------------------------------------------------
 if __name__ == "__main__":
     main()
-
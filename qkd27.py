@@ -1,12 +1,8 @@
 # qkd27_realistic.py  — 実運用スケールの数値で衛星E91と光ファイバーを比較（教育用モデル）
-# 必要: numpy, matplotlib
+# 必要: numpy（図を描くときは matplotlib も）
+import argparse
 import numpy as np
 
-try:
-    import matplotlib.pyplot as plt
-except Exception as e:
-    raise SystemExit("matplotlib が必要です: pip install matplotlib") from e
-
 # ==========================
 # 現実運用に近い“目安”パラメータ
 # ==========================
@@ -51,21 +47,37 @@ def fiber_bits_per_day(secret_rate=FIBER_SECRET_RATE, hours=FIBER_HOURS_PER_DAY)
     return secret_rate * hours * 3600.0
 
 # ==========================
-# メイン：計算 & 可視化
+# 計算（matplotlib 不要）
 # ==========================
-def main():
+def compute(n_sat_pick: int = 12) -> dict:
     # 1) 衛星コンステレーションのスケーリング（図1）
     sat_daily = [satellite_bits_per_day(n) for n in N_SAT_LIST]
 
     # 2) 代表ケースの棒グラフ（図2）
-    N_SAT_PICK = 12    # ここを変えると任意台数の比較が見れる
-    sat_day_pick = satellite_bits_per_day(N_SAT_PICK)
+    sat_day_pick = satellite_bits_per_day(n_sat_pick)
     fib_day = fiber_bits_per_day()
     total_day = sat_day_pick + fib_day
 
+    return {
+        "n_sat_pick": n_sat_pick,
+        "sat_daily": sat_daily,
+        "sat_day_pick": sat_day_pick,
+        "fib_day": fib_day,
+        "total_day": total_day,
+    }
+
+# ==========================
+# 可視化
+# ==========================
+def plot(results: dict):
+    try:
+        import matplotlib.pyplot as plt
+    except Exception as e:
+        raise SystemExit("matplotlib が必要です: pip install matplotlib") from e
+
     # ---- 表示（図1：衛星数スイープ） ----
     plt.figure(figsize=(7,5))
-    plt.plot(N_SAT_LIST, sat_daily, marker="o", label=f"Satellite downlink E91 (p_clear={P_CLEAR:.0%})")
+    plt.plot(N_SAT_LIST, results["sat_daily"], marker="o", label=f"Satellite downlink E91 (p_clear={P_CLEAR:.0%})")
     plt.yscale("log")
     plt.xlabel("Number of satellites")
     plt.ylabel("Daily secret key [bits/day] (log scale)")
@@ -74,8 +86,8 @@ def main():
     plt.legend()
 
     # ---- 表示（図2：棒グラフ） ----
-    labels = [f"Fiber/day\n(50 km)", f"Satellite/day\n(N_sat={N_SAT_PICK})", "Total/day"]
-    values = [fib_day, sat_day_pick, total_day]
+    labels = [f"Fiber/day\n(50 km)", f"Satellite/day\n(N_sat={results['n_sat_pick']})", "Total/day"]
+    values = [results["fib_day"], results["sat_day_pick"], results["total_day"]]
 
     plt.figure(figsize=(7,5))
     bars = plt.bar(labels, values)
@@ -87,6 +99,20 @@ def main():
         plt.text(b.get_x() + b.get_width()/2, v, f"{v:.2e}", ha="center", va="bottom", fontsize=9)
     plt.grid(True, axis="y", which="both", linestyle=":")
 
+    plt.tight_layout()
+    plt.show()
+
+# ==========================
+# メイン：計算 & 可視化
+# ==========================
+def main():
+    ap = argparse.ArgumentParser(description="段階27 衛星E91とファイバの比較（実運用スケール）")
+    ap.add_argument("--no-plot", dest="plot", action="store_false", help="図を描かない（数値のみ）")
+    args = ap.parse_args()
+
+    N_SAT_PICK = 12    # ここを変えると任意台数の比較が見れる
+    res = compute(N_SAT_PICK)
+
     # ---- コンソール出力（数値） ----
     print("\n=== Parameters (realistic-order, editable) ===")
     print(f"P_CLEAR={P_CLEAR:.0%}, PASSES_PER_DAY≈{PASSES_PER_DAY}, PASS_DURATION_SEC≈{PASS_DURATION_SEC}s, "
@@ -94,15 +120,14 @@ def main():
     print(f"Fiber SECRET_RATE≈{FIBER_SECRET_RATE} bits/s over {FIBER_HOURS_PER_DAY} h/day")
     print("\n=== Results ===")
     print("Satellites | bits/day (sat constellation)")
-    for n, v in zip(N_SAT_LIST, sat_daily):
+    for n, v in zip(N_SAT_LIST, res["sat_daily"]):
         print(f"{n:>3d}        | {v: .3e} bits/day")
-    print(f"\nFiber/day      = {fib_day: .3e} bits/day")
-    print(f"Satellite/day  = {sat_day_pick: .3e} bits/day  (N_sat={N_SAT_PICK})")
-    print(f"Total/day      = {total_day: .3e} bits/day\n")
+    print(f"\nFiber/day      = {res['fib_day']: .3e} bits/day")
+    print(f"Satellite/day  = {res['sat_day_pick']: .3e} bits/day  (N_sat={N_SAT_PICK})")
+    print(f"Total/day      = {res['total_day']: .3e} bits/day\n")
 
-    plt.tight_layout()
-    plt.show()
+    if args.plot:
+        plot(res)
 
 if __name__ == "__main__":
     main()
-
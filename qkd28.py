@@ -6,16 +6,76 @@
 # - 1パスで得られる鍵ビット数 × 1日の可視パス数 × 有効晴天確率 p_eff を「bits/day」として比較
 
 from __future__ import annotations
-import math
+import argparse
+import functools
+from statistics import NormalDist
 import numpy as np
-import matplotlib.pyplot as plt
+
+try:
+    from scipy.special import ndtri
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+try:
+    from numba import njit, prange
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+
+try:
+    import cupy as cp
+    HAVE_CUPY = True
+except ImportError:
+    HAVE_CUPY = False
 
 # ========= ユーティリティ =========
-def norm_cdf(x):
-    """標準正規 Φ(x) を配列対応で計算（SciPyなし）。"""
-    x = np.asarray(x, dtype=float)
-    erf_vec = np.vectorize(math.erf)       # math.erf はスカラー専用 -> ベクトル化して使う
-    return 0.5 * (1.0 + erf_vec(x / np.sqrt(2.0)))
+def norm_ppf(p):
+    """標準正規の逆関数 Φ⁻¹(p) を配列対応で計算（p=0 → -inf, p=1 → +inf）。"""
+    p = np.asarray(p, dtype=float)
+    if HAVE_SCIPY:
+        return ndtri(p)
+    # fallback: 標準ライブラリの NormalDist（要素数 M 程度なので十分）
+    inv = NormalDist().inv_cdf
+    return np.array([-np.inf if q <= 0.0 else np.inf if q >= 1.0 else inv(q)
+                     for q in p.ravel()]).reshape(p.shape)
+
+MC_BLOCK = 65536   # Monte Carlo で一度に持つ試行数（E はこの行数までしか作らない）
+
+if HAVE_NUMBA:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def _count_any_clear(E, L, t):
+        """
+        E: 標準正規 N(0, I) の [block, M]（試行のブロック1つ分）、L: 下三角コレスキー因子、t: しきい値 Φ⁻¹(p)
+        1行ずつ z_i = Σ_k L[i,k]·E[s,k] を計算してしきい値判定し、晴れが出たら打ち切る。
+        Z 行列・bool 行列を作らず 1パスで「少なくとも1局晴れ」の件数を返す。
+        """
+        trials, M = E.shape
+        count = 0
+        for s in prange(trials):
+            for i in range(M):
+                zi = 0.0
+                for k in range(i + 1):
+                    zi += L[i, k] * E[s, k]
+                if zi < t[i]:
+                    count += 1
+                    break
+        return count
+
+@functools.lru_cache(maxsize=128)
+def _chol_uniform(M: int, rho: float):
+    """一様相関行列（対角1、オフ対角rho）のコレスキー因子。(M, rho) ごとにキャッシュ（読み取り専用）。"""
+    Sigma = np.full((M, M), rho, dtype=float)
+    np.fill_diagonal(Sigma, 1.0)
+
+    # コレスキー（微小の数値誤差対策で対角にεを足す場合あり）
+    eps = 1e-12
+    try:
+        L = np.linalg.cholesky(Sigma)
+    except np.linalg.LinAlgError:
+        L = np.linalg.cholesky(Sigma + eps * np.eye(M))
+    L.setflags(write=False)
+    return L
 
 def effective_clear_prob_independent(p_list):
     """独立モデル: 晴れ確率 p_list の地上局が M局ある時の有効晴天確率 p_eff."""
@@ -27,86 +87,111 @@ def simulate_effective_clear_prob_correlated(
     rho: float,
     trials: int = 20000,
     seed: int = 12344,
+    use_gpu: bool = False,
 ):
     """
     相関モデル（ガウス・コピュラ）で p_eff をMonte Carlo推定。
     - 相関係数 rho を全オフ対角要素に入れた相関行列を構成（-1/(M-1) < rho < 1 にクリップ）
     - Z ~ N(0, Sigma) を生成 → U = Φ(Z) → 各局 i の U_i < p_i なら「晴れ」
+      （Φ は単調なので U_i < p_i ⇔ Z_i < Φ⁻¹(p_i)。U 行列は作らず Z を直接しきい値判定）
     - 1試行で「少なくとも1局晴れ」なら1カウント → 平均が p_eff 推定
+    - rho=0 のときは独立モデルの解析値 1-Π(1-p_i) をそのまま返す
+    - use_gpu=True かつ CuPy があれば同じ手順を GPU 上でバッチ実行（trials≧10⁶ 向け。乱数列は CPU 版と異なる）
     """
     p = np.clip(np.asarray(station_p_list, dtype=float), 0.0, 1.0)
     M = p.size
     if M == 0:
         return 0.0
+    if abs(rho) < 1e-12:
+        # 無相関なら独立モデルそのもの → Monte Carlo 不要（解析値を返す）
+        return effective_clear_prob_independent(p)
 
     # 相関の安定化: 一様相関行列が半正定値になる範囲にクリップ
     # 一様相関での下限は -1/(M-1)
     rho_min = -1.0 / (M - 1) + 1e-9 if M > 1 else -0.999999
     rho = float(np.clip(rho, rho_min, 0.999999))
 
-    # 相関行列（対角1、オフ対角rho）
-    Sigma = np.full((M, M), rho, dtype=float)
-    np.fill_diagonal(Sigma, 1.0)
+    L = _chol_uniform(M, rho)
 
-    # コレスキー（微小の数値誤差対策で対角にεを足す場合あり）
-    eps = 1e-12
-    try:
-        L = np.linalg.cholesky(Sigma)
-    except np.linalg.LinAlgError:
-        L = np.linalg.cholesky(Sigma + eps * np.eye(M))
+    t = norm_ppf(p)  # 局ごとのしきい値 Φ⁻¹(p_i)（M 個だけ計算）
 
-    rng = np.random.default_rng(seed)
-    # 標準正規 N(0, I) → 相関付き N(0, Sigma)
-    Z = rng.standard_normal(size=(trials, M)) @ L.T
-    U = norm_cdf(Z)  # [trials, M] に 0..1 の一様乱数（相関あり）
+    if use_gpu and HAVE_CUPY:
+        rng_gpu = cp.random.default_rng(seed)
+        Z_gpu = rng_gpu.standard_normal(size=(trials, M)) @ cp.asarray(L).T
+        any_gpu = cp.any(Z_gpu < cp.asarray(t), axis=1)
+        return float(cp.count_nonzero(any_gpu)) / trials
 
-    clear_mat = (U < p)          # True=晴れ
-    any_clear = np.any(clear_mat, axis=1)  # 少なくとも1局晴れ
-    p_eff_hat = float(np.mean(any_clear))
-    return p_eff_hat
+    # 試行を MC_BLOCK 行ずつ生成して数える（[trials, M] の行列は作らない。乱数列は一括生成と同じ）
+    rng = np.random.default_rng(seed)
+    count = 0
+    for start in range(0, trials, MC_BLOCK):
+        E = rng.standard_normal(size=(min(MC_BLOCK, trials - start), M))
+
+        if HAVE_NUMBA:
+            # 相関付け・しきい値判定・OR・集計を1カーネルに融合
+            count += _count_any_clear(E, L, t)
+            continue
+
+        # 標準正規 N(0, I) → 相関付き N(0, Sigma)
+        Z = E @ L.T
+
+        # 局ごとに「晴れ」を OR で累積（全試行が晴れ確定したら残りの局は見ない）
+        any_clear = np.zeros(E.shape[0], dtype=bool)  # 少なくとも1局晴れ
+        for i in range(M):
+            any_clear |= (Z[:, i] < t[i])
+            if any_clear.all():
+                break
+        count += int(np.count_nonzero(any_clear))
+    return count / trials
 
 # ========= ここから “モデル本体” =========
-def main():
-    # --- 日次スループットの基本パラメータ（教育用にまとめ値） ---
-    passes_per_day = 6        # 1日の可視パス数
-    pass_time      = 300      # 1パスの可視時間 [s]
-    bits_per_pass  = 1.0e8    # 1パスで得られる鍵ビット数（代表値, 例: 100 Mbit）
-    base_ps = 0.5             # 各局の「晴れ確率」の基本値（同一とする）
-    rho_dep = 0.5             # 相関モデルの相関係数 ρ（都市部で天候が似るイメージ）
-
-    # --- M（地上局数）を 1..M_max まで掃引 ---
-    M_max = 20
+# --- 日次スループットの基本パラメータ（教育用にまとめ値） ---
+PASSES_PER_DAY = 6        # 1日の可視パス数
+PASS_TIME      = 300      # 1パスの可視時間 [s]
+BITS_PER_PASS  = 1.0e8    # 1パスで得られる鍵ビット数（代表値, 例: 100 Mbit）
+BASE_PS = 0.5             # 各局の「晴れ確率」の基本値（同一とする）
+RHO_DEP = 0.5             # 相関モデルの相関係数 ρ（都市部で天候が似るイメージ）
+
+def compute(M_max: int = 20) -> dict:
+    """M（地上局数）を 1..M_max まで掃引して bits/day を返す（matplotlib 不要）。"""
     Ms = np.arange(1, M_max + 1)
 
     indep_curve = []   # 独立モデルの bits/day
     mc_curve    = []   # 相関モデルの bits/day（Monte Carlo）
 
     for M in Ms:
-        # 各局の晴れ確率リスト（ここでは全て同じ base_ps）
-        p_list = np.full(M, base_ps, dtype=float)
+        # 各局の晴れ確率リスト（ここでは全て同じ BASE_PS）
+        p_list = np.full(M, BASE_PS, dtype=float)
 
         # 独立モデル
         p_eff_ind = effective_clear_prob_independent(p_list)
-        bits_day_ind = bits_per_pass * passes_per_day * p_eff_ind
+        bits_day_ind = BITS_PER_PASS * PASSES_PER_DAY * p_eff_ind
         indep_curve.append(bits_day_ind)
 
         # 相関モデル（ガウス・コピュラ）
         p_eff_mc = simulate_effective_clear_prob_correlated(
             station_p_list=p_list,
-            rho=rho_dep,
+            rho=RHO_DEP,
             trials=20000,
             seed=12345,
         )
-        bits_day_mc = bits_per_pass * passes_per_day * p_eff_mc
+        bits_day_mc = BITS_PER_PASS * PASSES_PER_DAY * p_eff_mc
         mc_curve.append(bits_day_mc)
 
-    indep_curve = np.asarray(indep_curve)
-    mc_curve    = np.asarray(mc_curve)
+    return {
+        "Ms": Ms,
+        "indep_curve": np.asarray(indep_curve),
+        "mc_curve": np.asarray(mc_curve),
+    }
+
+def plot(results: dict):
+    import matplotlib.pyplot as plt
 
     # --- 図示 ---
+    Ms = results["Ms"]
     plt.figure(figsize=(8,5))
-    plt.plot(Ms, indep_curve, marker='o', label="Independent (analytic)")
-    plt.plot(Ms, mc_curve,    marker='s', label=f"Correlated MC (rho={rho_dep})")
+    plt.plot(Ms, results["indep_curve"], marker='o', label="Independent (analytic)")
+    plt.plot(Ms, results["mc_curve"],    marker='s', label=f"Correlated MC (rho={RHO_DEP})")
     plt.xlabel("Number of ground stations (M)")
     plt.ylabel("Daily secure key [bits/day]")
     plt.title("Independent vs Correlated weather model")
@@ -115,18 +200,26 @@ def main():
     plt.tight_layout()
     plt.show()
 
+def main():
+    ap = argparse.ArgumentParser(description="段階28 複数地上局 M の bits/day（天候独立 vs 相関）")
+    ap.add_argument("--no-plot", dest="plot", action="store_false", help="図を描かない（数値のみ）")
+    args = ap.parse_args()
+
+    res = compute()
+    if args.plot:
+        plot(res)
+
     # --- コンソールへ一部サンプル出力 ---
     print("\n--- Sample numbers ---")
-    print(f"passes/day={passes_per_day}, pass_time={pass_time}s, bits/pass={bits_per_pass:.2e}")
+    print(f"passes/day={PASSES_PER_DAY}, pass_time={PASS_TIME}s, bits/pass={BITS_PER_PASS:.2e}")
     for M in [1, 2, 5, 10, 20]:
-        p_list = np.full(M, base_ps, dtype=float)
+        p_list = np.full(M, BASE_PS, dtype=float)
         p_ind = effective_clear_prob_independent(p_list)
-        p_mc  = simulate_effective_clear_prob_correlated(p_list, rho=rho_dep, trials=20000, seed=2028)
-        bd_ind = bits_per_pass * passes_per_day * p_ind
-        bd_mc  = bits_per_pass * passes_per_day * p_mc
-        print(f"M={M:>2d}: p_eff(indep)={p_ind:.3f}, p_eff(corr@rho={rho_dep})={p_mc:.3f} | "
+        p_mc  = simulate_effective_clear_prob_correlated(p_list, rho=RHO_DEP, trials=20000, seed=2028)
+        bd_ind = BITS_PER_PASS * PASSES_PER_DAY * p_ind
+        bd_mc  = BITS_PER_PASS * PASSES_PER_DAY * p_mc
+        print(f"M={M:>2d}: p_eff(indep)={p_ind:.3f}, p_eff(corr@rho={RHO_DEP})={p_mc:.3f} | "
               f"bits/day(ind)={bd_ind:.2e}, corr={bd_mc:.2e}")
 
 if __name__ == "__main__":
     main()
-
@@ -36,12 +36,16 @@ BUF_MAX = 10_000.0         # 教育用上限（無限でもOK。見やすさ用
 # ===== データ生成 =====
 days = np.arange(1, DAYS + 1)
 
+# 日次の乱数はまとめて1回ずつ引いてアフィン変換（一様: Fiber/需要, 正規: 晴天率）
+u = rng.random((DAYS, 2))
+g = rng.standard_normal(DAYS)
+
 # Fiber 生産（ゆらぐが大きくは変わらない）
-fiber_prod = FIBER_MEAN + rng.uniform(-FIBER_JITTER, +FIBER_JITTER, size=DAYS)
+fiber_prod = FIBER_MEAN + (2.0 * u[:, 0] - 1.0) * FIBER_JITTER
 fiber_prod = np.clip(fiber_prod, 0.0, None)
 
 # その日の晴天率を正規分布からサンプル → [0,1] にクリップ
-p_clear_daily = np.clip(rng.normal(MEAN_P_CLEAR, SIGMA_P_CLEAR, size=DAYS), 0.0, 1.0)
+p_clear_daily = np.clip(MEAN_P_CLEAR + SIGMA_P_CLEAR * g, 0.0, 1.0)
 
 # Outage（分/日）＝（曇り・雨の割合）× 最大稼働分数
 outage_min = (1.0 - p_clear_daily) * MAX_SAT_MIN
@@ -50,7 +54,7 @@ outage_min = (1.0 - p_clear_daily) * MAX_SAT_MIN
 sat_prod = SAT_CLEAR_PROD * p_clear_daily
 
 # 需要（消費）
-consume = CONS_MEAN + rng.uniform(-CONS_JITTER, +CONS_JITTER, size=DAYS)
+consume = CONS_MEAN + (2.0 * u[:, 1] - 1.0) * CONS_JITTER
 consume = np.clip(consume, 0.0, None)
 
 # ===== 鍵バッファ残量（“貯金”）の推移 =====
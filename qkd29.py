@@ -1,22 +1,55 @@
 # qkd29.py  —  段階29：ファイバ + 衛星 + 天候相関(ガウス・コピュラ) + バッファ + 消費
 from __future__ import annotations
+import argparse
 import math
+from statistics import NormalDist
 import numpy as np
-import matplotlib.pyplot as plt
+from numpy.polynomial.hermite_e import hermegauss
+
+try:
+    from scipy.special import ndtr
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+try:
+    from numba import njit, vectorize, float64
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        # numba が無ければ素の Python 関数として使う
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
 
 # ========= 配列対応の正規CDF（erfの配列化が肝） =========
+_erf_vec = np.vectorize(math.erf)   # SciPy なしのときの予備（呼び出しごとに作り直さない）
+
+_SQRT2 = math.sqrt(2.0)
+if HAVE_NUMBA and not HAVE_SCIPY:
+    # SciPy なしでも numba があれば math.erf をネイティブの ufunc にする（要素ごとの Python 呼び出しなし）
+    # SciPy があるときは使わないので、import 時のコンパイルもしない
+    @vectorize([float64(float64)])
+    def _gauss_cdf_ufunc(x):
+        return 0.5 * (1.0 + math.erf(x / _SQRT2))
+
 def norm_cdf(x):
-    """標準正規Φ(x)。math.erfはスカラー専用なのでベクトル化して配列OKにする。"""
+    """標準正規Φ(x)。SciPy があれば C 実装の ndtr、なければ math.erf をベクトル化して配列OKにする。"""
     x = np.asarray(x, dtype=float)
-    erf_vec = np.vectorize(math.erf)
-    return 0.5 * (1.0 + erf_vec(x / np.sqrt(2.0)))
-
-# ========= 天候：相関付き 1 ステップの「少なくとも1局晴れ」 =========
-def at_least_one_clear_once(p_list, rho: float, rng: np.random.Generator) -> bool:
+    if HAVE_SCIPY:
+        return ndtr(x)
+    if HAVE_NUMBA:
+        return _gauss_cdf_ufunc(x)
+    return 0.5 * (1.0 + _erf_vec(x / np.sqrt(2.0)))
+
+# ========= 天候：相関行列のコレスキー因子（シミュレーション中は不変なので1回だけ） =========
+def _prepare_weather(p_list, rho: float):
+    """(L, P) を返す。L: 一様相関行列のコレスキー因子、P: 各局の晴れ確率（配列）。"""
     p = np.clip(np.asarray(p_list, dtype=float), 0.0, 1.0)
     M = p.size
     if M == 0:
-        return False
+        return np.zeros((0, 0)), p
 
     # 一様相関行列が半正定値になる範囲にクリップ（下限は -1/(M-1)）
     rho_min = -1.0 / (M - 1) + 1e-9 if M > 1 else -0.999999
@@ -32,19 +65,48 @@ def at_least_one_clear_once(p_list, rho: float, rng: np.random.Generator) -> boo
         L = np.linalg.cholesky(Sigma)
     except np.linalg.LinAlgError:
         L = np.linalg.cholesky(Sigma + eps * np.eye(M))
+    return L, p
 
-    # 相関付き標準正規ベクトル Z ~ N(0, Σ)
-    z0 = rng.standard_normal(M)
-    Z  = L @ z0
-    U  = norm_cdf(Z)           # 相関あり一様乱数（0..1）
-
-    clear_vec = (U < p)        # 各局：U_i < p_i で晴れ
-    return bool(np.any(clear_vec))
+# ========= 天候：相関付き n ステップ分の「少なくとも1局晴れ」 =========
+def at_least_one_clear_batch(L, P, rng: np.random.Generator, n: int) -> np.ndarray:
+    M = P.size
+    if M == 0:
+        return np.zeros(n, dtype=bool)
+
+    # 相関付き標準正規 Z ~ N(0, Σ) を n ステップ分まとめて生成
+    Z = rng.standard_normal((n, M)) @ L.T
+    U = norm_cdf(Z)            # 相関あり一様乱数（0..1）
+
+    clear_mat = (U < P)        # 各局：U_i < p_i で晴れ
+    return clear_mat.any(axis=1)
+
+# ========= 天候：同一晴れ確率 × 一様相関なら「少なくとも1局晴れ」は定数 =========
+def precompute_clear_any_prob(p: float, rho: float, M: int, n_quad: int = 64) -> float:
+    """
+    Z_i = √ρ W + √(1-ρ) ε_i と分解すると、W を固定すれば各局は独立なので
+      P(全局曇り) = ∫ φ(w) Φ((Φ⁻¹(1-p) - √ρ w)/√(1-ρ))^M dw
+    を Gauss–Hermite 求積（n_quad 点）で評価し、1 - P(全局曇り) を返す（0 <= rho < 1）。
+    """
+    if M == 0 or p <= 0.0:
+        return 0.0
+    if p >= 1.0:
+        return 1.0
+    nodes, weights = hermegauss(n_quad)   # ∫ f(w) e^{-w²/2} dw ≈ Σ weights * f(nodes)
+    t = NormalDist().inv_cdf(1.0 - p)
+    dry = norm_cdf((t - math.sqrt(rho) * nodes) / math.sqrt(1.0 - rho)) ** M
+    return float(1.0 - np.sum(weights * dry) / math.sqrt(2.0 * math.pi))
+
+def clear_any_mask(L, P, rho: float, rng: np.random.Generator, shape) -> np.ndarray:
+    """「少なくとも1局晴れ」の bool 配列。全局同じ p かつ 0 <= rho < 1 なら定数確率のベルヌーイで済ませる。"""
+    if P.size > 0 and np.all(P == P[0]) and 0.0 <= rho < 1.0:
+        return rng.random(shape) < precompute_clear_any_prob(float(P[0]), rho, P.size)
+    return at_least_one_clear_batch(L, P, rng, shape)
 
 # ========= シナリオ定数 =========
 DAYS               = 30
 DT_SEC             = 60                    # 1分ステップ
 STEPS_PER_DAY      = int(24*3600 // DT_SEC)
+TOTAL_STEPS        = DAYS * STEPS_PER_DAY
 
 FIBER_BPS          = 5e6                   # ファイバ鍵生成レート [bit/s]
 SAT_BPS            = 50e6                  # 衛星鍵生成レート [bit/s]（可視＋晴天）
@@ -56,6 +118,7 @@ PASSES_PER_DAY     = 4
 PASS_TIME_SEC      = 600
 PASS_DUTY          = (PASSES_PER_DAY * PASS_TIME_SEC) / (24*3600)
 PASS_PROB_PER_STEP = PASS_DUTY             # ベルヌーイ近似：各分で稼働している確率
+P_SAT_ANY          = 1.0 - (1.0 - PASS_PROB_PER_STEP) ** N_SAT   # N機のうち少なくとも1機が稼働する確率
 
 GROUND_P_LIST      = [0.5, 0.5, 0.5]       # 各地上局の晴れ確率
 WEATHER_RHO        = 0.5                   # 天候相関係数（一様相関）
@@ -65,63 +128,99 @@ INIT_BUFFER_BITS   = 0
 
 RNG_SEED           = 29
 
+# 1ステップあたりのビット数（ループ内で毎回計算しない）
+FIBER_BITS_PER_STEP = int(FIBER_BPS * DT_SEC)
+SAT_BITS_PER_STEP   = int(SAT_BPS * DT_SEC)
+CONS_BITS_PER_STEP  = int(CONS_BPS * DT_SEC)
+
+# ========= バッファ更新（ここだけは逐次 → numba があればネイティブ化） =========
+@njit(cache=True)
+def run_buffer(produced_arr, cons_bits, cap, init_buf):
+    """
+    buffer = clip(buffer + produced - cons, 0, cap) をステップごとに更新。
+    戻り値: (各ステップ後のバッファ残量, 停止したステップか)
+    """
+    n = produced_arr.size
+    buffer_series = np.empty(n, dtype=np.int64)
+    outage_series = np.zeros(n, dtype=np.bool_)
+
+    buffer_bits = init_buf
+    for i in range(n):
+        produced = produced_arr[i]
+        buffer_bits = buffer_bits + produced - cons_bits
+        if buffer_bits < 0:
+            buffer_bits = 0
+        elif buffer_bits > cap:
+            buffer_bits = cap
+        buffer_series[i] = buffer_bits
+        if buffer_bits == 0 and produced < cons_bits:
+            outage_series[i] = True
+    return buffer_series, outage_series
+
+def run_buffer_fast(produced_arr, cons_bits, cap, init_buf):
+    """
+    run_buffer と同じ結果を NumPy の累積演算だけで求める高速版。
+    下限 0 のクリップだけなら S = init + cumsum(produced - cons) として
+      buffer_t = S_t - min(0, min_{s<=t} S_s)
+    と閉じた形（running-min）で書ける。上限 cap に一度も届かなければこれで確定、
+    届く場合は逐次スキャン（run_buffer）に戻す。
+    """
+    S = init_buf + np.cumsum(produced_arr - cons_bits)
+    buffer_series = S - np.minimum(np.minimum.accumulate(S), 0)
+    if buffer_series.size and buffer_series.max() > cap:
+        return run_buffer(produced_arr, cons_bits, cap, init_buf)
+    outage_series = (buffer_series == 0) & (produced_arr < cons_bits)
+    return buffer_series, outage_series
+
 # ========= メイン・シミュレーション =========
-def simulate():
-    rng = np.random.default_rng(RNG_SEED)
-
-    prod_fiber_day      = np.zeros(DAYS, dtype=np.int64)
-    prod_sat_day        = np.zeros(DAYS, dtype=np.int64)
-    cons_day            = np.zeros(DAYS, dtype=np.int64)
-    outage_minutes_day  = np.zeros(DAYS, dtype=np.int32)
-    min_buffer_day      = np.zeros(DAYS, dtype=np.int64)
-
-    buffer_bits = INIT_BUFFER_BITS
-
-    for d in range(DAYS):
-        min_buf = BUFFER_CAP_BITS
-        prod_fiber = 0
-        prod_sat   = 0
-        cons_total = 0
-        outage_min = 0
-
-        for _ in range(STEPS_PER_DAY):
-            # 生産（ファイバは常時）
-            fiber_bits = int(FIBER_BPS * DT_SEC)
-
-            # 衛星：N機のうち少なくとも1機が稼働
-            active_any_sat = np.any(rng.random(N_SAT) < PASS_PROB_PER_STEP)
-            # 天候：少なくとも1局晴れ
-            clear_any = at_least_one_clear_once(GROUND_P_LIST, WEATHER_RHO, rng)
-
-            sat_bits = int(SAT_BPS * DT_SEC) if (active_any_sat and clear_any) else 0
-
-            # 消費
-            cons_bits = int(CONS_BPS * DT_SEC)
-
-            # バッファ更新（上限/下限のクリップ）
-            produced   = fiber_bits + sat_bits
-            buffer_bits = min(BUFFER_CAP_BITS, max(0, buffer_bits + produced - cons_bits))
-
-            # 統計
-            prod_fiber += fiber_bits
-            prod_sat   += sat_bits
-            cons_total += cons_bits
-            if buffer_bits == 0 and produced < cons_bits:
-                outage_min += 1
-
-            if buffer_bits < min_buf:
-                min_buf = buffer_bits
-
-        prod_fiber_day[d]     = prod_fiber
-        prod_sat_day[d]       = prod_sat
-        cons_day[d]           = cons_total
-        outage_minutes_day[d] = outage_min
-        min_buffer_day[d]     = min_buf
+def simulate(seed=RNG_SEED):
+    # seed は int / SeedSequence / Generator のどれでもOK（SeedSequence.spawn の子を渡せば並列でも独立）
+    rng = np.random.default_rng(seed)
+    L, P = _prepare_weather(GROUND_P_LIST, WEATHER_RHO)
+
+    # 衛星・天候はステップ間で独立 → 全ステップ分をまとめて生成
+    # 衛星：N機のうち少なくとも1機が稼働
+    sat_mask = rng.random(TOTAL_STEPS) < P_SAT_ANY
+    # 天候：少なくとも1局晴れ
+    weather_mask = clear_any_mask(L, P, WEATHER_RHO, rng, TOTAL_STEPS)
+
+    # 生産（ファイバは常時）と消費
+    sat_arr   = np.where(sat_mask & weather_mask, SAT_BITS_PER_STEP, 0).astype(np.int64)
+    produced  = sat_arr + FIBER_BITS_PER_STEP   # ファイバは毎ステップ一定
+
+    # バッファ更新（上限/下限のクリップ）
+    buffer_series, outage_series = run_buffer_fast(
+        produced, CONS_BITS_PER_STEP, BUFFER_CAP_BITS, INIT_BUFFER_BITS)
+
+    # 日ごとの統計
+    # ファイバ生産・消費は毎ステップ一定 → 1日ぶんの合計も定数
+    prod_fiber_day      = np.full(DAYS, FIBER_BITS_PER_STEP*STEPS_PER_DAY, dtype=np.int64)
+    prod_sat_day        = sat_arr.reshape(DAYS, -1).sum(axis=1)
+    cons_day            = np.full(DAYS, CONS_BITS_PER_STEP*STEPS_PER_DAY, dtype=np.int64)
+    outage_minutes_day  = outage_series.reshape(DAYS, -1).sum(axis=1).astype(np.int32)
+    min_buffer_day      = buffer_series.reshape(DAYS, -1).min(axis=1)
 
     return prod_fiber_day, prod_sat_day, cons_day, outage_minutes_day, min_buffer_day
 
+# ========= 日ごとの簡易グラフ（任意） =========
+def plot(prod_fiber_day, prod_sat_day, cons_day, outage_minutes_day):
+    import matplotlib.pyplot as plt
+
+    days = np.arange(1, DAYS+1)
+    plt.figure(figsize=(10,5))
+    plt.plot(days, prod_fiber_day/1e9, label="Fiber produced [Gbit/day]")
+    plt.plot(days, prod_sat_day/1e9,   label="Sat produced [Gbit/day]")
+    plt.plot(days, cons_day/1e9,       label="Consumed [Gbit/day]")
+    plt.step(days, outage_minutes_day, where='mid', label="Outage minutes [min/day]")
+    plt.xlabel("Day"); plt.grid(True); plt.legend(); plt.tight_layout()
+    plt.show()
+
 # ========= 実行 & KPI =========
 def main():
+    ap = argparse.ArgumentParser(description="段階29 ファイバ + 衛星 + 天候相関 + バッファ + 消費")
+    ap.add_argument("--no-plot", dest="plot", action="store_false", help="図を描かない（数値のみ）")
+    args = ap.parse_args()
+
     prod_fiber_day, prod_sat_day, cons_day, outage_minutes_day, min_buffer_day = simulate()
 
     total_prod_fiber = int(prod_fiber_day.sum())
@@ -143,15 +242,8 @@ def main():
     print(f"Fiber_bps={FIBER_BPS:.0f}, Sat_bps={SAT_BPS:.0f}, Cons_bps={CONS_BPS:.0f}")
     print(f"Buffer cap={BUFFER_CAP_BITS/1e9:.2f} Gbit")
 
-    # 日ごとの簡易グラフ（任意）
-    days = np.arange(1, DAYS+1)
-    plt.figure(figsize=(10,5))
-    plt.plot(days, prod_fiber_day/1e9, label="Fiber produced [Gbit/day]")
-    plt.plot(days, prod_sat_day/1e9,   label="Sat produced [Gbit/day]")
-    plt.plot(days, cons_day/1e9,       label="Consumed [Gbit/day]")
-    plt.step(days, outage_minutes_day, where='mid', label="Outage minutes [min/day]")
-    plt.xlabel("Day"); plt.grid(True); plt.legend(); plt.tight_layout()
-    plt.show()
+    if args.plot:
+        plot(prod_fiber_day, prod_sat_day, cons_day, outage_minutes_day)
 
 if __name__ == "__main__":
     main()
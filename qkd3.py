@@ -20,24 +20,24 @@ bob_bits = np.where(alice_bases == bob_bases,
                     rng.integers(0, 2, size=N, dtype=np.uint8))
 
 # ---- sifting ----
+# ブールマスクでの抽出は新しい配列を返す（.copy() 不要）
 match = (alice_bases == bob_bases)
-idx = np.where(match)[0]
-a_sift = alice_bits[idx].copy()
-b_sift = bob_bits[idx].copy()
+a_sift = alice_bits[match]
+b_sift = bob_bits[match]
 
-if len(a_sift) == 0:
+if a_sift.size == 0:
     print("QBER=NA, sifted=0（基底一致が0件）")
 else:
     # ---- QBER推定（20%を検査）----
-    k = max(1, int(len(a_sift) * 0.2))
-    test_idx = rng.choice(len(a_sift), size=k, replace=False)
-    qber = float(np.mean(a_sift[test_idx] ^ b_sift[test_idx]))
+    # 1回のシャッフルで「検査用」と「鍵用」の添字を切り分ける
+    perm = rng.permutation(a_sift.size)
+    k = max(1, a_sift.size // 5)
+    test_idx, keep_idx = perm[:k], perm[k:]
+    qber = np.count_nonzero(a_sift[test_idx] != b_sift[test_idx]) / k
 
     # 検査に使ったビットを除外して鍵に
-    mask = np.ones(len(a_sift), dtype=bool)
-    mask[test_idx] = False
-    a_key = a_sift[mask]
-    b_key = b_sift[mask]
+    a_key = a_sift[keep_idx]
+    b_key = b_sift[keep_idx]
 
     print(f"QBER={qber:.2%}, sifted={len(a_key)}")
 
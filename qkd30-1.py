@@ -1,26 +1,53 @@
 # qkd30_jp.py  — 段階30（日本語ラベル版）
 from __future__ import annotations
 import math
+from statistics import NormalDist
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import rcParams
-
-# ====== 日本語フォントを指定 ======
-rcParams['font.family'] = 'Hiragino Sans'  # Macの場合
-# Windowsの人は → rcParams['font.family'] = 'Meiryo'
+from numpy.polynomial.hermite_e import hermegauss
+
+try:
+    from scipy.special import ndtr
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+try:
+    from numba import njit, vectorize, float64
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        # numba が無ければ素の Python 関数として使う
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
 
 # ========= 配列対応の正規CDF =========
+_erf_vec = np.vectorize(math.erf)   # SciPy なしのときの予備
+
+_SQRT2 = math.sqrt(2.0)
+if HAVE_NUMBA and not HAVE_SCIPY:
+    # SciPy なしでも numba があれば math.erf をネイティブの ufunc にする（要素ごとの Python 呼び出しなし）
+    # SciPy があるときは使わないので、import 時のコンパイルもしない
+    @vectorize([float64(float64)])
+    def _gauss_cdf_ufunc(x):
+        return 0.5 * (1.0 + math.erf(x / _SQRT2))
+
 def norm_cdf(x):
     x = np.asarray(x, dtype=float)
-    erf_vec = np.vectorize(math.erf)
-    return 0.5 * (1.0 + erf_vec(x / np.sqrt(2.0)))
+    if HAVE_SCIPY:
+        return ndtr(x)
+    if HAVE_NUMBA:
+        return _gauss_cdf_ufunc(x)
+    return 0.5 * (1.0 + _erf_vec(x / np.sqrt(2.0)))
 
 # ========= 天候モデル =========
-def at_least_one_clear_once(p_list, rho: float, rng: np.random.Generator) -> bool:
+def _prepare_weather(p_list, rho: float):
+    """(L, P): 一様相関行列のコレスキー因子と晴れ確率配列。シミュレーション開始時に1回だけ作る。"""
     p = np.clip(np.asarray(p_list, dtype=float), 0.0, 1.0)
     M = p.size
     if M == 0:
-        return False
+        return np.zeros((0, 0)), p
 
     rho_min = -1.0 / (M - 1) + 1e-9 if M > 1 else -0.999999
     rho = float(np.clip(rho, rho_min, 0.999999))
@@ -33,28 +60,56 @@ def at_least_one_clear_once(p_list, rho: float, rng: np.random.Generator) -> boo
         L = np.linalg.cholesky(Sigma)
     except np.linalg.LinAlgError:
         L = np.linalg.cholesky(Sigma + eps * np.eye(M))
+    return L, p
 
-    z0 = rng.standard_normal(M)
-    Z  = L @ z0
-    U  = norm_cdf(Z)
-
-    clear_vec = (U < p)
-    return bool(np.any(clear_vec))
+def at_least_one_clear_batch(L, P, rng: np.random.Generator, n: int) -> np.ndarray:
+    M = P.size
+    if M == 0:
+        return np.zeros(n, dtype=bool)
+
+    Z = rng.standard_normal((n, M)) @ L.T
+    U = norm_cdf(Z)
+
+    clear_mat = (U < P)
+    return clear_mat.any(axis=1)
+
+# ========= 天候：同一晴れ確率 × 一様相関なら「少なくとも1局晴れ」は定数 =========
+def precompute_clear_any_prob(p: float, rho: float, M: int, n_quad: int = 64) -> float:
+    """
+    Z_i = √ρ W + √(1-ρ) ε_i と分解すると、W を固定すれば各局は独立なので
+      P(全局曇り) = ∫ φ(w) Φ((Φ⁻¹(1-p) - √ρ w)/√(1-ρ))^M dw
+    を Gauss–Hermite 求積（n_quad 点）で評価し、1 - P(全局曇り) を返す（0 <= rho < 1）。
+    """
+    if M == 0 or p <= 0.0:
+        return 0.0
+    if p >= 1.0:
+        return 1.0
+    nodes, weights = hermegauss(n_quad)   # ∫ f(w) e^{-w²/2} dw ≈ Σ weights * f(nodes)
+    t = NormalDist().inv_cdf(1.0 - p)
+    dry = norm_cdf((t - math.sqrt(rho) * nodes) / math.sqrt(1.0 - rho)) ** M
+    return float(1.0 - np.sum(weights * dry) / math.sqrt(2.0 * math.pi))
+
+def clear_any_mask(L, P, rho: float, rng: np.random.Generator, shape) -> np.ndarray:
+    """「少なくとも1局晴れ」の bool 配列。全局同じ p かつ 0 <= rho < 1 なら定数確率のベルヌーイで済ませる。"""
+    if P.size > 0 and np.all(P == P[0]) and 0.0 <= rho < 1.0:
+        return rng.random(shape) < precompute_clear_any_prob(float(P[0]), rho, P.size)
+    return at_least_one_clear_batch(L, P, rng, shape)
 
 # ========= CHSHゲート =========
-def chsh_pass_once(qber: float, n_pairs: int, rng: np.random.Generator) -> bool:
+def chsh_pass_prob(qber: float, n_pairs: int) -> float:
+    """CHSH 合格確率（qber と n_pairs が決まれば定数）。"""
     if n_pairs <= 0:
-        return False
+        return 0.0
     S_thr = 2.0
     S_exp = 2.0 * np.sqrt(2.0) * max(0.0, (1.0 - 2.0 * qber))
     z = (S_exp - S_thr) * np.sqrt(float(n_pairs))
-    p_pass = float(np.clip(norm_cdf(z), 0.0, 1.0))
-    return bool(rng.random() < p_pass)
+    return float(np.clip(norm_cdf(z), 0.0, 1.0))
 
 # ========= 定数 =========
 DAYS               = 30
 DT_SEC             = 60
 STEPS_PER_DAY      = int(24*3600 // DT_SEC)
+TOTAL_STEPS        = DAYS * STEPS_PER_DAY
 
 FIBER_BPS          = 5e6
 SAT_BPS            = 50e6
@@ -66,6 +121,7 @@ PASSES_PER_DAY     = 4
 PASS_TIME_SEC      = 600
 PASS_DUTY          = (PASSES_PER_DAY * PASS_TIME_SEC) / (24*3600)
 PASS_PROB_PER_STEP = PASS_DUTY
+P_SAT_ANY          = 1.0 - (1.0 - PASS_PROB_PER_STEP) ** N_SAT   # 少なくとも1機が稼働する確率
 
 GROUND_P_LIST      = [0.5, 0.5, 0.5]
 WEATHER_RHO        = 0.5
@@ -76,62 +132,79 @@ INIT_BUFFER_BITS   = 0
 
 RNG_SEED           = 30
 
-# ========= シミュレーション =========
-def simulate():
-    rng = np.random.default_rng(RNG_SEED)
-
-    prod_fiber_day      = np.zeros(DAYS, dtype=np.int64)
-    prod_sat_day        = np.zeros(DAYS, dtype=np.int64)
-    cons_day            = np.zeros(DAYS, dtype=np.int64)
-    outage_minutes_day  = np.zeros(DAYS, dtype=np.int32)
-    min_buffer_day      = np.zeros(DAYS, dtype=np.int64)
-
-    buffer_bits = INIT_BUFFER_BITS
-
-    for d in range(DAYS):
-        min_buf = BUFFER_CAP_BITS
-        prod_fiber = 0
-        prod_sat   = 0
-        cons_total = 0
-        outage_min = 0
-
-        for _ in range(STEPS_PER_DAY):
-            fiber_bits = int(FIBER_BPS * DT_SEC)
+# 1ステップあたりのビット数（ループ内で毎回計算しない）
+FIBER_BITS_PER_STEP = int(FIBER_BPS * DT_SEC)
+SAT_BITS_PER_STEP   = int(SAT_BPS * DT_SEC)
+CONS_BITS_PER_STEP  = int(CONS_BPS * DT_SEC)
+SAT_TEST_BITS       = int(SAT_BITS_PER_STEP * CHSH_TEST_FRACTION)
+SAT_KEY_BITS_BASE   = SAT_BITS_PER_STEP - SAT_TEST_BITS
+
+# ========= バッファ更新（ここだけは逐次 → numba があればネイティブ化） =========
+@njit(cache=True)
+def run_buffer(produced_arr, cons_bits, cap, init_buf):
+    """戻り値: (各ステップ後のバッファ残量, 停止したステップか)"""
+    n = produced_arr.size
+    buffer_series = np.empty(n, dtype=np.int64)
+    outage_series = np.zeros(n, dtype=np.bool_)
+
+    buffer_bits = init_buf
+    for i in range(n):
+        produced = produced_arr[i]
+        buffer_bits = buffer_bits + produced - cons_bits
+        if buffer_bits < 0:
+            buffer_bits = 0
+        elif buffer_bits > cap:
+            buffer_bits = cap
+        buffer_series[i] = buffer_bits
+        if buffer_bits == 0 and produced < cons_bits:
+            outage_series[i] = True
+    return buffer_series, outage_series
+
+def run_buffer_fast(produced_arr, cons_bits, cap, init_buf):
+    """
+    run_buffer と同じ結果を NumPy の累積演算だけで求める高速版。
+    下限 0 のクリップだけなら S = init + cumsum(produced - cons) として
+      buffer_t = S_t - min(0, min_{s<=t} S_s)
+    と閉じた形（running-min）で書ける。上限 cap に一度も届かなければこれで確定、
+    届く場合は逐次スキャン（run_buffer）に戻す。
+    """
+    S = init_buf + np.cumsum(produced_arr - cons_bits)
+    buffer_series = S - np.minimum(np.minimum.accumulate(S), 0)
+    if buffer_series.size and buffer_series.max() > cap:
+        return run_buffer(produced_arr, cons_bits, cap, init_buf)
+    outage_series = (buffer_series == 0) & (produced_arr < cons_bits)
+    return buffer_series, outage_series
 
-            active_any_sat = np.any(rng.random(N_SAT) < PASS_PROB_PER_STEP)
-            clear_any = at_least_one_clear_once(GROUND_P_LIST, WEATHER_RHO, rng)
-
-            if active_any_sat and clear_any:
-                total_sat_bits = int(SAT_BPS * DT_SEC)
-                test_bits      = int(total_sat_bits * CHSH_TEST_FRACTION)
-                key_bits_base  = total_sat_bits - test_bits
-
-                n_test_pairs = test_bits
-                chsh_ok = chsh_pass_once(SAT_QBER, n_test_pairs, rng)
-
-                sat_bits = key_bits_base if chsh_ok else 0
-            else:
-                sat_bits = 0
-
-            cons_bits = int(CONS_BPS * DT_SEC)
-
-            produced    = fiber_bits + sat_bits
-            buffer_bits = min(BUFFER_CAP_BITS, max(0, buffer_bits + produced - cons_bits))
-
-            prod_fiber += fiber_bits
-            prod_sat   += sat_bits
-            cons_total += cons_bits
-            if buffer_bits == 0 and produced < cons_bits:
-                outage_min += 1
-
-            if buffer_bits < min_buf:
-                min_buf = buffer_bits
-
-        prod_fiber_day[d]     = prod_fiber
-        prod_sat_day[d]       = prod_sat
-        cons_day[d]           = cons_total
-        outage_minutes_day[d] = outage_min
-        min_buffer_day[d]     = min_buf
+# ========= シミュレーション =========
+def simulate(seed=RNG_SEED):
+    # seed は int / SeedSequence / Generator のどれでもOK（SeedSequence.spawn の子を渡せば並列でも独立）
+    rng = np.random.default_rng(seed)
+    L, P = _prepare_weather(GROUND_P_LIST, WEATHER_RHO)
+    p_chsh = chsh_pass_prob(SAT_QBER, SAT_TEST_BITS)
+
+    # 衛星・天候はステップ間で独立 → 全ステップ分をまとめて生成
+    sat_mask     = rng.random(TOTAL_STEPS) < P_SAT_ANY
+    weather_mask = clear_any_mask(L, P, WEATHER_RHO, rng, TOTAL_STEPS)
+
+    # CHSH：合格確率は定数 → 機会（衛星可視 & 晴れ）の合格数を1回の二項乱数で引き、
+    # どの機会が合格したかは非復元抽出で選ぶ（ステップごとのベルヌーイと同分布）
+    idx_opp   = np.flatnonzero(sat_mask & weather_mask)
+    n_pass    = rng.binomial(idx_opp.size, p_chsh)
+    chsh_mask = np.zeros(TOTAL_STEPS, dtype=bool)
+    chsh_mask[rng.choice(idx_opp, size=n_pass, replace=False)] = True
+
+    sat_arr   = np.where(chsh_mask, SAT_KEY_BITS_BASE, 0).astype(np.int64)
+    produced  = sat_arr + FIBER_BITS_PER_STEP   # ファイバは毎ステップ一定
+
+    buffer_series, outage_series = run_buffer_fast(
+        produced, CONS_BITS_PER_STEP, BUFFER_CAP_BITS, INIT_BUFFER_BITS)
+
+    # ファイバ生産・消費は毎ステップ一定 → 1日ぶんの合計も定数
+    prod_fiber_day      = np.full(DAYS, FIBER_BITS_PER_STEP*STEPS_PER_DAY, dtype=np.int64)
+    prod_sat_day        = sat_arr.reshape(DAYS, -1).sum(axis=1)
+    cons_day            = np.full(DAYS, CONS_BITS_PER_STEP*STEPS_PER_DAY, dtype=np.int64)
+    outage_minutes_day  = outage_series.reshape(DAYS, -1).sum(axis=1).astype(np.int32)
+    min_buffer_day      = buffer_series.reshape(DAYS, -1).min(axis=1)
 
     return prod_fiber_day, prod_sat_day, cons_day, outage_minutes_day, min_buffer_day
 
@@ -144,6 +217,12 @@ def main():
     total_cons       = int(cons_day.sum())
     total_out_min    = int(outage_minutes_day.sum())
 
+    # matplotlib は描画するときだけ読み込む（simulate() だけ使う場合は不要）
+    import matplotlib.pyplot as plt
+    # ====== 日本語フォントを指定 ======
+    plt.rcParams['font.family'] = 'Hiragino Sans'  # Macの場合
+    # Windowsの人は → plt.rcParams['font.family'] = 'Meiryo'
+
     days = np.arange(1, DAYS+1)
     fig, ax = plt.subplots(2, 1, figsize=(10, 7), sharex=True)
 
@@ -4,8 +4,10 @@
 # - N_sat や N_chsh による依存性をグラフ化
 
 import math
+import os
+from multiprocessing import Pool
+from statistics import NormalDist
 import numpy as np
-import matplotlib.pyplot as plt
 
 try:
     from scipy.stats import beta as sp_beta
@@ -14,18 +16,47 @@ except Exception:
     HAVE_SCIPY = False
 
 # ===== Utility =====
+def _cp_lo(k, n, alpha):
+    """Clopper–Pearson 下側（k, n は配列可、ppf は1回だけ呼ぶ）。"""
+    k = np.asarray(k, dtype=float); n = np.asarray(n, dtype=float)
+    return np.where(k == 0, 0.0, sp_beta.ppf(alpha/2, np.maximum(k, 1), n-k+1))
+
+def _cp_hi(k, n, alpha):
+    """Clopper–Pearson 上側（k==n の端は np.where で 1.0）。"""
+    k = np.asarray(k, dtype=float); n = np.asarray(n, dtype=float)
+    return np.where(k == n, 1.0, sp_beta.ppf(1-alpha/2, k+1, np.maximum(n-k, 1)))
+
+def _wilson_interval(k, n, alpha):
+    """Wilson 区間（NumPy のみ。n が大きければ Clopper–Pearson とほぼ一致）。"""
+    k = np.asarray(k, dtype=float); n = np.asarray(n, dtype=float)
+    z = NormalDist().inv_cdf(1-alpha/2)
+    n_safe = np.maximum(n, 1)
+    p = k/n_safe
+    denom = 1+z*z/n_safe
+    center=(p+z*z/(2*n_safe))/denom
+    half=z*np.sqrt(p*(1-p)/n_safe+z*z/(4*n_safe*n_safe))/denom
+    lo = np.where(n == 0, 0.0, np.maximum(0, center-half))
+    hi = np.where(n == 0, 1.0, np.minimum(1, center+half))
+    return (lo, hi)
+
 def clopper_pearson_interval(k, n, alpha=1e-3):
-    if n == 0: return (0.0, 1.0)
+    """k, n はスカラーでも配列でもOK（配列なら要素ごとの区間を配列で返す）。"""
+    scalar = np.ndim(k) == 0 and np.ndim(n) == 0
     if HAVE_SCIPY:
-        lo = 0.0 if k == 0 else float(sp_beta.ppf(alpha/2, k, n-k+1))
-        hi = 1.0 if k == n else float(sp_beta.ppf(1-alpha/2, k+1, n-k))
-        return (lo, hi)
-    # Wilson近似
-    p = k/n; z=3.29
-    denom = 1+z*z/n
-    center=(p+z*z/(2*n))/denom
-    half=z*math.sqrt(p*(1-p)/n+z*z/(4*n*n))/denom
-    return (max(0, center-half), min(1, center+half))
+        lo, hi = _cp_lo(k, n, alpha), _cp_hi(k, n, alpha)
+    else:
+        # Wilson近似
+        lo, hi = _wilson_interval(k, n, alpha)
+    if scalar:
+        return (float(lo), float(hi))
+    return (lo, hi)
+
+def _interval(k, n, alpha, wilson_min_n):
+    # wilson_min_n を指定したときだけ、n >= wilson_min_n のバケットを Wilson にする（beta の分位点計算を省く）
+    # Wilson は保守的でないので既定は Clopper–Pearson
+    if wilson_min_n is not None and n >= wilson_min_n:
+        return _wilson_interval(k, n, alpha)
+    return clopper_pearson_interval(k, n, alpha)
 
 def h2(x):
     if x<=0 or x>=1: return 0.0
@@ -35,22 +66,24 @@ def h2(x):
 def chsh_mismatch_prob(base_match, p_noise):
     return (1.0-base_match)+p_noise*(2*base_match-1.0)
 
-def chsh_lower_bound_for_pass(N_chsh, p_noise=0.03, alpha=1e-3, rng=None):
-    if N_chsh<=0: return -1e9
+def chsh_lower_bound_for_pass(N_chsh, p_noise=0.03, alpha=1e-3, rng=None, size=None,
+                              wilson_min_n=None):
+    """size を与えると size 回分の S_LB を配列でまとめて返す。
+    既定は Clopper–Pearson。wilson_min_n を与えると試行数がそれ以上のバケットだけ Wilson 区間（近似・高速）。"""
+    if N_chsh<=0: return -1e9 if size is None else np.full(size, -1e9)
     if rng is None: rng=np.random.default_rng()
     n00=n01=n10=n11=N_chsh//4
-    for _ in range(N_chsh-4*(N_chsh//4)):
-        n00+=1
+    n00+=N_chsh-4*(N_chsh//4)
     q_pos=chsh_mismatch_prob(0.85,p_noise)
     q_neg=chsh_mismatch_prob(0.15,p_noise)
-    k00=rng.binomial(n00,q_pos)
-    k01=rng.binomial(n01,q_pos)
-    k10=rng.binomial(n10,q_pos)
-    k11=rng.binomial(n11,q_neg)
-    _,qU00=clopper_pearson_interval(k00,n00,alpha)
-    _,qU01=clopper_pearson_interval(k01,n01,alpha)
-    _,qU10=clopper_pearson_interval(k10,n10,alpha)
-    qL11,_=clopper_pearson_interval(k11,n11,alpha)
+    k00=rng.binomial(n00,q_pos,size=size)
+    k01=rng.binomial(n01,q_pos,size=size)
+    k10=rng.binomial(n10,q_pos,size=size)
+    k11=rng.binomial(n11,q_neg,size=size)
+    _,qU00=_interval(k00,n00,alpha,wilson_min_n)
+    _,qU01=_interval(k01,n01,alpha,wilson_min_n)
+    _,qU10=_interval(k10,n10,alpha,wilson_min_n)
+    qL11,_=_interval(k11,n11,alpha,wilson_min_n)
     E00_LB=1-2*qU00
     E01_LB=1-2*qU01
     E10_LB=1-2*qU10
@@ -59,23 +92,25 @@ def chsh_lower_bound_for_pass(N_chsh, p_noise=0.03, alpha=1e-3, rng=None):
 
 # ===== Experiment =====
 def estimate_pass_rate(N_chsh, n_trials=5000, p_noise=0.03, alpha=1e-3, seed=1234):
+    """seed は int / SeedSequence / Generator のどれでもOK（Generator ならそのまま使う）。"""
     rng=np.random.default_rng(seed)
-    count=0
-    for _ in range(n_trials):
-        S_LB=chsh_lower_bound_for_pass(N_chsh,p_noise,alpha,rng)
-        if S_LB>2.0:
-            count+=1
-    return count/n_trials
+    S_LB=chsh_lower_bound_for_pass(N_chsh,p_noise,alpha,rng,size=n_trials)
+    return float(np.mean(S_LB>2.0))
 
 def main():
     # サンプル数ごとの合格率
     N_chsh_values=[100,300,1000,3000,10000]
-    rates=[]
-    for N in N_chsh_values:
-        r=estimate_pass_rate(N,n_trials=5000)
-        rates.append(r)
+    # N_chsh ごとに独立なので1プロセス1値で並列に回す
+    # 乱数は1つのシードから SeedSequence.spawn で独立な子ストリームを作って各ワーカーへ
+    rngs=[np.random.default_rng(c) for c in np.random.SeedSequence(1234).spawn(len(N_chsh_values))]
+    jobs=[(N,5000,0.03,1e-3,rng) for N,rng in zip(N_chsh_values,rngs)]
+    with Pool(min(len(jobs), os.cpu_count() or 1)) as pool:
+        rates=pool.starmap(estimate_pass_rate,jobs)
+    for N,r in zip(N_chsh_values,rates):
         print(f"N_chsh={N}: pass rate={r*100:.1f}%")
 
+    # matplotlib は描画するときだけ読み込む
+    import matplotlib.pyplot as plt
     plt.figure(figsize=(7,5))
     plt.plot(N_chsh_values,rates,marker='o')
     plt.xscale("log")
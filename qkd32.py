@@ -1,41 +1,62 @@
 # qkd32.py — 段階32：key_fraction を掃引して「パス採用率（天候＆CHSH）」を可視化
 from __future__ import annotations
 import math
+from statistics import NormalDist
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib import rcParams
+from numpy.polynomial.hermite_e import hermegauss
 
-# ===== 日本語フォント（Mac）=====
-rcParams["font.family"] = "Hiragino Sans"   # Windowsなら "Meiryo" など
+try:
+    # SciPy があればそれを使う（高速・高精度）
+    from scipy.special import ndtr
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+HAVE_NUMBA = False
+if not HAVE_SCIPY:
+    try:
+        # SciPy が無いときの norm_cdf 用（math.erf を ufunc 化する）
+        from numba import vectorize, float64
+        HAVE_NUMBA = True
+    except ImportError:
+        pass
 
 # ==============================
 #  正規CDF（配列OK）— ここが落ちどころの修正点
 # ==============================
+# math.erf はスカラー専用 → ベクトル化で配列対応（SciPy なしの予備。モジュールで1回だけ作る）
+_erf_vec = np.vectorize(math.erf)
+
+_SQRT2 = math.sqrt(2.0)
+if HAVE_NUMBA and not HAVE_SCIPY:
+    # SciPy なしでも numba があれば math.erf をネイティブの ufunc にする（要素ごとの Python 呼び出しなし）
+    # SciPy があるときは使わないので、import 時のコンパイルもしない
+    @vectorize([float64(float64)])
+    def _gauss_cdf_ufunc(x):
+        return 0.5 * (1.0 + math.erf(x / _SQRT2))
+
 def norm_cdf(x):
-    """標準正規 Φ(x)（SciPyなし・配列対応）"""
+    """標準正規 Φ(x)（配列対応。SciPy があれば ndtr、なければ math.erf（numba があれば ufunc 化））"""
     x = np.asarray(x, dtype=float)
-    try:
-        # SciPy があればそれを使う（高速・高精度）
-        from scipy.special import erf as _erf
-        return 0.5 * (1.0 + _erf(x / np.sqrt(2.0)))
-    except Exception:
-        # math.erf はスカラー専用 → ベクトル化で配列対応
-        erf_vec = np.vectorize(math.erf)
-        return 0.5 * (1.0 + erf_vec(x / np.sqrt(2.0)))
+    if HAVE_SCIPY:
+        return ndtr(x)
+    if HAVE_NUMBA:
+        return _gauss_cdf_ufunc(x)
+    return 0.5 * (1.0 + _erf_vec(x / np.sqrt(2.0)))
 
 # ==============================
-#  天候：相関付き 1 ステップの「少なくとも1局晴れ」
+#  天候：相関行列のコレスキー因子（p_list と rho が同じなら1回だけ作る）
 # ==============================
-def at_least_one_clear_once(p_list, rho: float, rng: np.random.Generator) -> bool:
+def _prepare_weather(p_list, rho: float):
     """
     p_list: 各地上局の晴れ確率 [0..1]
     rho   : 一様相関（相関行列のオフ対角を全部 rho）
-    戻り値: 少なくとも1局晴れなら True
+    戻り値: (L, P) — L: Σ のコレスキー因子、P: 晴れ確率の配列
     """
     p = np.clip(np.asarray(p_list, dtype=float), 0.0, 1.0)
     M = p.size
     if M == 0:
-        return False
+        return np.zeros((0, 0)), p
 
     # 一様相関が半正定値になる範囲にクリップ（下限 -1/(M-1)）
     rho_min = -1.0 / (M - 1) + 1e-9 if M > 1 else -0.999999
@@ -51,29 +72,66 @@ def at_least_one_clear_once(p_list, rho: float, rng: np.random.Generator) -> boo
         L = np.linalg.cholesky(Sigma)
     except np.linalg.LinAlgError:
         L = np.linalg.cholesky(Sigma + eps * np.eye(M))
+    return L, p
+
+# ==============================
+#  天候：相関付き「少なくとも1局晴れ」をまとめて判定
+# ==============================
+def at_least_one_clear_batch(L, P, rng: np.random.Generator, shape) -> np.ndarray:
+    """
+    L, P  : _prepare_weather() の戻り値
+    shape : 試行の形（例: (len(kfs), trials)）
+    戻り値: 少なくとも1局晴れなら True の bool 配列（shape）
+    """
+    M = P.size
+    if M == 0:
+        return np.zeros(shape, dtype=bool)
+
+    # 相関付き標準正規 Z ~ N(0, Σ) → 一様乱数 U = Φ(Z)
+    Z = rng.standard_normal((*shape, M)) @ L.T   # (..., M)
+    U = norm_cdf(Z)
 
-    # 相関付き標準正規 z ~ N(0, Σ) → 一様乱数 u = Φ(z)
-    z0 = rng.standard_normal(M)      # (M,)
-    z  = L @ z0                      # (M,)
-    u  = norm_cdf(z)                 # (M,)
+    # 各局：U_i < p_i なら晴れ
+    return (U < P).any(axis=-1)
 
-    # 各局：u_i < p_i なら晴れ
-    return bool(np.any(u < p))
+# ==============================
+#  天候：同一晴れ確率 × 一様相関なら「少なくとも1局晴れ」は定数
+# ==============================
+def precompute_clear_any_prob(p: float, rho: float, M: int, n_quad: int = 64) -> float:
+    """
+    Z_i = √ρ W + √(1-ρ) ε_i と分解すると、W を固定すれば各局は独立なので
+      P(全局曇り) = ∫ φ(w) Φ((Φ⁻¹(1-p) - √ρ w)/√(1-ρ))^M dw
+    を Gauss–Hermite 求積（n_quad 点）で評価し、1 - P(全局曇り) を返す（0 <= rho < 1）。
+    """
+    if M == 0 or p <= 0.0:
+        return 0.0
+    if p >= 1.0:
+        return 1.0
+    nodes, weights = hermegauss(n_quad)   # ∫ f(w) e^{-w²/2} dw ≈ Σ weights * f(nodes)
+    t = NormalDist().inv_cdf(1.0 - p)
+    dry = norm_cdf((t - math.sqrt(rho) * nodes) / math.sqrt(1.0 - rho)) ** M
+    return float(1.0 - np.sum(weights * dry) / math.sqrt(2.0 * math.pi))
+
+def clear_any_mask(L, P, rho: float, rng: np.random.Generator, shape) -> np.ndarray:
+    """「少なくとも1局晴れ」の bool 配列。全局同じ p かつ 0 <= rho < 1 なら定数確率のベルヌーイで済ませる。"""
+    if P.size > 0 and np.all(P == P[0]) and 0.0 <= rho < 1.0:
+        return rng.random(shape) < precompute_clear_any_prob(float(P[0]), rho, P.size)
+    return at_least_one_clear_batch(L, P, rng, shape)
 
 # ==============================
 #  CHSHゲート（教育用の簡易近似）
 # ==============================
-def chsh_pass_once(qber: float, n_pairs: int, rng: np.random.Generator) -> bool:
+def chsh_pass_prob(qber: float, n_pairs: int) -> float:
     """
-    期待値 S ≈ 2√2 * (1 - 2Q)、閾値 2、分散 ~ 1/√N とした粗い正規近似で合否を決定。
+    期待値 S ≈ 2√2 * (1 - 2Q)、閾値 2、分散 ~ 1/√N とした粗い正規近似での合格確率。
+    qber と n_pairs が決まれば定数なので、呼び出し側で1回だけ計算してベルヌーイ試行に使う。
     """
     if n_pairs <= 0:
-        return False
+        return 0.0
     S_thr = 2.0
     S_exp = 2.0 * np.sqrt(2.0) * max(0.0, (1.0 - 2.0 * qber))
     z = (S_exp - S_thr) * np.sqrt(float(n_pairs))  # 標準化
-    p_pass = float(np.clip(norm_cdf(z), 0.0, 1.0))
-    return bool(rng.random() < p_pass)
+    return float(np.clip(norm_cdf(z), 0.0, 1.0))
 
 # ==============================
 #  パラメータ
@@ -86,47 +144,48 @@ PASSES_PER_DAY     = 4
 PASS_TIME_SEC      = 600
 PASS_DUTY          = (PASSES_PER_DAY * PASS_TIME_SEC) / (24 * 3600)  # 1日での稼働率
 PASS_PROB_PER_STEP = PASS_DUTY                                        # 各分で稼働している確率（ベルヌーイ近似）
+P_SAT_ANY          = 1.0 - (1.0 - PASS_PROB_PER_STEP) ** N_SAT         # N機のうち少なくとも1機が稼働する確率
 
 GROUND_P_LIST      = [0.5, 0.5, 0.5]  # 地上局の晴れ確率
 WEATHER_RHO        = 0.5              # 天候の一様相関
 
 # ==============================
-#  評価関数：ある key_fraction での「パス採用率(%)」
+#  評価関数：key_fraction ごとの「パス採用率(%)」
 # ==============================
-def evaluate_day_for_key_fraction(key_fraction: float, trials_weather: int = 2000, seed: int = 2025) -> float:
+def evaluate_key_fraction_sweep(kfs, trials_weather: int = 2000, seed: int = 2025) -> np.ndarray:
     """
-    key_fraction: 1ステップで得た衛星ビットのうち、鍵に回す割合（残りはCHSH検査用）
-    戻り値: 「衛星が稼働していたステップのうち、天候OKかつCHSH合格で“採用”できた割合」[%]
+    kfs: key_fraction の配列（1ステップで得た衛星ビットのうち、鍵に回す割合。残りはCHSH検査用）
+    戻り値: kf ごとの「衛星が稼働していたステップのうち、天候OKかつCHSH合格で“採用”できた割合」[%]
+    掃引全体（len(kfs) × trials_weather）を1回の乱数生成でまとめて評価する。
     """
+    kfs = np.asarray(kfs, dtype=float)
     rng = np.random.default_rng(seed)
+    L, P = _prepare_weather(GROUND_P_LIST, WEATHER_RHO)
+    shape = (kfs.size, trials_weather)
+
+    # 衛星生産ビット（1分ぶん）と CHSH 合格確率は key_fraction だけで決まる
+    total_sat_bits = int(SAT_BPS * DT_SEC)
+    key_bits_base  = (total_sat_bits * kfs).astype(np.int64)
+    test_bits      = total_sat_bits - key_bits_base
+    # CHSH（教育用簡易近似）— テストビット ≒ ペア数として扱う
+    p_pass = np.array([chsh_pass_prob(SAT_QBER, n_pairs=int(n)) for n in test_bits])
+
+    # 一様乱数は衛星 1 列 + CHSH 1 列を1回で引いて切り分ける
+    U = rng.random((*shape, 2))
+    # 衛星：N機のうち少なくとも1機が稼働（確率 P_SAT_ANY の1回のベルヌーイ）
+    sat_any    = U[..., 0] < P_SAT_ANY
+    # CHSH 合否（テストビットが無ければ不合格）
+    chsh_ok    = (U[..., 1] < p_pass[:, None]) & (test_bits > 0)[:, None]
+    # 天候：少なくとも1局が晴れ
+    weather_ok = clear_any_mask(L, P, WEATHER_RHO, rng, shape)
+
+    adopted  = (sat_any & weather_ok & chsh_ok & (key_bits_base > 0)[:, None]).sum(axis=-1)
+    possible = sat_any.sum(axis=-1)
+    return 100.0 * adopted / np.maximum(possible, 1)
 
-    adopted = 0      # 採用できたステップ数（天候OK & CHSH合格）
-    possible = 0     # 衛星が「稼働」していたステップ数
-
-    for _ in range(trials_weather):
-        # 衛星：N機のうち少なくとも1機が稼働
-        active_any_sat = np.any(rng.random(N_SAT) < PASS_PROB_PER_STEP)
-        if not active_any_sat:
-            continue
-        possible += 1
-
-        # 天候：少なくとも1局が晴れ
-        weather_ok = at_least_one_clear_once(GROUND_P_LIST, WEATHER_RHO, rng)
-        if not weather_ok:
-            continue
-
-        # 衛星生産ビット（1分ぶん）
-        total_sat_bits = int(SAT_BPS * DT_SEC)
-        key_bits_base  = int(total_sat_bits * key_fraction)
-        test_bits      = total_sat_bits - key_bits_base
-
-        # CHSH（教育用簡易近似）— テストビット ≒ ペア数として扱う
-        chsh_ok = chsh_pass_once(SAT_QBER, n_pairs=test_bits, rng=rng)
-
-        if chsh_ok and key_bits_base > 0:
-            adopted += 1
-
-    return 100.0 * (adopted / possible) if possible else 0.0
+def evaluate_day_for_key_fraction(key_fraction: float, trials_weather: int = 2000, seed: int = 2025) -> float:
+    """1点だけ評価する版（evaluate_key_fraction_sweep の薄いラッパ）"""
+    return float(evaluate_key_fraction_sweep([key_fraction], trials_weather, seed)[0])
 
 # ==============================
 #  メイン：key_fraction を掃引して可視化
@@ -135,14 +194,15 @@ def main():
     # 掃引レンジ（例：0.05〜0.95）
     kfs = np.linspace(0.05, 0.95, 19)
 
-    adm = []  # adoption rate [%]
-    for i, kf in enumerate(kfs):
-        # シードをずらして安定化
-        adm.append(evaluate_day_for_key_fraction(float(kf), trials_weather=4000, seed=2025 + i))
+    adm = evaluate_key_fraction_sweep(kfs, trials_weather=4000, seed=2025)  # adoption rate [%]
 
     # ===== グラフ：合格率 vs key_fraction =====
+    # matplotlib は描画するときだけ読み込む
+    import matplotlib.pyplot as plt
+    # ===== 日本語フォント（Mac）=====
+    plt.rcParams["font.family"] = "Hiragino Sans"   # Windowsなら "Meiryo" など
     plt.figure(figsize=(7, 5))
-    plt.plot(kfs, np.array(adm), marker="o")
+    plt.plot(kfs, adm, marker="o")
     plt.xlabel("鍵生成に回す割合（key_fraction）")
     plt.ylabel("パス採用率 [%]（天候 & CHSH）")
     plt.title("パス採用率 vs 鍵生成割合")
@@ -34,9 +34,10 @@ z_score = 2.58  # 99%
 
 # θ差から「同一結果の確率」を与える（理想EPRの偏光モデル）
 # P(same) = 0.5*(1 + cos(2Δθ))。ノイズは同/異をランダム反転。
+# N, theta_a, theta_b は配列でもOK（ブロードキャストして1回の binomial で引く）
 def sample_same_diff(N, theta_a, theta_b, rng):
-    delta = theta_a - theta_b
-    p_same_ideal = 0.5*(1 + math.cos(2*delta))
+    delta = np.asarray(theta_a) - np.asarray(theta_b)
+    p_same_ideal = 0.5*(1 + np.cos(2*delta))
     # ノイズでフリップ
     # 実効 p_same = (1 - flip_noise)*p_same_ideal + flip_noise*(1 - p_same_ideal)
     p_same = (1 - flip_noise)*p_same_ideal + flip_noise*(1 - p_same_ideal)
@@ -44,62 +45,46 @@ def sample_same_diff(N, theta_a, theta_b, rng):
     n_diff = N - n_same
     return n_same, n_diff
 
-# E と 分散近似（±1 変数の平均）
+# E と 分散近似（±1 変数の平均、配列対応。N=0 は nan）
 def est_E_and_var(n_same, n_diff):
-    N = n_same + n_diff
-    if N == 0:
-        return np.nan, np.nan
-    E_hat = (n_same - n_diff) / N
-    var = (1 - E_hat**2) / max(N, 1)  # ガウス近似
+    N = np.asarray(n_same + n_diff, dtype=float)
+    N_safe = np.maximum(N, 1)
+    E_hat = np.where(N > 0, (n_same - n_diff) / N_safe, np.nan)
+    var = (1 - E_hat**2) / N_safe  # ガウス近似
     return E_hat, var
 
-# CHSH をテスト分割で推定
+# 4組 (a0,b0),(a0,b1),(a1,b0),(a1,b1) の角度
+SETTINGS_A = np.array([a0, a0, a1, a1])
+SETTINGS_B = np.array([b0, b1, b0, b1])
+
+# CHSH をテスト分割で推定（n_test は配列でもOK → 掃引全体を1回で推定）
 def chsh_test(n_test, rng):
-    # 4組 (a0,b0),(a0,b1),(a1,b0),(a1,b1) をほぼ均等に割る
-    N_each = [n_test//4]*4
-    for i in range(n_test % 4):
-        N_each[i] += 1
-
-    settings = [(a0,b0), (a0,b1), (a1,b0), (a1,b1)]
-    Es = []
-    Vars = []
-    for N, (ta, tb) in zip(N_each, settings):
-        n_same, n_diff = sample_same_diff(N, ta, tb, rng)
-        E_hat, var = est_E_and_var(n_same, n_diff)
-        Es.append(E_hat)
-        Vars.append(var)
+    # 4組にほぼ均等に割る（余りは先頭から1つずつ）
+    n_test = np.asarray(n_test)[..., None]
+    N_each = n_test//4 + (np.arange(4) < n_test % 4)
+
+    n_same, n_diff = sample_same_diff(N_each, SETTINGS_A, SETTINGS_B, rng)
+    Es, Vars = est_E_and_var(n_same, n_diff)
 
     # CHSH S = E00 + E01 + E10 - E11
-    S_hat = Es[0] + Es[1] + Es[2] - Es[3]
-    var_S = Vars[0] + Vars[1] + Vars[2] + Vars[3]  # 相関の和の分散（独立近似）
-    S_LB = S_hat - z_score*math.sqrt(max(var_S, 0.0))
+    S_hat = Es[..., 0] + Es[..., 1] + Es[..., 2] - Es[..., 3]
+    var_S = Vars.sum(axis=-1)  # 相関の和の分散（独立近似）
+    S_LB = S_hat - z_score*np.sqrt(np.maximum(var_S, 0.0))
     return S_hat, S_LB
 
 # 教育用の鍵効率（0〜1）: S_LB<=2 なら 0、超えれば (S_LB-2)/(S_max-2) に比例
 def secure_key_efficiency_frac(key_fraction, S_LB):
-    if np.isnan(S_LB) or S_LB <= 2.0:
-        return 0.0
-    strength = (S_LB - 2.0) / (S_max - 2.0)
-    strength = float(np.clip(strength, 0.0, 1.0))
-    return key_fraction * strength
+    strength = np.clip((S_LB - 2.0) / (S_max - 2.0), 0.0, 1.0)
+    ok = ~np.isnan(S_LB) & (S_LB > 2.0)
+    return np.where(ok, key_fraction * strength, 0.0)
 
 # 走査
 fractions = np.linspace(0.20, 0.80, 17)  # 0.20, 0.23, ..., 0.80
-raw_eff = []
-S_vals = []
-S_LBs = []
-for f in fractions:
-    n_key  = int(round(N_pairs * f))
-    n_test = max(0, N_pairs - n_key)
-
-    S_hat, S_LB = chsh_test(n_test, rng)
-    e = secure_key_efficiency_frac(f, S_LB)
-
-    raw_eff.append(e)
-    S_vals.append(S_hat)
-    S_LBs.append(S_LB)
+n_key  = np.rint(N_pairs * fractions).astype(int)
+n_test = np.maximum(0, N_pairs - n_key)
 
-raw_eff = np.array(raw_eff, dtype=float)
+S_vals, S_LBs = chsh_test(n_test, rng)
+raw_eff = secure_key_efficiency_frac(fractions, S_LBs)
 
 # 相対化（最大を100%）
 if raw_eff.max() > 0:
@@ -117,9 +102,9 @@ def evaluate_at(f_target):
     n_key  = int(round(N_pairs * f_target))
     n_test = max(0, N_pairs - n_key)
     S_hat, S_LB = chsh_test(n_test, rng)
-    e = secure_key_efficiency_frac(f_target, S_LB)
+    e = float(secure_key_efficiency_frac(f_target, S_LB))
     rel = 100.0 * e / (raw_eff.max() if raw_eff.max() > 0 else 1.0)
-    return S_hat, S_LB, e, rel
+    return float(S_hat), float(S_LB), e, rel
 
 S30, SLB30, e30, rel30 = evaluate_at(0.30)
 S65, SLB65, e65, rel65 = evaluate_at(0.65)
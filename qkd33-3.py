@@ -2,11 +2,16 @@
 # 同一条件で「絶対効率（段階33）」と「相対効率（段階33-2）」を同時表示する教育用コード
 # Author: ChatGPT（教育用モデル）
 
+import os
 import numpy as np
 import math
+import matplotlib
+
+# HEADLESS=1 なら画面を使わず Agg で描いて PNG に保存する（CI・サーバ向け）
+HEADLESS = bool(os.environ.get("HEADLESS"))
+if HEADLESS:
+    matplotlib.use("Agg")
 import matplotlib.pyplot as plt
-from qiskit import QuantumCircuit, transpile
-from qiskit_aer import AerSimulator
 
 # =========================
 # 表示用（日本語フォント）
@@ -21,7 +26,6 @@ plt.rcParams['axes.unicode_minus'] = False
 # 教育モデルのパラメータ（同一条件で固定）
 # =========================
 SEED = 42
-rng = np.random.default_rng(SEED)
 
 N_PAIRS = 6000        # 総EPRペア数（テスト＋鍵）
 NOISE_P_FLIP = 0.0    # 量子ビット反転ノイズ（教育用：0〜0.05くらいで試せる）
@@ -50,38 +54,13 @@ def h2(p):
         return 0.0
     return -p*math.log2(p) - (1-p)*math.log2(1-p)
 
-# 1回のEPR測定（教育用：Y軸周り回転→Z測定、簡易ノイズ付き）
-sim = AerSimulator()
-
-def epr_once(theta_a: float, theta_b: float, p_flip: float = 0.0) -> tuple[int, int]:
-    qc = QuantumCircuit(2, 2)
-    # |Φ+> を生成
-    qc.h(0)
-    qc.cx(0, 1)
-    # 測定基底回転
-    if theta_a != 0.0:
-        qc.ry(-2*theta_a, 0)
-    if theta_b != 0.0:
-        qc.ry(-2*theta_b, 1)
-    # （教育用）古典側でビットフリップ雑音を近似注入
-    # 実機ではチャンネル/ゲートノイズで表すが、ここでは簡便のため測定後に反転
-    qc.measure(0, 0)
-    qc.measure(1, 1)
-
-    tqc = transpile(qc, sim, optimization_level=0)
-    result = sim.run(tqc, shots=1, memory=True).result()
-    mem = result.get_memory()[0]  # 'ab' where a=q0, b=q1
-    a = int(mem[0])
-    b = int(mem[1])
-
-    # 簡略ノイズ：独立なビット反転
-    if p_flip > 0.0:
-        if rng.random() < p_flip:
-            a ^= 1
-        if rng.random() < p_flip:
-            b ^= 1
-
-    return a, b
+# EPR測定の解析的サンプラ（教育用：Y軸周り回転→Z測定、簡易ノイズ付き）
+# |Φ+> を角度 θa, θb で測ると P(a=b) = 0.5*(1 + cos(2(θa-θb)))、周辺分布は一様。
+# a, b それぞれ独立に確率 p_flip で反転すると「一致/不一致」は 2p(1-p) で入れ替わる。
+def p_same(theta_a: float, theta_b: float, p_flip: float = 0.0) -> float:
+    p_ideal = 0.5*(1 + math.cos(2*(theta_a - theta_b)))
+    q = 2*p_flip*(1 - p_flip)
+    return (1 - q)*p_ideal + q*(1 - p_ideal)
 
 # CHSH用バケット
 def corr_bucket():
@@ -102,8 +81,8 @@ def compute_absolute_efficiency(N_pairs, key_len, qber, S):
     privacy = max(0.0, 1.0 - h2(qber))  # 0〜1
     return 100.0 * frac_key * conf * privacy  # [%]
 
-# 指定 key_fraction で1回の実験（同一条件）
-def run_once(key_fraction: float):
+# 指定 key_fraction で1回の実験（同一条件、乱数は呼び出し側の rng を使う）
+def run_once(key_fraction: float, rng: np.random.Generator):
     bucket_map = {
         0: (a0, b0),
         1: (a0, b1),
@@ -116,25 +95,19 @@ def run_once(key_fraction: float):
     b_a1b1 = corr_bucket()
     buckets = [b_a0b0, b_a0b1, b_a1b0, b_a1b1]
 
-    key_a = []
-    key_b = []
-
-    for _ in range(N_PAIRS):
-        is_key = (rng.random() < key_fraction)
-        if is_key:
-            a_bit, b_bit = epr_once(theta_key_a, theta_key_b, NOISE_P_FLIP)
-            key_a.append(a_bit)
-            key_b.append(b_bit)
-        else:
-            idx = rng.integers(0, 4)
-            th_a, th_b = bucket_map[idx]
-            a_bit, b_bit = epr_once(th_a, th_b, NOISE_P_FLIP)
-            ba = buckets[idx]
-            if   a_bit == 0 and b_bit == 0: ba["n00"] += 1
-            elif a_bit == 0 and b_bit == 1: ba["n01"] += 1
-            elif a_bit == 1 and b_bit == 0: ba["n10"] += 1
-            else:                           ba["n11"] += 1
-            ba["N"] += 1
+    # 各ペアは確率 key_fraction で鍵、残りは 4 設定に等確率で振り分け
+    key_len = int(rng.binomial(N_PAIRS, key_fraction))
+    N_each = rng.multinomial(N_PAIRS - key_len, [0.25]*4)
+    for idx, ba in enumerate(buckets):
+        th_a, th_b = bucket_map[idx]
+        N = int(N_each[idx])
+        n_same = int(rng.binomial(N, p_same(th_a, th_b, NOISE_P_FLIP)))
+        # 一致は 00/11、不一致は 01/10 に等分（周辺一様）
+        ba["n00"] = int(rng.binomial(n_same, 0.5))
+        ba["n11"] = n_same - ba["n00"]
+        ba["n01"] = int(rng.binomial(N - n_same, 0.5))
+        ba["n10"] = N - n_same - ba["n01"]
+        ba["N"] = N
 
     # CHSH 点推定
     E_a0b0 = E_from_bucket(b_a0b0)
@@ -143,11 +116,9 @@ def run_once(key_fraction: float):
     E_a1b1 = E_from_bucket(b_a1b1)
     S = E_a0b0 + E_a0b1 + E_a1b0 - E_a1b1
 
-    key_a = np.array(key_a, dtype=int)
-    key_b = np.array(key_b, dtype=int)
-    key_len = len(key_a)
     if key_len > 0:
-        qber = 1.0 - np.mean(key_a == key_b)  # 誤り率
+        n_match = rng.binomial(key_len, p_same(theta_key_a, theta_key_b, NOISE_P_FLIP))
+        qber = 1.0 - n_match / key_len  # 誤り率
     else:
         qber = 0.5
 
@@ -165,18 +136,13 @@ def run_once(key_fraction: float):
 def main():
     # 同一条件で key_fraction を同じ列で評価
     key_fracs = np.linspace(0.2, 0.8, 13)  # 0.2〜0.8 を 0.05刻みに近い間隔で
-    results = []
-    # 乱数の再現性のため、各fごとにサブseedを派生
-    for i, f in enumerate(key_fracs):
-        # サブシード固定（同一性の担保）
-        global rng
-        rng = np.random.default_rng(SEED + i*1000)
-        r = run_once(f)
-        r["f"] = f
-        results.append(r)
-
-    f_list = np.array([r["f"] for r in results])
-    abs_eff = np.array([r["abs_eff"] for r in results])  # 段階33：絶対効率 [%]
+    # 乱数の再現性のため、SeedSequence から各fごとに独立な子ストリームを派生
+    children = np.random.SeedSequence(SEED).spawn(len(key_fracs))
+    rngs = [np.random.Generator(np.random.PCG64(c)) for c in children]
+    f_list = key_fracs
+    abs_eff = np.empty(len(key_fracs))  # 段階33：絶対効率 [%]
+    for i, (f, rng) in enumerate(zip(key_fracs, rngs)):
+        abs_eff[i] = run_once(f, rng)["abs_eff"]
 
     # 段階33-2：相対効率（同じ配列を最大値で正規化して100%表示）
     max_abs = abs_eff.max() if abs_eff.size > 0 else 1.0
@@ -192,8 +158,10 @@ def main():
     mark_f1 = 0.30
     mark_f2 = 0.65
     def interp(xarr, yarr, x):
-        # 簡易補間（最も近い点）
-        j = np.argmin(np.abs(xarr - x))
+        # 簡易補間（最も近い点）：xarr は昇順なので二分探索で求める
+        j = min(int(np.searchsorted(xarr, x)), len(xarr) - 1)
+        if j > 0 and abs(xarr[j - 1] - x) <= abs(xarr[j] - x):
+            j -= 1  # 同距離なら左側（argmin と同じ選び方）
         return yarr[j], xarr[j]  # y, 実際に使われたf
 
     abs_m1, f1 = interp(f_list, abs_eff, mark_f1)
@@ -202,11 +170,13 @@ def main():
     rel_m2, _ = interp(f_list, rel_eff, mark_f2)
 
     # ========= 図の作成（同時表示：左=絶対効率, 右=相対効率） =========
+    # 点が多いときはマーカーを省く（描画を軽く）
+    mk = 'o' if len(f_list) <= 100 else None
     fig, axes = plt.subplots(1, 2, figsize=(13, 5), dpi=120)
     ax1, ax2 = axes
 
     # --- 左：段階33（絶対効率） ---
-    ax1.plot(f_list, abs_eff, marker='o')
+    ax1.plot(f_list, abs_eff, marker=mk)
     ax1.set_title("段階33：安全に残せる鍵効率（絶対値, 教育用モデル）")
     ax1.set_xlabel("鍵に回す割合 (key_fraction)")
     ax1.set_ylabel("安全に残せる鍵効率（%）")
@@ -227,7 +197,7 @@ def main():
                  (f2, abs_m2), textcoords="offset points", xytext=(8, -18))
 
     # --- 右：段階33-2（相対効率） ---
-    ax2.plot(f_list, rel_eff, marker='o')
+    ax2.plot(f_list, rel_eff, marker=mk)
     ax2.set_title("段階33-2：安全に残せる鍵効率（相対, ベスト=100%）")
     ax2.set_xlabel("鍵に回す割合 (key_fraction)")
     ax2.set_ylabel("相対効率（%）")
@@ -246,7 +216,11 @@ def main():
 
     plt.suptitle("同一条件での比較：段階33（絶対）と 段階33-2（相対）", y=1.02, fontsize=12)
     plt.tight_layout()
-    plt.show()
+    if HEADLESS:
+        fig.savefig("stage33.png", dpi=100, bbox_inches="tight")
+        plt.close(fig)
+    else:
+        plt.show()
 
     # 参考出力
     print("=== 実験条件（共通） ===")
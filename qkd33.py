@@ -2,12 +2,13 @@
 # 依存: numpy, matplotlib
 # 実行: python qkd32_jp.py
 
-import math
+import sys
 import numpy as np
 
 # ====== 日本語フォント設定（環境にあるものを順に試す）======
 import matplotlib
 import matplotlib.pyplot as plt
+from matplotlib import font_manager
 
 def set_japanese_font():
     candidates = [
@@ -19,16 +20,12 @@ def set_japanese_font():
         "Noto Sans JP",
         "TakaoGothic"
     ]
+    # 図を作って試すのではなく、フォント一覧に入っているかを直接調べる
+    available = {f.name for f in font_manager.fontManager.ttflist}
     for name in candidates:
-        try:
+        if name in available:
             matplotlib.rcParams["font.family"] = name
-            # テスト描画でエラーが出なければ採用
-            fig = plt.figure()
-            plt.title("日本語フォントテスト")
-            plt.close(fig)
             return name
-        except Exception:
-            continue
     return matplotlib.rcParams.get("font.family", ["sans-serif"])[0]
 
 FONT_USED = set_japanese_font()
@@ -41,58 +38,53 @@ PAIRS_PER_DAY = 20000
 # 値を変えると全体のレベルが上下します（0.0〜1.0）
 P_CLEAR_AVG = 0.75  # 75% くらいに設定（段階32のグラフの雰囲気に近づけるため）
 
-def chsh_pass_prob(n_samples: int) -> float:
+def chsh_pass_prob(n_samples):
     """
     CHSHの検定に使えるサンプル数 n_samples に応じた合格確率（教育用モデル）
     ・サンプルが少ないと通りにくい
     ・増えるほど通りやすくなる（S字）
+    n_samples はスカラーでも配列でもOK（配列なら np.exp 1回で全要素）
     """
-    if n_samples <= 0:
-        return 0.0
+    n = np.asarray(n_samples, dtype=float)
     # ロジスティック曲線で 3000 サンプル付近からグッと上がる感じ
     x0 = 3000.0   # 立ち上がり中心
     k  = 1/800.0  # 立ち上がりの急さ
-    p  = 1.0 / (1.0 + math.exp(-(n_samples - x0) * k))
+    p  = 1.0 / (1.0 + np.exp(-(n - x0) * k))
     # 上限は 99% 程度に制限（理想でも完全ではない前提）
-    return min(0.99, max(0.0, p))
+    p = np.where(n <= 0, 0.0, np.clip(p, 0.0, 0.99))
+    return float(p) if p.ndim == 0 else p
 
-def pass_rate_for_key_fraction(key_fraction: float) -> float:
+def pass_rate_for_key_fraction(key_fraction):
     """
     鍵に回す割合 key_fraction（0〜1）から、その日のパス採用率（0〜1）を返す。
     ・テスト割合 test_frac = 1 - key_fraction
     ・CHSHは test に回したサンプル数が多いほど通りやすい
     ・天候は平均値 P_CLEAR_AVG を掛け合わせる（独立仮定）
+    key_fraction は配列でもOK（掃引全体を1回で評価）
     """
-    key_fraction = max(0.0, min(1.0, key_fraction))
+    key_fraction = np.clip(key_fraction, 0.0, 1.0)
     test_frac = 1.0 - key_fraction
-    n_chsh = int(PAIRS_PER_DAY * test_frac)
+    n_chsh = np.asarray(PAIRS_PER_DAY * test_frac).astype(np.int64)
     p_chsh = chsh_pass_prob(n_chsh)
     p_pass = P_CLEAR_AVG * p_chsh
     return p_pass
 
-def expected_final_key_bits_per_day(key_fraction: float) -> int:
+def expected_final_key_bits_per_day(key_fraction):
     """
     期待できる最終鍵ビット数（雑に：パス採用率 × 鍵に回したビット数）
     ※段階32は“採用率”が主題なので、参考出力として用意
+    key_fraction は配列でもOK
     """
-    test_frac = 1.0 - key_fraction
-    n_keep = int(PAIRS_PER_DAY * key_fraction)
-    return int(n_keep * pass_rate_for_key_fraction(key_fraction))
+    n_keep = (PAIRS_PER_DAY * np.asarray(key_fraction)).astype(np.int64)
+    keys = (n_keep * pass_rate_for_key_fraction(key_fraction)).astype(np.int64)
+    return int(keys) if keys.ndim == 0 else keys
 
 # ====== 掃引してプロット ======
 def main():
     # 掃引用の鍵割合（0.30〜0.80）
     xs = np.round(np.linspace(0.30, 0.80, 21), 3)
-    ys = []
-    keys = []
-
-    for kf in xs:
-        p = pass_rate_for_key_fraction(kf)
-        ys.append(100.0 * p)  # %
-        keys.append(expected_final_key_bits_per_day(kf))
-
-    ys = np.array(ys)
-    keys = np.array(keys)
+    ys = 100.0 * pass_rate_for_key_fraction(xs)   # %
+    keys = expected_final_key_bits_per_day(xs)
 
     # 最良点（採用率最大→同率なら最終鍵ビットが最大）
     best_idx = int(np.argmax(np.stack([ys, keys], axis=1)[:,0]))
@@ -125,10 +117,12 @@ def main():
     plt.show()
 
     # ---- 表形式の概要出力 ----
-    print("\n=== 掃引結果（抜粋）===")
-    print(" key_fraction | pass_rate(%) | expected_key(bit/day)")
-    for i in range(0, len(xs), 2):
-        print(f"   {xs[i]:.2f}      |   {ys[i]:6.2f}    |   {keys[i]:>8,d}")
+    # 行をまとめて組み立て、1回の write で出力する
+    lines = ["\n=== 掃引結果（抜粋）===",
+             " key_fraction | pass_rate(%) | expected_key(bit/day)"]
+    lines += [f"   {x:.2f}      |   {y:6.2f}    |   {k:>8,d}"
+              for x, y, k in zip(xs[::2], ys[::2], keys[::2])]
+    sys.stdout.write("\n".join(lines) + "\n")
 
     print("\n[推奨（教育用）]")
     print(f"  ・key_fraction = {best_kf:.2f}")
@@ -4,10 +4,7 @@
 import math
 import numpy as np
 import matplotlib.pyplot as plt
-from qiskit import QuantumCircuit, transpile
-from qiskit_aer import AerSimulator
-from scipy.stats import beta
-import hashlib, secrets
+import secrets
 
 # 日本語フォント設定（Mac用）
 try:
@@ -20,40 +17,44 @@ plt.rcParams['axes.unicode_minus'] = False
 SEED = 42
 rng = np.random.default_rng(SEED)
 
-# ----------------------------
-# 天候モデル（簡易）
-# ----------------------------
-def at_least_one_clear_once(station_p_list, rho, rng):
-    """ステーション群のうち1つでも晴れるかを判定"""
-    u = rng.random()
-    # 相関をrhoで導入（0=独立,1=完全相関）
-    if u < rho:
-        # 全ステーション同じ天候
-        return rng.random() < np.mean(station_p_list)
-    else:
-        # 独立判定
-        return any(rng.random() < p for p in station_p_list)
+# 天候モデル（モジュール定数：呼び出しごとに作り直さない）
+STATION_P = np.array([0.5, 0.6, 0.7])   # 仮の晴天確率
+STATION_MEAN = float(STATION_P.mean())
+RHO = 0.2                               # 天候相関
 
 # ----------------------------
 # 1日の評価
 # ----------------------------
 def evaluate_day_for_key_fraction(kf, trials_weather=1000, seed=123):
+    """kf は配列でもOK（同じ天候サンプルで全 kf を一度に評価し、配列で返す）"""
     rng = np.random.default_rng(seed)
     # 鍵生成割合kfでCHSH検査に回す残りを評価
-    station_p_list = [0.5, 0.6, 0.7]   # 仮の晴天確率
-    rho = 0.2                          # 天候相関
-    count_ok = 0
-    for _ in range(trials_weather):
-        weather_ok = at_least_one_clear_once(station_p_list, rho, rng)
-        if weather_ok:
-            # 簡単なCHSH成功判定（乱数ベース）
-            if rng.random() < (1 - kf):  
-                count_ok += 1
-    return count_ok / trials_weather
+    # 全試行ぶんの乱数を1回で引いて列を切り分ける：[相関判定, 共通天候, 各局..., CHSH]
+    u = rng.random((trials_weather, 3 + STATION_P.size))
+    u_corr, u_same, u_ind, u_chsh = u[:, 0], u[:, 1], u[:, 2:-1], u[:, -1]
+
+    # 天候：相関をrhoで導入（0=独立,1=完全相関）
+    corr_mask = u_corr < RHO                      # 全ステーション同じ天候
+    same = u_same < STATION_MEAN
+    any_ind = (u_ind < STATION_P).any(axis=1)     # 独立判定
+    weather_ok = np.where(corr_mask, same, any_ind)
+
+    # 簡単なCHSH成功判定（乱数ベース）：列方向に kf を並べて一括判定
+    kf_arr = np.asarray(kf, dtype=float)
+    chsh = u_chsh[:, None] < (1 - np.atleast_1d(kf_arr))
+    rate = np.count_nonzero(weather_ok[:, None] & chsh, axis=0) / trials_weather
+    return float(rate[0]) if kf_arr.ndim == 0 else rate
 
 # ----------------------------
 # OTP暗号化デモ
 # ----------------------------
+def xor_otp(msg_bytes: bytes, key_bytes: bytes) -> bytes:
+    """OTP（XOR）：短い方の長さに揃え、NumPy の XOR（C ループ）で一括処理"""
+    m = min(len(msg_bytes), len(key_bytes))
+    xm = np.frombuffer(msg_bytes, dtype=np.uint8, count=m)
+    xk = np.frombuffer(key_bytes, dtype=np.uint8, count=m)
+    return (xm ^ xk).tobytes()
+
 def otp_encrypt_decrypt_demo():
     msg = "量子鍵配送の暗号化テスト🔑"
     key_len = 64
@@ -62,9 +63,8 @@ def otp_encrypt_decrypt_demo():
     if len(msg_b) > key_len:
         print("メッセージが長すぎます（今回はテスト用に64バイトまで）")
         return
-    m = min(len(msg_b), key_len)
-    cipher = bytes([msg_b[i] ^ key[i] for i in range(m)])
-    plain = bytes([cipher[i] ^ key[i] for i in range(m)])
+    cipher = xor_otp(msg_b, key)
+    plain = xor_otp(cipher, key)
     print("cipher(hex) =", cipher.hex())
     print("decrypted  =", plain.decode("utf-8", errors="ignore"))
 
@@ -75,7 +75,7 @@ def main():
     print("=== 段階34: 自動最適化サンプル ===")
 
     kfs = np.linspace(0.1, 0.95, 10)  # 鍵生成に回す割合
-    adm = [evaluate_day_for_key_fraction(kf, trials_weather=500, seed=2025) for kf in kfs]
+    adm = evaluate_day_for_key_fraction(kfs, trials_weather=500, seed=2025)
 
     # 結果表示
     for kf, val in zip(kfs, adm):
@@ -83,7 +83,7 @@ def main():
 
     # グラフ表示
     plt.figure(figsize=(7,5))
-    plt.plot(kfs, np.array(adm)*100, marker='o')
+    plt.plot(kfs, adm*100, marker='o')
     plt.xlabel("鍵生成に回す割合 (key_fraction)")
     plt.ylabel("パス採用率 [%] (天候&CHSH)")
     plt.title("パス採用率 vs 鍵生成割合")
@@ -6,8 +6,26 @@
 
 from __future__ import annotations
 import math
+from functools import lru_cache
 import numpy as np
 
+try:
+    from scipy.stats import beta as _beta
+    _HAS_SCIPY = True
+except ImportError:
+    _HAS_SCIPY = False
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        # numba が無ければ素の Python 関数として使う
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
 # ====== 設定 ======
 FAST = True            # True: NumPyだけで高速に; False: Qiskitで厳密サンプルを生成
 SHOW_PLOT = False      # True: グラフ表示（ブロッキング）; False: 何も表示しない
@@ -25,10 +43,12 @@ SAFETY_BITS   = 40           # 安全余裕（プライバシー増幅で削る
 SEED = 35
 
 # ====== ユーティリティ ======
+@njit(cache=True, fastmath=True)
 def h2(p: float) -> float:
     p = min(max(p, 1e-12), 1 - 1e-12)
     return -(p * math.log2(p) + (1 - p) * math.log2(1 - p))
 
+@njit(cache=True, fastmath=True)
 def wilson_ci(k: int, n: int, alpha: float = 0.05) -> tuple[float, float]:
     """
     Wilsonの二項信頼区間（正規近似より安定）
@@ -45,22 +65,38 @@ def wilson_ci(k: int, n: int, alpha: float = 0.05) -> tuple[float, float]:
     lo, hi = center - half, center + half
     return (max(0.0, lo), min(1.0, hi))
 
+@lru_cache(maxsize=None)
 def clopper_pearson_ci(k: int, n: int, alpha: float = 0.05) -> tuple[float, float]:
     """
     SciPy があれば Clopper-Pearson（正確区間）を使い、無ければ Wilson にフォールバック。
+    同じ (k, n, alpha) はキャッシュから返す。
     """
-    try:
-        from scipy.stats import beta
-        if n == 0:
-            return (0.0, 1.0)
-        a = k + 1
-        b = (n - k) + 1
-        lo = beta.ppf(alpha/2,      a, b) if k > 0   else 0.0
-        hi = beta.ppf(1 - alpha/2,  a, b) if k < n   else 1.0
-        return (float(lo), float(hi))
-    except Exception:
-        return wilson_ci(k, n, alpha)
+    lo, hi = clopper_pearson_batch(k, n, alpha)
+    return (float(lo), float(hi))
 
+def clopper_pearson_batch(ks, ns, alpha: float = 0.05) -> tuple[np.ndarray, np.ndarray]:
+    """
+    clopper_pearson_ci の配列版：(ks, ns) の区間をまとめて計算し (lo, hi) 配列を返す。
+    beta.ppf は下限・上限それぞれ1回ずつの ufunc 呼び出しで済む。
+    """
+    ks, ns = np.broadcast_arrays(np.asarray(ks, dtype=np.int64), np.asarray(ns, dtype=np.int64))
+    if not _HAS_SCIPY:
+        lo = np.empty(ks.shape)
+        hi = np.empty(ks.shape)
+        for idx in np.ndindex(ks.shape):
+            lo[idx], hi[idx] = wilson_ci(int(ks[idx]), int(ns[idx]), alpha)
+        return lo, hi
+    a = ks + 1
+    b = (ns - ks) + 1
+    with np.errstate(invalid="ignore"):
+        lo = np.where(ks > 0,  _beta.ppf(alpha/2,     a, b), 0.0)
+        hi = np.where(ks < ns, _beta.ppf(1 - alpha/2, a, b), 1.0)
+    empty = ns == 0
+    lo = np.where(empty, 0.0, lo)
+    hi = np.where(empty, 1.0, hi)
+    return lo, hi
+
+@njit(cache=True, fastmath=True)
 def devetak_winter_key_bits(m_key: int, qber_hat: float, leak_ec_per_bit: float, safety_bits: int) -> int:
     """
     教育用の簡易鍵長：m_key * max(0, 1 - 2 h2(Q)) - m_key * leak_EC - safety
@@ -82,33 +118,47 @@ def generate_samples_numpy(n_pairs: int, qber: float, rng: np.random.Generator)
 def generate_samples_qiskit(n_pairs: int, rng: np.random.Generator) -> tuple[np.ndarray, np.ndarray]:
     """
     EPR生成 + 測定を Qiskit でモデル化（遅いのでデモ用）。
-    transpile 一括 & run 一括で高速化。
+    回路は2種類だけなので、それぞれ1回 transpile して shots で回す。
     """
     from qiskit import QuantumCircuit, transpile
     from qiskit_aer import AerSimulator
 
     sim = AerSimulator(method="stabilizer")  # EPR/パウリ測定なら高速
-    circs = []
-    for _ in range(n_pairs):
+
+    # 回路は「誤りなし / Xフリップあり」の2種類だけ → テンプレートを2つ作って使い回す
+    def epr_template(with_error: bool) -> QuantumCircuit:
         qc = QuantumCircuit(2, 2)
         # EPR（ベル状態）
         qc.h(0); qc.cx(0, 1)
         # 誤りを確率的に入れる（Xフリップ）
-        if rng.random() < QBER_TRUE:
+        if with_error:
             qc.x(1)
         qc.measure([0, 1], [0, 1])
-        circs.append(qc)
-
-    tcircs = transpile(circs, sim, optimization_level=0)
-    res = sim.run(tcircs, shots=1).result()
-    A = np.empty(n_pairs, dtype=np.uint8)
-    B = np.empty(n_pairs, dtype=np.uint8)
-    for i in range(n_pairs):
-        c = res.get_counts(i)
-        # 例: {'00': 1} or {'11':1} など
-        bitstr = next(iter(c.keys()))
-        A[i] = int(bitstr[-1])      # qiskit の順序に合わせる（clbit index）
-        B[i] = int(bitstr[-2])
+        return qc
+
+    qc_ok, qc_err = epr_template(False), epr_template(True)
+    err_mask = rng.random(n_pairs) < QBER_TRUE
+    n_err = int(np.count_nonzero(err_mask))
+    n_ok = n_pairs - n_err
+
+    # transpile は2回だけ。各回路を shots=件数 で1ジョブずつ回し、memory で1ショットごとの結果を得る
+    tqc_ok, tqc_err = transpile([qc_ok, qc_err], sim, optimization_level=0)
+
+    def run_bits(tqc, shots: int) -> np.ndarray:
+        if shots == 0:
+            return np.empty((0, 2), dtype=np.uint8)
+        mem = sim.run(tqc, shots=shots, memory=True).result().get_memory(0)
+        # 例: ['00', '11', ...] → 連結して一括でパース
+        return (np.frombuffer("".join(mem).encode("ascii"), dtype=np.uint8)
+                .reshape(shots, 2) - ord("0"))
+
+    # mask で元の並び（ペア順）に戻す
+    arr = np.empty((n_pairs, 2), dtype=np.uint8)
+    arr[~err_mask] = run_bits(tqc_ok, n_ok)
+    arr[err_mask] = run_bits(tqc_err, n_err)
+    # qiskit の順序に合わせる（文字列の右端が clbit 0）
+    A = arr[:, 1].copy()
+    B = arr[:, 0].copy()
     return A, B
 
 # ====== メイン ======
@@ -5,8 +5,20 @@ from __future__ import annotations
 import math
 import numpy as np
 
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        # numba が無ければ素の Python 関数として使う
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
 
 # ========= ユーティリティ =========
+@njit(cache=True, fastmath=True)
 def h2(x: float) -> float:
     """2進エントロピー h2(x) = -x log2 x - (1-x) log2 (1-x)"""
     if x <= 0.0 or x >= 1.0:
@@ -14,6 +26,14 @@ def h2(x: float) -> float:
     return -(x * math.log2(x) + (1 - x) * math.log2(1 - x))
 
 
+@njit(cache=True, fastmath=True)
+def _z_for_alpha(alpha: float) -> float:
+    # だいたいの近似：alpha=1e-3 → z≈3.29（99.9%）
+    # alphaを変えてもOKなように逆誤差関数近似（ここでは固定でも十分）
+    return 3.29 if abs(alpha - 1e-3) < 1e-12 else 2.58  # 1e-3か、それ以外は99%相当
+
+
+@njit(cache=True, fastmath=True)
 def wilson_interval(k: int, n: int, alpha: float = 1e-3) -> tuple[float, float]:
     """
     Wilson近似で二項比率の信頼区間 [lo, hi] を返す（教育用）。
@@ -23,10 +43,7 @@ def wilson_interval(k: int, n: int, alpha: float = 1e-3) -> tuple[float, float]:
         return (0.0, 1.0)
     p = k / n
     # 正規近似のz（両側）
-    from math import sqrt
-    # だいたいの近似：alpha=1e-3 → z≈3.29（99.9%）
-    # alphaを変えてもOKなように逆誤差関数近似（ここでは固定でも十分）
-    z = 3.29 if abs(alpha - 1e-3) < 1e-12 else 2.58  # 1e-3か、それ以外は99%相当
+    z = _z_for_alpha(alpha)
     denom = 1 + z * z / n
     center = (p + z * z / (2 * n)) / denom
     half = (z * math.sqrt(p * (1 - p) / n + z * z / (4 * n * n))) / denom
@@ -35,6 +52,22 @@ def wilson_interval(k: int, n: int, alpha: float = 1e-3) -> tuple[float, float]:
     return (lo, hi)
 
 
+def wilson_interval_vec(k, n, alpha: float = 1e-3) -> tuple[np.ndarray, np.ndarray]:
+    """wilson_interval の配列版（k, n は同じ形の配列。n<=0 の要素は [0, 1]）"""
+    k = np.asarray(k, dtype=float)
+    n = np.asarray(n, dtype=float)
+    n_safe = np.maximum(n, 1.0)
+    z = _z_for_alpha(alpha)
+    p = k / n_safe
+    denom = 1 + z * z / n_safe
+    center = (p + z * z / (2 * n_safe)) / denom
+    half = (z * np.sqrt(p * (1 - p) / n_safe + z * z / (4 * n_safe * n_safe))) / denom
+    lo = np.where(n > 0, np.maximum(0.0, center - half), 0.0)
+    hi = np.where(n > 0, np.minimum(1.0, center + half), 1.0)
+    return lo, hi
+
+
+@njit(cache=True, fastmath=True)
 def chsh_min_entropy_term(S_LB: float) -> float:
     """
     Acín系の下限（教育用簡略版）: 量子相関の項 h2( (1+sqrt((S/2)^2-1))/2 )
@@ -50,10 +83,8 @@ def chsh_min_entropy_term(S_LB: float) -> float:
 def bits_to_bytes(bits: np.ndarray) -> tuple[bytes, int]:
     bits = np.asarray(bits, dtype=np.uint8)
     pad = (-len(bits)) % 8
-    if pad:
-        bits = np.concatenate([bits, np.zeros(pad, dtype=np.uint8)])
-    by = np.packbits(bits)
-    return bytes(by.tolist()), pad
+    # packbits は末尾を 0 で埋めてくれるので連結は不要
+    return np.packbits(bits).tobytes(), pad
 
 
 def utf8_truncate(s: str, max_bytes: int) -> tuple[str, bytes]:
@@ -69,8 +100,11 @@ def utf8_truncate(s: str, max_bytes: int) -> tuple[str, bytes]:
 
 
 def xor_bytes(a: bytes, b: bytes) -> bytes:
+    # 1バイトずつの Python ループではなく NumPy の XOR（C ループ）で一括
     m = min(len(a), len(b))
-    return bytes([a[i] ^ b[i] for i in range(m)])
+    xa = np.frombuffer(a, dtype=np.uint8, count=m)
+    xb = np.frombuffer(b, dtype=np.uint8, count=m)
+    return np.bitwise_xor(xa, xb).tobytes()
 
 
 # ========= 物理モデル（高速・教育用） =========
@@ -88,28 +122,31 @@ def simulate_e91_samples(
       → 不一致確率 p_ij=(1-Eij)/2 からビット一致/不一致を生成
     - 鍵用: 同一基底の対で、誤り率 qber_true のビット不一致を生成
     """
+    n_key, n_test, counts = _split_pairs(N_total, key_fraction)
+    return _draw_e91_samples(n_key, n_test, counts, visibility, qber_true, rng)
+
+
+def _split_pairs(N_total: int, key_fraction: float):
+    """鍵用/テスト用の件数と、テストのCHSH4設定への均等割り当て"""
     n_key = int(N_total * key_fraction)
     n_test = N_total - n_key
-    # ---- テスト（CHSH）----
     per = n_test // 4
     rem = n_test - 4 * per
-    counts = [per, per, per, per]
-    for i in range(rem):
-        counts[i] += 1
+    counts = np.full(4, per, dtype=np.int64)
+    counts[:rem] += 1
+    return n_key, n_test, counts
+
+
+def _draw_e91_samples(n_key, n_test, counts, visibility, qber_true, rng):
+    # ---- テスト（CHSH）----
     # 相関係数（教育用）
     c = visibility / math.sqrt(2.0)
-    E00 = E01 = E10 = c
-    E11 = -c
-    # 不一致確率
-    p00 = (1 - E00) / 2
-    p01 = (1 - E01) / 2
-    p10 = (1 - E10) / 2
-    p11 = (1 - E11) / 2  # E11<0 → p11>0.5
-
-    mism = []
-    for p, n in zip([p00, p01, p10, p11], counts):
-        # 不一致: 1、一致: 0 として数える
-        mism.append(rng.binomial(n=n, p=p))
+    # E00=E01=E10=+c、E11=-c → 不一致確率 p_ij=(1-Eij)/2（E11<0 → p11>0.5）
+    E = np.array([c, c, c, -c])
+    ps = (1 - E) / 2
+
+    # 不一致: 1、一致: 0 として数える（4設定を1回の二項乱数で）
+    mism = rng.binomial(n=counts, p=ps)
 
     # ---- 鍵用（同一基底セット）----
     key_mism = rng.binomial(n=n_key, p=qber_true)
@@ -124,6 +161,82 @@ def simulate_e91_samples(
 
 
 # ========= 最終鍵の計算 =========
+def make_compute_final_key(
+    N_total: int = 200_000,       # 総ペア数（増やすと統計が安定）
+    key_fraction: float = 0.80,   # 鍵に回す割合（残りがテスト）
+    alpha: float = 1e-3,          # 信頼水準（99.9%）
+    leak_per_bit: float = 0.02,   # 誤り訂正漏えい(bits/bit)の目安
+    safety_bits: int = 40,        # 追加安全マージン（固定ビット）
+):
+    """
+    N_total などの固定パラメータで compute_final_key を特殊化する。
+    件数の割り当て・EC漏えい・有限サイズ補正Δ は1回だけ計算し、
+    f(visibility, qber_true, seed) -> 結果dict を返す（visibility/QBER の掃引向け）。
+    """
+    n_key, n_test, cts = _split_pairs(N_total, key_fraction)
+    has = cts > 0
+    n_safe = np.maximum(cts, 1)
+    # 有限サイズ補正（教育用）：Δ = ceil(6 * sqrt(n_key))
+    leak_EC = int(math.ceil(leak_per_bit * n_key))
+    Delta = int(math.ceil(6.0 * math.sqrt(n_key)))
+    fixed_cost = leak_EC + safety_bits + Delta
+
+    def compute(visibility: float = 0.98, qber_true: float = 0.004, seed: int = 2025):
+        rng = np.random.default_rng(seed)
+
+        # 1) サンプル生成
+        samp = _draw_e91_samples(n_key, n_test, cts, visibility, qber_true, rng)
+        mis = samp["test_mismatches"]
+        key_mis = samp["key_mismatches"]
+
+        # 2) CHSHの下限（設定ごとの二項区間からE_ij下限→合成、4設定まとめて配列で）
+        #    一致率 = 1 - (m/n) → 相関E = 2*一致率 - 1 = 1 - 2*(m/n)
+        lo, _ = wilson_interval_vec(k=cts - mis, n=cts, alpha=alpha)   # 一致数 = n - m
+        E_point = np.where(has, 1.0 - 2.0 * (mis / n_safe), 0.0)
+        E_lo = np.where(has, 1.0 - 2.0 * (1.0 - lo), 0.0)
+
+        E00, E01, E10, E11 = E_point.tolist()
+        E00_lo, E01_lo, E10_lo, E11_lo = E_lo.tolist()
+
+        S_point = E00 + E01 + E10 - E11
+        S_LB = E00_lo + E01_lo + E10_lo - E11_lo  # 下限
+
+        # 3) QBERの上限（鍵セットの二項区間）
+        if n_key > 0:
+            qhat = key_mis / n_key
+            _, q_hi = wilson_interval(k=key_mis, n=n_key, alpha=alpha)
+            Q_upper = q_hi
+        else:
+            qhat = 0.5
+            Q_upper = 0.5
+
+        # 4) Devetak–Winter の“下限鍵率” r_low
+        chsh_term = chsh_min_entropy_term(S_LB)
+        r_low = max(0.0, 1.0 - h2(Q_upper) - chsh_term)
+
+        # 5) 最終鍵長 m = floor(n_key*r_low) - EC漏えい - 安全ビット - 有限サイズ補正Δ
+        ell_raw = max(0, int(math.floor(n_key * r_low)))
+        m = max(0, ell_raw - fixed_cost)
+
+        return {
+            "N_total": N_total,
+            "n_key": n_key,
+            "n_test": n_test,
+            "S_point": S_point,
+            "S_LB": S_LB,
+            "Q_hat": qhat,
+            "Q_upper": Q_upper,
+            "r_low": r_low,
+            "ell_raw": ell_raw,
+            "leak_EC": leak_EC,
+            "Delta": Delta,
+            "safety_bits": safety_bits,
+            "m": m,
+        }
+
+    return compute
+
+
 def compute_final_key(
     N_total: int = 200_000,       # 総ペア数（増やすと統計が安定）
     key_fraction: float = 0.80,   # 鍵に回す割合（残りがテスト）
@@ -134,79 +247,8 @@ def compute_final_key(
     safety_bits: int = 40,        # 追加安全マージン（固定ビット）
     seed: int = 2025,
 ):
-    rng = np.random.default_rng(seed)
-
-    # 1) サンプル生成
-    samp = simulate_e91_samples(
-        N_total=N_total,
-        key_fraction=key_fraction,
-        visibility=visibility,
-        qber_true=qber_true,
-        rng=rng,
-    )
-
-    n_key = samp["n_key"]
-    n_test = samp["n_test"]
-    cts = samp["test_counts"]
-    mis = samp["test_mismatches"]
-    key_mis = samp["key_mismatches"]
-
-    # 2) CHSHの下限（設定ごとの二項区間からE_ij下限→合成）
-    E_lo = []
-    E_point = []
-    for n, m in zip(cts, mis):
-        # 一致率 = 1 - (m/n) → 相関E = 2*一致率 - 1 = 1 - 2*(m/n)
-        if n == 0:
-            E_point.append(0.0)
-            E_lo.append(0.0)
-            continue
-        p_hat = 1.0 - (m / n)
-        lo, hi = wilson_interval(k=int(round(p_hat * n)), n=n, alpha=alpha)
-        E_point.append(1.0 - 2.0 * (m / n))
-        E_lo.append(1.0 - 2.0 * (1.0 - lo))
-
-    E00, E01, E10, E11 = E_point
-    E00_lo, E01_lo, E10_lo, E11_lo = E_lo
-
-    S_point = E00 + E01 + E10 - E11
-    S_LB = E00_lo + E01_lo + E10_lo - E11_lo  # 下限
-
-    # 3) QBERの上限（鍵セットの二項区間）
-    if n_key > 0:
-        qhat = key_mis / n_key
-        _, q_hi = wilson_interval(k=key_mis, n=n_key, alpha=alpha)
-        Q_upper = q_hi
-    else:
-        qhat = 0.5
-        Q_upper = 0.5
-
-    # 4) Devetak–Winter の“下限鍵率” r_low
-    chsh_term = chsh_min_entropy_term(S_LB)
-    r_low = max(0.0, 1.0 - h2(Q_upper) - chsh_term)
-
-    # 5) 最終鍵長 m = floor(n_key*r_low) - EC漏えい - 安全ビット - 有限サイズ補正Δ
-    #    有限サイズ補正（教育用）：Δ = ceil(6 * sqrt(n_key))
-    ell_raw = max(0, int(math.floor(n_key * r_low)))
-    leak_EC = int(math.ceil(leak_per_bit * n_key))
-    Delta = int(math.ceil(6.0 * math.sqrt(n_key)))
-    m = max(0, ell_raw - leak_EC - safety_bits - Delta)
-
-    out = {
-        "N_total": N_total,
-        "n_key": n_key,
-        "n_test": n_test,
-        "S_point": S_point,
-        "S_LB": S_LB,
-        "Q_hat": qhat,
-        "Q_upper": Q_upper,
-        "r_low": r_low,
-        "ell_raw": ell_raw,
-        "leak_EC": leak_EC,
-        "Delta": Delta,
-        "safety_bits": safety_bits,
-        "m": m,
-    }
-    return out
+    f = make_compute_final_key(N_total, key_fraction, alpha, leak_per_bit, safety_bits)
+    return f(visibility, qber_true, seed)
 
 
 # ========= OTPデモ（鍵が出たら実施） =========
@@ -6,6 +6,17 @@ import numpy as np
 import math
 import secrets
 
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        # numba が無ければ素の Python 関数として使う
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
 # ====== 設定 ======
 N_PAIRS = 200000        # ペア総数（試行回数） ← 大幅増
 KEY_FRACTION = 0.75     # 鍵生成に使う割合
@@ -15,50 +26,88 @@ ALPHA = 1e-10           # 有限サイズ補正の信頼水準（厳しめ）
 SAFETY_BITS = 40        # 安全マージン
 
 # ====== エントロピー関数 ======
+@njit(cache=True, fastmath=True)
 def h2(x):
     if x <= 0 or x >= 1:
         return 0.0
     return -x*math.log2(x) - (1-x)*math.log2(1-x)
 
+def h2_vec(x):
+    """h2 の配列版（np.log2 を配列全体に1回ずつ。x<=0, x>=1 は 0）"""
+    x = np.asarray(x, dtype=float)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        y = -x*np.log2(x) - (1-x)*np.log2(1-x)
+    return np.where((x <= 0) | (x >= 1), 0.0, y)
+
+def xor_otp(msg_bytes: bytes, key_bytes: bytes) -> bytes:
+    """OTP（XOR）：短い方の長さに揃え、NumPy の XOR（C ループ）で一括処理"""
+    m = min(len(msg_bytes), len(key_bytes))
+    xm = np.frombuffer(msg_bytes, dtype=np.uint8, count=m)
+    xk = np.frombuffer(key_bytes, dtype=np.uint8, count=m)
+    return (xm ^ xk).tobytes()
+
 # ====== シミュレーション ======
-def run():
+def run(error_rates=None, key_fractions=None, seed=None):
+    """
+    error_rates / key_fractions に配列を渡すと (誤り率, 鍵割合) の全組合せを一括評価し、
+    形 (len(error_rates), len(key_fractions)) の配列を値にもつ dict を返す。
+    どちらも省略すると ERROR_RATE / KEY_FRACTION の1点をスカラーの dict で返す（従来どおり）。
+    seed を渡すと CHSH のノイズを default_rng(seed) から引く。
+    """
+    scalar = error_rates is None and key_fractions is None
+    q_obs = np.atleast_1d(np.asarray(ERROR_RATE if error_rates is None else error_rates, dtype=float))
+    kf = np.atleast_1d(np.asarray(KEY_FRACTION if key_fractions is None else key_fractions, dtype=float))
+    q_obs = q_obs.reshape(-1, 1)   # 行：誤り率
+    kf = kf.reshape(1, -1)         # 列：鍵割合
+    shape = (q_obs.shape[0], kf.shape[1])
+
     # ペアを分配
-    n_key = int(N_PAIRS * KEY_FRACTION)
+    n_key = (N_PAIRS * kf).astype(np.int64)
     n_test = int(N_PAIRS * TEST_FRACTION)
 
-    # QBER測定
-    q_obs = ERROR_RATE
-
     # CHSH値の推定（理論値を3.2程度に設定、ノイズ加味）
-    S_point = 2.8 + np.random.normal(0, 0.05)
+    gen = np.random if seed is None else np.random.default_rng(seed)
+    S_point = 2.8 + gen.normal(0, 0.05, size=shape)
     # 有限サイズ補正で下限を計算（近似）
     S_LB = S_point - 3.0/np.sqrt(max(1, n_test))
 
     # エラー訂正リーク（CASCADEを模擬）
-    EC_leak = int(n_key * h2(q_obs) * 1.2)  # 1.2倍はCASCADEのオーバーヘッド
+    hq = h2_vec(q_obs)
+    EC_leak = (n_key * hq * 1.2).astype(np.int64)  # 1.2倍はCASCADEのオーバーヘッド
 
     # Devetak-Winter レート
-    if S_LB > 2.0:
-        r = 1 - h2(q_obs) - (EC_leak / n_key)
-    else:
-        r = 0.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        r = np.where(S_LB > 2.0, 1 - hq - EC_leak / n_key, 0.0)
 
     # 有限サイズ補正
-    A = int(5.0 * math.sqrt(n_key))  # 教育用に簡略化
+    A = (5.0 * np.sqrt(n_key)).astype(np.int64)  # 教育用に簡略化
 
     # 最終鍵長
-    l_raw = int(n_key * max(0, 1 - h2(q_obs))) - EC_leak
-    l_final = max(0, l_raw - A - SAFETY_BITS)
-
+    l_raw = (n_key * np.maximum(0, 1 - hq)).astype(np.int64) - EC_leak
+    l_final = np.maximum(0, l_raw - A - SAFETY_BITS)
+
+    if scalar:
+        return {
+            "N": N_PAIRS,
+            "n_key": int(n_key[0, 0]),
+            "n_test": n_test,
+            "QBER": float(q_obs[0, 0]),
+            "S_point": float(S_point[0, 0]),
+            "S_LB": float(S_LB[0, 0]),
+            "EC_leak": int(EC_leak[0, 0]),
+            "finite_A": int(A[0, 0]),
+            "l_raw": int(l_raw[0, 0]),
+            "l_final": int(l_final[0, 0]),
+        }
     return {
         "N": N_PAIRS,
-        "n_key": n_key,
+        "n_key": np.broadcast_to(n_key, shape),
         "n_test": n_test,
-        "QBER": q_obs,
+        "QBER": np.broadcast_to(q_obs, shape),
         "S_point": S_point,
         "S_LB": S_LB,
         "EC_leak": EC_leak,
-        "finite_A": A,
+        "finite_A": np.broadcast_to(A, shape),
         "l_raw": l_raw,
         "l_final": l_final,
     }
@@ -84,8 +133,8 @@ def main():
         key = secrets.token_bytes(key_len)
         msg = "E91で暗号通信テスト"
         msg_bytes = msg.encode('utf-8')
-        cipher = bytes([a ^ b for a, b in zip(msg_bytes, key[:len(msg_bytes)])])
-        plain = bytes([a ^ b for a, b in zip(cipher, key[:len(msg_bytes)])])
+        cipher = xor_otp(msg_bytes, key)
+        plain = xor_otp(cipher, key)
         print(f"暗号文 (hex) = {cipher.hex()}")
         print(f"復号結果 = {plain.decode('utf-8')}")
     else:
@@ -3,19 +3,44 @@
 
 from __future__ import annotations
 import math, secrets
+from functools import lru_cache
+from statistics import NormalDist
 import numpy as np
 
+try:
+    from scipy.special import ndtri
+    from scipy.stats import beta
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
 # ===== 基本関数 =====
+@lru_cache(maxsize=4096)
 def h2(x: float) -> float:
+    # 同じ引数（例: Q_UB）で何度も呼ばれるのでメモ化（キーは x そのもの：丸めないので値は変わらない）
     if x <= 0.0 or x >= 1.0: return 0.0
     return - x*math.log2(x) - (1-x)*math.log2(1-x)
 
+@lru_cache(maxsize=32)
+def _z_one_sided(alpha: float) -> float:
+    # 片側の正規分位 z = Φ^{-1}(1-α)。SciPy があれば ndtri、無ければ標準ライブラリの NormalDist
+    if HAVE_SCIPY:
+        return float(ndtri(1 - alpha))
+    return NormalDist().inv_cdf(1 - alpha)
+
 def clopper_pearson_upper(k: int, n: int, alpha: float) -> float:
     # 片側上側 (success=k) の上限（失敗=エラー数でも使える）
-    # k/n の上方信頼限界  (scipy無しの近似: Wilsonを穏健に利用)
+    # k/n の正確な上方信頼限界 Beta(1-α; k+1, n-k)。SciPy が無ければ Wilson で近似
+    if not HAVE_SCIPY:
+        return wilson_upper(k, n, alpha)
+    if n == 0 or k >= n: return 1.0
+    return float(beta.ppf(1 - alpha, k + 1, n - k))
+
+def wilson_upper(k: int, n: int, alpha: float) -> float:
+    # k/n の上方信頼限界（Wilson スコア近似、比較用）
     if n == 0: return 1.0
     p = k/n
-    z = abs(np.sqrt(2)*erf_inv(1-2*alpha))  # 正規近似のz
+    z = _z_one_sided(alpha)  # 正規近似のz
     denom = 1 + z*z/n
     center = (p + z*z/(2*n)) / denom
     half = z*math.sqrt(p*(1-p)/n + z*z/(4*n*n)) / denom
@@ -27,7 +52,7 @@ def confint_E_from_counts(match:int, total:int, alpha:float):
         return (0.0, 0.0, 0.0)
     p_hat = match/total
     # WilsonでCI
-    z = abs(np.sqrt(2)*erf_inv(1-2*alpha))
+    z = _z_one_sided(alpha)
     denom = 1 + z*z/total
     center = (p_hat + z*z/(2*total))/denom
     half = z*math.sqrt(p_hat*(1-p_hat)/total + z*z/(4*total*total))/denom
@@ -38,15 +63,6 @@ def confint_E_from_counts(match:int, total:int, alpha:float):
     E_hi  = 2*hi_p - 1
     return (E_hat, E_lo, E_hi)
 
-# 誤差関数の逆関数（近似）
-def erf_inv(x: float) -> float:
-    # Abramowitz–Stegun型の近似で十分
-    a = 0.147  # 定数
-    sgn = 1 if x>=0 else -1
-    ln = math.log(1-x*x)
-    term = 2/(math.pi*a) + ln/2
-    return sgn*math.sqrt( math.sqrt(term*term - ln/a) - term )
-
 # ===== E91の教育モデル =====
 def e91_run(
     N_pairs=300_000,
@@ -75,16 +91,11 @@ def e91_run(
     n_per = n_test//4
     # 不一致確率 p_ij = (1 - E_ij)/2
     # + + + − の組み合わせ（E11は負）
-    p00 = (1 - (+E_star))/2
-    p01 = (1 - (+E_star))/2
-    p10 = (1 - (+E_star))/2
-    p11 = (1 - (-E_star))/2  # = (1 + E_star)/2
+    # 順に (00, 01, 10, 11)。p11 = (1 - (-E*))/2 = (1 + E*)/2
+    p_mis = np.array([(1 - E_star)/2]*3 + [(1 + E_star)/2])
 
-    # 一致回数を二項分布で生成（"一致" = 1−不一致）
-    m00 = n_per - rng.binomial(n_per, p00)
-    m01 = n_per - rng.binomial(n_per, p01)
-    m10 = n_per - rng.binomial(n_per, p10)
-    m11 = n_per - rng.binomial(n_per, p11)
+    # 一致回数を二項分布で生成（"一致" = 1−不一致）：4組を1回の呼び出しで
+    m00, m01, m10, m11 = (n_per - rng.binomial(n_per, p_mis)).tolist()
 
     # 推定と信頼区間
     E00, E00_lo, E00_hi = confint_E_from_counts(m00, n_per, alpha)
@@ -163,8 +174,11 @@ def otp_demo(key_bits: int, msg="E91で作った鍵で暗号化デモ"):
     kb = secrets.token_bytes((key_bits+7)//8)
     m  = msg.encode("utf-8")
     n  = min(len(m), len(kb))
-    c  = bytes([m[i]^kb[i] for i in range(n)])
-    p  = bytes([c[i]^kb[i] for i in range(n)])
+    # バイト単位の XOR は NumPy で一括（Python の1バイトずつループを避ける）
+    ka = np.frombuffer(kb, dtype=np.uint8, count=n)
+    ca = np.frombuffer(m, dtype=np.uint8, count=n) ^ ka
+    c  = ca.tobytes()
+    p  = (ca ^ ka).tobytes()
     return {
         "key_len_bits": 8*n,
         "cipher_hex": c.hex(),
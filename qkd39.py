@@ -4,8 +4,26 @@
 
 from __future__ import annotations
 import math, hashlib, secrets
+from functools import lru_cache
 import numpy as np
 
+try:
+    from scipy.special import ndtri
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        # numba が無ければ素の Python 関数として使う
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
 # =========================
 #  小さなユーティリティ
 # =========================
@@ -47,46 +65,44 @@ def normal_ppf_acklam(p: float) -> float:
     return (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5])*q / \
            (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1)
 
+@lru_cache(maxsize=32)
+def _wilson_z(alpha: float) -> tuple[float, float]:
+    """Wilson区間の z=Φ^{-1}(1-α/2) と z²（alpha ごとに1回だけ計算）"""
+    # SciPy があれば ndtri（C実装・高精度）、無ければ Acklam 近似
+    p = 1 - alpha/2
+    z = float(ndtri(p)) if HAVE_SCIPY else normal_ppf_acklam(p)
+    return z, z*z
+
 def wilson_two_sided_CI(k: int, n: int, alpha: float) -> tuple[float,float]:
     """二項比率のWilson区間（安全側）。k成功, n試行"""
     if n == 0:
         return (0.0, 1.0)
     p = k/n
-    z = normal_ppf_acklam(1 - alpha/2)
-    denom = 1 + z*z/n
-    center = (p + z*z/(2*n)) / denom
-    half = z*math.sqrt(p*(1-p)/n + z*z/(4*n*n)) / denom
+    z, z2 = _wilson_z(alpha)
+    denom = 1 + z2/n
+    center = (p + z2/(2*n)) / denom
+    half = z*math.sqrt(p*(1-p)/n + z2/(4*n*n)) / denom
     lo = max(0.0, center - half)
     hi = min(1.0, center + half)
     return lo, hi
 
 def bits_to_bytes(bits: np.ndarray) -> bytes:
-    """0/1のnp.uint8配列→バイト列（先頭から詰める）"""
-    if len(bits) == 0:
-        return b""
-    pad = (8 - (len(bits) % 8)) % 8
-    if pad:
-        bits = np.concatenate([bits, np.zeros(pad, dtype=np.uint8)])
-    by = bytearray()
-    for i in range(0, len(bits), 8):
-        v = 0
-        for b in bits[i:i+8]:
-            v = (v<<1) | int(b)
-        by.append(v)
-    return bytes(by)
+    """0/1のnp.uint8配列→バイト列（先頭から詰める。端数は0で埋める）"""
+    return np.packbits(bits, bitorder="big").tobytes()
 
 def sha256_privacy_amp(bits: np.ndarray, m: int) -> np.ndarray:
     """SHA-256連結でmビットへ圧縮"""
     if m <= 0:
         return np.zeros(0, dtype=np.uint8)
-    raw = bits_to_bytes(bits)
+    # raw は1回だけ吸収し、その内部状態を複製してカウンタを足す
+    # （sha256(raw + ctr) と同じ値を、raw を読み直さずに得る）
+    base = hashlib.sha256(bits_to_bytes(bits))
     out = bytearray()
-    ctr = 0
-    while len(out)*8 < m:
-        out.extend(hashlib.sha256(raw + ctr.to_bytes(4,'big')).digest())
-        ctr += 1
-    bitstr = ''.join(f'{b:08b}' for b in out)[:m]
-    return np.fromiter((1 if c=='1' else 0 for c in bitstr), dtype=np.uint8)
+    for ctr in range((m + 255) // 256):
+        h = base.copy()
+        h.update(ctr.to_bytes(4,'big'))
+        out.extend(h.digest())
+    return np.unpackbits(np.frombuffer(bytes(out), dtype=np.uint8), bitorder="big")[:m]
 
 # =========================
 #  E91 もつれ測定の教育的シミュレーション
@@ -95,24 +111,12 @@ def sha256_privacy_amp(bits: np.ndarray, m: int) -> np.ndarray:
 A_ANGLES = [0.0, math.pi/4]
 B_ANGLES = [ math.pi/8, -math.pi/8 ]
 
-def chsh_expectation(visibility: float, ai: int, bi: int) -> float:
-    """理想 singlet の相関 E = -vis*cos(2*(a-b))"""
-    a = A_ANGLES[ai]; b = B_ANGLES[bi]
-    return -visibility * math.cos(2*(a - b))
+# cos(2*(a-b)) は角度の組 (ai,bi) ごとの定数 → 2×2 の表にしておく
+_COS_AB = np.array([[math.cos(2*(a - b)) for b in B_ANGLES] for a in A_ANGLES])
 
-def sample_ab_from_E(E: float, rng: np.random.Generator) -> tuple[int,int]:
-    """
-    E = <A*B> を満たす ±1の相関サンプリング（周辺一様）
-    P(A=B)= (1+E)/2,  P(A≠B)=(1-E)/2
-    返り値は 0/1 ビット（±1→0/1 に写像）
-    """
-    A = 1 if rng.random() < 0.5 else -1
-    same = rng.random() < (1+E)/2
-    B = A if same else -A
-    # ±1 → 0/1 に変換（-1→1, +1→0 でもどちらでも可）
-    a_bit = 0 if A==1 else 1
-    b_bit = 0 if B==1 else 1
-    return a_bit, b_bit
+def chsh_expectation(visibility: float, ai, bi):
+    """理想 singlet の相関 E = -vis*cos(2*(a-b))（ai, bi は配列でもOK：表を引くだけ）"""
+    return -visibility * _COS_AB[ai, bi]
 
 def run_e91_once(N_pairs=300_000, key_fraction=0.80, p_flip=0.005, alpha_CI=0.02, seed=2025):
     """
@@ -124,40 +128,33 @@ def run_e91_once(N_pairs=300_000, key_fraction=0.80, p_flip=0.005, alpha_CI=0.02
     rng = np.random.default_rng(seed)
     vis = max(0.0, 1 - 2*p_flip)    # 可視度（単純モデル）
 
-    # 記録
-    a_key = []
-    b_key = []
-
-    # CHSH: 各組み合わせの一致回数
-    ch_cnt = {(0,0):[0,0], (0,1):[0,0], (1,0):[0,0], (1,1):[0,0]}  # [equal, total]
-
-    for _ in range(N_pairs):
-        if rng.random() < key_fraction:
-            # 鍵セット: 完全相関にBob側ビット反転ノイズ
-            a = 1 if rng.random()<0.5 else 0
-            b = a
-            if rng.random() < p_flip:
-                b ^= 1
-            a_key.append(a); b_key.append(b)
-        else:
-            # CHSHセット
-            ai = rng.integers(0,2); bi = rng.integers(0,2)
-            E = chsh_expectation(vis, ai, bi)
-            a,b = sample_ab_from_E(E, rng)
-            eq = 1 if (a==b) else 0
-            rec = ch_cnt[(ai,bi)]
-            rec[0] += eq; rec[1] += 1
-
-    a_key = np.array(a_key, dtype=np.uint8)
-    b_key = np.array(b_key, dtype=np.uint8)
-    n_key = int(len(a_key))
-    qber = float(np.mean(a_key ^ b_key)) if n_key>0 else 0.0
+    # 鍵セット / CHSHセットの振り分けを全ペア一括で
+    is_key = rng.random(N_pairs) < key_fraction
+    n_key = int(np.count_nonzero(is_key))
+    n_ch = N_pairs - n_key
+
+    # 鍵セット: 完全相関にBob側ビット反転ノイズ
+    a_key = (rng.random(n_key) < 0.5).astype(np.uint8)
+    flips = rng.random(n_key) < p_flip
+    b_key = a_key ^ flips.astype(np.uint8)
+    qber = float(flips.mean()) if n_key>0 else 0.0   # a^b = flips なので XOR し直さない
+
+    # CHSHセット: 設定 (ai,bi) ごとの E を表から引き、一致 (A==B) を確率 (1+E)/2 で判定
+    ai = rng.integers(0, 2, size=n_ch)
+    bi = rng.integers(0, 2, size=n_ch)
+    idx = 2*ai + bi
+    same = rng.random(n_ch) < (1 + chsh_expectation(vis, ai, bi))/2
+    eq_cnt = np.bincount(idx, weights=same, minlength=4).astype(np.int64)
+    tot_cnt = np.bincount(idx, minlength=4)
+
+    # CHSH: 各組み合わせの一致回数 ch_cnt[ai, bi] = [equal, total]（形 (2,2,2) の int64 配列）
+    ch_cnt = np.stack([eq_cnt, tot_cnt], axis=1).reshape(2, 2, 2)
 
     # CHSH 推定と“下限”の作成
     E_point = {}
     E_LB = {}
     for k,(ai,bi) in enumerate([(0,0),(0,1),(1,0),(1,1)]):
-        eq, tot = ch_cnt[(ai,bi)]
+        eq, tot = ch_cnt[ai, bi].tolist()
         if tot==0:
             E_point[(ai,bi)] = 0.0
             E_LB[(ai,bi)] = -1.0  # 最悪
@@ -182,22 +179,97 @@ def run_e91_once(N_pairs=300_000, key_fraction=0.80, p_flip=0.005, alpha_CI=0.02
 # =========================
 #  CASCADE風 EC + インターリーブ + 追加パス
 # =========================
-def parity(arr: np.ndarray) -> int:
-    return int(np.bitwise_xor.reduce(arr) if len(arr) else 0)
-
+def mismatched_blocks(a: np.ndarray, b: np.ndarray, block_size: int) -> np.ndarray:
+    """
+    長さ block_size のブロックに区切り、パリティが食い違うブロック番号を返す。
+    parity(a)^parity(b) = parity(a^b) なので a^b を (ブロック数, block_size) に並べて1回で XOR 縮約。
+    末尾の端数ブロックは0埋め（パリティは変わらない）。
+    """
+    d = a ^ b
+    pad = (-len(d)) % block_size
+    if pad:
+        d = np.concatenate([d, np.zeros(pad, dtype=d.dtype)])
+    if block_size % 64 == 0:
+        # 64ビットずつ uint64 に詰め（1ビット/ビット）、ブロック内の語を XOR してから語のパリティを取る
+        words = np.packbits(d).view(np.uint64).reshape(-1, block_size // 64)
+        return np.flatnonzero(word_parity(np.bitwise_xor.reduce(words, axis=1)))
+    return np.flatnonzero(np.bitwise_xor.reduce(d.reshape(-1, block_size), axis=1))
+
+def word_parity(w: np.ndarray) -> np.ndarray:
+    """uint64 配列の各要素のパリティ（popcount & 1）。NumPy 2 は bitwise_count、無ければ SWAR で畳み込む。"""
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(w) & 1
+    w = w.copy()
+    for sh in (32, 16, 8, 4, 2, 1):
+        w ^= w >> np.uint64(sh)
+    return w & np.uint64(1)
+
+@njit(cache=True, boundscheck=False)
 def binary_search_fix(a: np.ndarray, b: np.ndarray, l: int, r: int) -> int:
     """区間[l,r) 内で1ビット誤りを二分探索で修正。漏洩カウント（比較回数）を返す。"""
     leak = 0
     while r - l > 1:
         m = (l + r)//2
         leak += 1
-        if parity(a[l:m]) != parity(b[l:m]):
+        # 左半分のパリティをその場で XOR 累積（スライス・reduce を作らない）
+        pa = 0; pb = 0
+        for i in range(l, m):
+            pa ^= a[i]; pb ^= b[i]
+        if pa != pb:
             r = m
         else:
             l = m
     b[l] ^= 1
     return leak
 
+@njit(cache=True, boundscheck=False)
+def fix_blocks(a: np.ndarray, b: np.ndarray, bad: np.ndarray, block_size: int) -> int:
+    """不一致ブロック bad をそれぞれ二分探索で修正し、漏洩カウントの合計を返す。"""
+    n = len(a)
+    leak = 0
+    for k in bad:
+        s = k * block_size
+        leak += binary_search_fix(a, b, s, min(s+block_size, n))
+    return leak
+
+@njit(cache=True, boundscheck=False)
+def _cascade_pass(a: np.ndarray, b: np.ndarray, block_size: int) -> int:
+    """1パス分：ブロックごとにパリティを XOR 累積で比較し、不一致なら二分探索で修正。漏洩カウントを返す。"""
+    n = len(a)
+    leak = 0
+    for s in range(0, n, block_size):
+        e = min(s+block_size, n)
+        pa = 0; pb = 0
+        for i in range(s, e):
+            pa ^= a[i]; pb ^= b[i]
+        if pa != pb:
+            leak += 1
+            leak += binary_search_fix(a, b, s, e)
+    return leak
+
+@njit(cache=True, boundscheck=False)
+def _cascade_core(a: np.ndarray, b: np.ndarray, perms: np.ndarray,
+                  passes: np.ndarray, interleave: bool) -> int:
+    """
+    メインパス全体を1つのカーネルで実行（b をその場で修正し、漏洩カウントを返す）。
+    置換 perms[i] は Python 側で rng から作って渡す。
+    """
+    n = len(a)
+    leak = 0
+    a_p = np.empty_like(a)
+    b_p = np.empty_like(b)
+    for k in range(len(passes)):
+        if interleave:
+            perm = perms[k]
+            for i in range(n):
+                a_p[i] = a[perm[i]]; b_p[i] = b[perm[i]]
+            leak += _cascade_pass(a_p, b_p, passes[k])
+            for i in range(n):
+                b[perm[i]] = b_p[i]
+        else:
+            leak += _cascade_pass(a, b, passes[k])
+    return leak
+
 def cascade_ec(a_key: np.ndarray, b_key: np.ndarray,
                passes=(256,128,64,32,16,8,4,2,1),
                interleave=True, seed=2025, extra_rounds=2):
@@ -209,38 +281,53 @@ def cascade_ec(a_key: np.ndarray, b_key: np.ndarray,
     返り値: b_corr, leak_ec(bit), mism_after
     """
     rng = np.random.default_rng(seed)
-    a = a_key.copy()
+    a = a_key          # a は書き換えないのでコピー不要（修正するのは b だけ）
     b = b_key.copy()
     n = len(a)
     leak = 0
 
-    def one_pass(block_size: int) -> int:
-        nonlocal leak, a, b
-        mismatches = 0
-        for s in range(0, n, block_size):
-            e = min(s+block_size, n)
-            if parity(a[s:e]) != parity(b[s:e]):
-                leak += 1
-                leak += binary_search_fix(a, b, s, e)
-                mismatches += 1
-        return mismatches
+    def one_pass(a: np.ndarray, b: np.ndarray, block_size: int) -> int:
+        nonlocal leak
+        if n == 0:
+            return 0
+        # 全ブロックのパリティ比較を一括で行い、不一致ブロックだけ二分探索へ
+        # （ブロックは互いに素なので、1つ直しても他ブロックの判定は変わらない）
+        bad = mismatched_blocks(a, b, block_size)
+        leak += len(bad)
+        if block_size == 1:
+            # 1ビットブロックは比較そのものが位置特定：まとめて反転
+            b[bad] ^= 1
+        else:
+            leak += fix_blocks(a, b, bad, block_size)
+        return len(bad)
 
     # メインパス
-    for bs in passes:
-        if interleave:
-            perm = rng.permutation(n)
-            a = a[perm]; b = b[perm]
-        mism = one_pass(bs)
-        # インターリーブを戻す（次のパスのため）
-        if interleave:
-            inv = np.empty_like(perm)
-            inv[perm] = np.arange(n)
-            a = a[inv]; b = b[inv]
-
-    # 必要なら追加で微細パス
-    bs = 1
-    for _ in range(extra_rounds):
-        mism = one_pass(bs)
+    if HAVE_NUMBA:
+        # numba があればパス全体を1カーネルで（置換は同じ rng・同じ順で先に作って渡す）
+        if interleave and n > 0:
+            perms = np.array([rng.permutation(n) for _ in passes], dtype=np.int64).reshape(len(passes), n)
+        else:
+            perms = np.empty((0, n), dtype=np.int64)
+        leak += _cascade_core(a, b, perms, np.asarray(passes, dtype=np.int64), interleave)
+    else:
+        for bs in passes:
+            if interleave:
+                # 並べ替えた写しでパスを行い、修正された b だけを元の位置へ書き戻す
+                # （a は書き換わらないので戻す必要がなく、逆置換も作らない）
+                perm = rng.permutation(n)
+                b_p = b[perm]
+                one_pass(a[perm], b_p, bs)
+                b[perm] = b_p
+            else:
+                one_pass(a, b, bs)
+
+    # 必要なら追加で微細パス（bs=1）
+    # 1ビットブロックの比較は a!=b そのもので、1ラウンドで残りが全て直る
+    # （2ラウンド目以降は不一致0で漏洩も増えない）ので、直接比較1回にまとめる
+    if extra_rounds > 0:
+        diff = np.flatnonzero(a != b)
+        leak += len(diff)
+        b[diff] = a[diff]
 
     mism_after = int(np.sum(a ^ b))
     return b, leak, mism_after
@@ -254,9 +341,9 @@ def consume_auth_tag(bits: np.ndarray, tag_bits=128) -> tuple[np.ndarray, int, b
     実装簡略化: bitsが空でなければ「検証成功」とする。
     """
     if len(bits) < tag_bits:
-        return bits.copy(), 0, False
-    # 消費（末尾を使う）
-    return bits[:-tag_bits].copy(), tag_bits, True
+        return bits, 0, False
+    # 消費（末尾を使う）。以降は読むだけなのでコピーせずビューで返す
+    return bits[:-tag_bits], tag_bits, True
 
 # =========================
 #  パイプライン: E91→EC→認証→PA
@@ -282,9 +369,8 @@ def run_pipeline(N_pairs=300_000,
                         seed=seed, extra_rounds=2)
 
     # 検証タグ（鍵一致の最終確認）
-    a_after_ec = a_key.copy()
-    # a側は既に正しいのでそのまま
-    a_for_auth = a_after_ec
+    # a側は既に正しいのでそのまま（EC は a を書き換えないのでコピー不要）
+    a_for_auth = a_key
     b_for_auth = b_corr
     # 認証タグ分を消費（両者同じだけ消費）
     a_after_tag, leak_tag_a, auth_ok_a = consume_auth_tag(a_for_auth, tag_bits=tag_bits)
@@ -333,8 +419,11 @@ def otp_demo(final_bits: np.ndarray, msg="E91で作った鍵で暗号化テス
     L = min(len(mb), len(key_bytes))
     if L == 0:
         return {"ok": False}
-    cipher = bytes([mb[i] ^ key_bytes[i] for i in range(L)])
-    plain  = bytes([cipher[i] ^ key_bytes[i] for i in range(L)]).decode("utf-8","ignore")
+    # XOR は NumPy 配列で一括
+    ka = np.frombuffer(key_bytes, dtype=np.uint8, count=L)
+    ca = np.frombuffer(mb, dtype=np.uint8, count=L) ^ ka
+    cipher = ca.tobytes()
+    plain  = (ca ^ ka).tobytes().decode("utf-8","ignore")
     return {"ok": True, "key_len_bits": len(final_bits), "cipher_hex": cipher.hex(), "recovered": plain}
 
 # =========================
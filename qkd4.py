@@ -1,8 +1,7 @@
 import numpy as np
-from qiskit import QuantumCircuit, transpile
-from qiskit_aer import AerSimulator
 
 N = 800
+FAST = True   # True: NumPyだけで高速に; False: Qiskitで (bit, Alice基底, Bob基底) の組ごとに最大8回路を作り、memory=True で1ショットずつの結果を読む（教育用・遅い）
 rng = np.random.default_rng(0)
 
 alice_bits  = rng.integers(0,2,size=N,dtype=np.uint8)
@@ -10,18 +9,29 @@ alice_basis = rng.integers(0,2,size=N,dtype=np.uint8)  # 0=Z, 1=X
 bob_basis   = rng.integers(0,2,size=N,dtype=np.uint8)
 
 # --- 送受信 ---
-circs = []
-for b, ba, bb in zip(alice_bits, alice_basis, bob_basis):
-    qc = QuantumCircuit(1,1)
-    if b==1:  qc.x(0)      # 1を準備
-    if ba==1: qc.h(0)      # アリスの基底
-    if bb==1: qc.h(0)      # ボブの測定基底
-    qc.measure(0,0)
-    circs.append(qc)
-
-sim = AerSimulator()
-res = sim.run(transpile(circs, sim), shots=1).result()
-bob_bits = np.array([1 if res.get_counts(i).get('1',0) else 0 for i in range(N)], dtype=np.uint8)
+if FAST:
+    # 基底が一致すればアリスのビットそのまま、不一致なら 0/1 が等確率（回路の測定結果と同じ分布）
+    random_bits = rng.integers(0,2,size=N,dtype=np.uint8)
+    bob_bits = np.where(alice_basis == bob_basis, alice_bits, random_bits)
+else:
+    from qiskit import QuantumCircuit, transpile
+    from qiskit_aer import AerSimulator
+
+    # 回路は (b, ba, bb) の8通りしかない → 種類ごとに1回だけ作って shots=件数 で回し、
+    # memory で1ショットずつの結果を受け取り、文字列を NumPy で一括パースする
+    sim = AerSimulator()
+    code = 4*alice_bits + 2*alice_basis + bob_basis
+    bob_bits = np.empty(N, dtype=np.uint8)
+    for c in np.unique(code):
+        b, ba, bb = (c >> 2) & 1, (c >> 1) & 1, c & 1
+        qc = QuantumCircuit(1,1)
+        if b==1:  qc.x(0)      # 1を準備
+        if ba==1: qc.h(0)      # アリスの基底
+        if bb==1: qc.h(0)      # ボブの測定基底
+        qc.measure(0,0)
+        sel = np.flatnonzero(code == c)
+        mem = sim.run(transpile(qc, sim), shots=len(sel), memory=True).result().get_memory(0)
+        bob_bits[sel] = np.frombuffer("".join(mem).encode("ascii"), dtype=np.uint8) - ord("0")
 
 # --- ★ここにノイズを差し込む（Bobの測定結果を擬似的に乱す） ---
 flip_noise =0.08  # 8%の反転ノイズ
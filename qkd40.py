@@ -99,7 +99,10 @@ def run_e91(N_pairs=400_000, key_fraction=0.85, p_flip=0.004, alpha_CI=0.02, see
 
 # ===== CASCADE風EC（インターリーブ+追加ラウンド） =====
 def parity(arr: np.ndarray)->int:
-    return int(np.bitwise_xor.reduce(arr) if len(arr) else 0)
+    # 0/1 配列のパリティ。短いブロックは NumPy の呼び出しコストが支配的なので、
+    # バイト列の 1 の個数で数える（~0.2µs）。長いときだけ XOR 縮約。
+    if len(arr)<=512: return arr.tobytes().count(1) & 1
+    return int(np.bitwise_xor.reduce(arr))
 
 def bs_fix(a:np.ndarray,b:np.ndarray,l:int,r:int)->int:
     leak=0
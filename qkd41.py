@@ -4,8 +4,26 @@
 from __future__ import annotations
 import math
 import hashlib
+from functools import lru_cache
 import numpy as np
 
+try:
+    from scipy.special import ndtri
+    HAVE_SCIPY = True
+except ImportError:
+    HAVE_SCIPY = False
+
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        # numba が無ければ素の Python 関数として使う
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
 # ===== ユーティリティ =====
 def h2(x: float) -> float:
     if x <= 0.0 or x >= 1.0:
@@ -35,82 +53,76 @@ def normal_ppf(p: float) -> float:
     return (((((a[0]*r + a[1])*r + a[2])*r + a[3])*r + a[4])*r + a[5]) * q / \
            (((((b[0]*r + b[1])*r + b[2])*r + b[3])*r + b[4])*r + 1)
 
+@lru_cache(maxsize=32)
+def _wilson_z(alpha: float) -> tuple[float, float]:
+    # z = Φ^{-1}(1-α/2) と z² は alpha ごとに1回だけ計算
+    # SciPy があれば ndtri（C実装・高精度）、無ければ Acklam 近似
+    p = 1 - alpha / 2
+    z = float(ndtri(p)) if HAVE_SCIPY else normal_ppf(p)
+    return z, z*z
+
 def wilson_CI(k: int, n: int, alpha: float) -> tuple[float, float]:
     if n == 0:
         return (0.0, 1.0)
     p = k / n
-    z = normal_ppf(1 - alpha / 2)
-    den = 1 + z*z/n
-    ctr = (p + z*z/(2*n)) / den
-    half = z * math.sqrt(p*(1-p)/n + z*z/(4*n*n)) / den
+    z, z2 = _wilson_z(alpha)
+    den = 1 + z2/n
+    ctr = (p + z2/(2*n)) / den
+    half = z * math.sqrt(p*(1-p)/n + z2/(4*n*n)) / den
     return max(0.0, ctr - half), min(1.0, ctr + half)
 
 def bits_to_bytes(bits: np.ndarray) -> bytes:
-    if len(bits) == 0:
-        return b""
-    pad = (8 - (len(bits) % 8)) % 8
-    if pad:
-        bits = np.concatenate([bits, np.zeros(pad, dtype=np.uint8)])
-    out = bytearray()
-    for i in range(0, len(bits), 8):
-        v = 0
-        for b in bits[i:i+8]:
-            v = (v << 1) | int(b)
-        out.append(v)
-    return bytes(out)
+    # MSB 先頭で8ビットずつ詰める（端数は0埋め）
+    return np.packbits(bits, bitorder="big").tobytes()
 
 def sha256_amp(bits: np.ndarray, m: int) -> np.ndarray:
     if m <= 0:
         return np.zeros(0, dtype=np.uint8)
-    raw = bits_to_bytes(bits)
+    # raw を吸収した状態を複製してカウンタだけ追加（= sha256(raw + ctr)、raw の再読込なし）
+    base = hashlib.sha256(bits_to_bytes(bits))
     buf = bytearray()
-    ctr = 0
-    while len(buf) * 8 < m:
-        buf.extend(hashlib.sha256(raw + ctr.to_bytes(4, "big")).digest())
-        ctr += 1
-    bitstr = "".join(f"{b:08b}" for b in buf)[:m]
-    return np.fromiter((1 if c == "1" else 0 for c in bitstr), dtype=np.uint8)
+    for ctr in range((m + 255) // 256):
+        h = base.copy()
+        h.update(ctr.to_bytes(4, "big"))
+        buf.extend(h.digest())
+    return np.unpackbits(np.frombuffer(bytes(buf), dtype=np.uint8), bitorder="big")[:m]
 
 # ===== E91（教育） =====
 A = [0.0, math.pi/4]
 B = [math.pi/8, -math.pi/8]
 
-def E_theory(vis: float, ai: int, bi: int) -> float:
-    return -vis * math.cos(2*(A[ai] - B[bi]))
+# cos(2*(a-b)) は (ai,bi) ごとの定数なので 2×2 表に
+_COS_AB = np.array([[math.cos(2*(a - b)) for b in B] for a in A])
 
-def sample_from_E(E: float, rng) -> tuple[int, int]:
-    a_bit = 1 if rng.random() < 0.5 else 0
-    same  = rng.random() < (1 + E) / 2
-    b_bit = a_bit if same else a_bit ^ 1
-    return a_bit, b_bit
+def E_theory(vis: float, ai, bi):
+    # ai, bi は配列でもOK（表を引くだけ）
+    return -vis * _COS_AB[ai, bi]
 
 def run_e91(N_pairs=400_000, key_fraction=0.85, p_flip=0.004, alpha_CI=0.02, seed=2025):
     rng = np.random.default_rng(seed)
     vis = max(0.0, 1 - 2*p_flip)
 
-    a_key, b_key = [], []
-    ch = {(0,0): [0,0], (0,1): [0,0], (1,0): [0,0], (1,1): [0,0]}
+    # 鍵セット / CHSHセットの振り分けを全ペア一括で
+    is_key = rng.random(N_pairs) < key_fraction
+    n_key = int(np.count_nonzero(is_key))
+    n_ch = N_pairs - n_key
 
-    for _ in range(N_pairs):
-        if rng.random() < key_fraction:
-            a = 1 if rng.random() < 0.5 else 0
-            b = a ^ (1 if rng.random() < p_flip else 0)
-            a_key.append(a); b_key.append(b)
-        else:
-            ai = rng.integers(0, 2); bi = rng.integers(0, 2)
-            E = E_theory(vis, ai, bi)
-            a, b = sample_from_E(E, rng)
-            eq = 1 if a == b else 0
-            rec = ch[(ai, bi)]; rec[0] += eq; rec[1] += 1
+    a_key = (rng.random(n_key) < 0.5).astype(np.uint8)
+    flips = rng.random(n_key) < p_flip
+    b_key = a_key ^ flips.astype(np.uint8)
+    qber  = float(flips.mean()) if n_key > 0 else 0.0   # a^b = flips
 
-    a_key = np.array(a_key, dtype=np.uint8)
-    b_key = np.array(b_key, dtype=np.uint8)
-    n_key = len(a_key)
-    qber  = float(np.mean(a_key ^ b_key)) if n_key > 0 else 0.0
+    # CHSH: 設定ごとの E を表引きし、一致を確率 (1+E)/2 で判定して bincount で集計
+    ai = rng.integers(0, 2, size=n_ch); bi = rng.integers(0, 2, size=n_ch)
+    idx = 2*ai + bi
+    same = rng.random(n_ch) < (1 + E_theory(vis, ai, bi)) / 2
+    eq_cnt = np.bincount(idx, weights=same, minlength=4).astype(np.int64)
+    tot_cnt = np.bincount(idx, minlength=4)
+    ch = np.stack([eq_cnt, tot_cnt], axis=1).reshape(2, 2, 2)   # ch[ai, bi] = [equal, total]
 
     E_pt, E_lb = {}, {}
     for ai, bi in [(0,0), (0,1), (1,0), (1,1)]:
-        eq, tot = ch[(ai, bi)]
+        eq, tot = ch[ai, bi].tolist()
         if tot == 0:
             E_pt[(ai,bi)] = 0.0; E_lb[(ai,bi)] = -1.0
         else:
@@ -125,51 +137,124 @@ def run_e91(N_pairs=400_000, key_fraction=0.85, p_flip=0.004, alpha_CI=0.02, see
             "qber": qber, "S_pt": S_pt, "S_LB": S_LB}
 
 # ===== CASCADE風EC（インターリーブ+追加ラウンド） =====
-def parity(arr: np.ndarray) -> int:
-    return int(np.bitwise_xor.reduce(arr) if len(arr) else 0)
-
+def mismatched_blocks(a: np.ndarray, b: np.ndarray, bs: int) -> np.ndarray:
+    # parity(a)^parity(b) = parity(a^b)：(ブロック数, bs) に並べて1回で縮約（端数は0埋め）
+    d = a ^ b
+    pad = (-len(d)) % bs
+    if pad:
+        d = np.concatenate([d, np.zeros(pad, dtype=d.dtype)])
+    if bs % 64 == 0:
+        # uint64 に詰めて（1ビット/ビット）ブロック内の語を XOR → 語のパリティ
+        words = np.packbits(d).view(np.uint64).reshape(-1, bs // 64)
+        return np.flatnonzero(word_parity(np.bitwise_xor.reduce(words, axis=1)))
+    return np.flatnonzero(np.bitwise_xor.reduce(d.reshape(-1, bs), axis=1))
+
+def word_parity(w: np.ndarray) -> np.ndarray:
+    # uint64 各要素の popcount & 1（NumPy 2 は bitwise_count、無ければ SWAR で畳み込み）
+    if hasattr(np, "bitwise_count"):
+        return np.bitwise_count(w) & 1
+    w = w.copy()
+    for sh in (32, 16, 8, 4, 2, 1):
+        w ^= w >> np.uint64(sh)
+    return w & np.uint64(1)
+
+@njit(cache=True, boundscheck=False)
 def bs_fix(a: np.ndarray, b: np.ndarray, l: int, r: int) -> int:
     leak = 0
     while r - l > 1:
         m = (l + r) // 2
         leak += 1
-        if parity(a[l:m]) != parity(b[l:m]):
+        # 左半分のパリティを XOR 累積で（スライスを作らない）
+        pa = 0; pb = 0
+        for i in range(l, m):
+            pa ^= a[i]; pb ^= b[i]
+        if pa != pb:
             r = m
         else:
             l = m
     b[l] ^= 1
     return leak
 
+@njit(cache=True, boundscheck=False)
+def fix_blocks(a: np.ndarray, b: np.ndarray, bad: np.ndarray, bs: int) -> int:
+    # 不一致ブロックを順に二分探索で修正（漏洩カウントの合計を返す）
+    n = len(a); leak = 0
+    for k in bad:
+        s = k * bs
+        leak += bs_fix(a, b, s, min(s + bs, n))
+    return leak
+
+@njit(cache=True, boundscheck=False)
+def _cascade_pass(a: np.ndarray, b: np.ndarray, bs: int) -> int:
+    # 1パス：ブロックのパリティを XOR 累積で比較し、不一致なら二分探索（漏洩カウントを返す）
+    n = len(a); leak = 0
+    for s in range(0, n, bs):
+        e = min(s + bs, n)
+        pa = 0; pb = 0
+        for i in range(s, e):
+            pa ^= a[i]; pb ^= b[i]
+        if pa != pb:
+            leak += 1
+            leak += bs_fix(a, b, s, e)
+    return leak
+
+@njit(cache=True, boundscheck=False)
+def _cascade_core(a: np.ndarray, b: np.ndarray, perms: np.ndarray, passes: np.ndarray) -> int:
+    # インターリーブ付きのメインパス全体を1カーネルで（b をその場で修正。perms は Python 側で生成）
+    n = len(a); leak = 0
+    a_p = np.empty_like(a); b_p = np.empty_like(b)
+    for k in range(len(passes)):
+        perm = perms[k]
+        for i in range(n):
+            a_p[i] = a[perm[i]]; b_p[i] = b[perm[i]]
+        leak += _cascade_pass(a_p, b_p, passes[k])
+        for i in range(n):
+            b[perm[i]] = b_p[i]
+    return leak
+
 def cascade(a_key: np.ndarray, b_key: np.ndarray,
             passes=(256,128,64,32,16,8,4,2,1), extra=2, seed=2025):
     rng = np.random.default_rng(seed)
-    a = a_key.copy(); b = b_key.copy(); n = len(a); leak = 0
-
-    def one_pass(bs: int):
-        nonlocal leak, a, b
-        for s in range(0, n, bs):
-            e = min(s + bs, n)
-            if parity(a[s:e]) != parity(b[s:e]):
-                leak += 1
-                leak += bs_fix(a, b, s, e)
-
-    for bs in passes:
-        perm = rng.permutation(n)
-        a = a[perm]; b = b[perm]
-        one_pass(bs)
-        inv = np.empty_like(perm); inv[perm] = np.arange(n)
-        a = a[inv]; b = b[inv]
-    for _ in range(extra):
-        one_pass(1)
+    a = a_key; b = b_key.copy(); n = len(a); leak = 0   # 書き換えるのは b だけ
+
+    def one_pass(a: np.ndarray, b: np.ndarray, bs: int):
+        nonlocal leak
+        if n == 0:
+            return
+        # 不一致ブロックだけを二分探索（bs=1 は比較がそのまま位置特定）
+        bad = mismatched_blocks(a, b, bs)
+        leak += len(bad)
+        if bs == 1:
+            b[bad] ^= 1
+            return
+        leak += fix_blocks(a, b, bad, bs)
+
+    if HAVE_NUMBA and n > 0:
+        # numba があればパス全体を1カーネルで（置換は同じ rng・同じ順で先に作って渡す）
+        perms = np.array([rng.permutation(n) for _ in passes], dtype=np.int64).reshape(len(passes), n)
+        leak += _cascade_core(a, b, perms, np.asarray(passes, dtype=np.int64))
+    else:
+        for bs in passes:
+            # 並べ替えた写しで直し、b だけ元の位置へ書き戻す（a は不変なので逆置換は不要）
+            perm = rng.permutation(n)
+            b_p = b[perm]
+            one_pass(a[perm], b_p, bs)
+            b[perm] = b_p
+    # 追加ラウンド（bs=1）：比較は a!=b そのもの。1回で全て直るので直接まとめて修正
+    if extra > 0:
+        diff = np.flatnonzero(a != b)
+        leak += len(diff)
+        b[diff] = a[diff]
 
     mism = int(np.sum(a ^ b))
     return b, leak, mism
 
 # ===== 認証（タグ消費モデル） =====
 def consume_tag(bits: np.ndarray, tag_bits=128) -> tuple[np.ndarray, int, bool]:
+    # 以降は読むだけなのでコピーせずビューで返す
     if len(bits) < tag_bits:
-        return bits.copy(), 0, False
-    return bits[:-tag_bits].copy(), tag_bits, True
+        return bits, 0, False
+    return bits[:-tag_bits], tag_bits, True
 
 # ===== パイプライン =====
 def pipeline(N_pairs=400_000, key_fraction=0.85, p_flip=0.004, alpha_CI=0.02,
@@ -207,8 +292,10 @@ def otp_encrypt_decrypt(message: str, key_bits: np.ndarray) -> tuple[str, str, s
     if L == 0:
         return "", "", "（鍵長が0のためOTPデモはスキップしました）"
     mb_fit = mb[:L]
-    cipher = bytes(mb_fit[i] ^ key_bytes[i] for i in range(L))
-    plain  = bytes(cipher[i] ^ key_bytes[i] for i in range(L)).decode("utf-8", "ignore")
+    ka = np.frombuffer(key_bytes, dtype=np.uint8, count=L)
+    ca = np.frombuffer(mb_fit, dtype=np.uint8) ^ ka   # XOR は NumPy で一括
+    cipher = ca.tobytes()
+    plain  = (ca ^ ka).tobytes().decode("utf-8", "ignore")
     note = "" if len(mb) == L else "※メッセージを鍵の長さに合わせて切り詰めました"
     return cipher.hex(), plain, note
 
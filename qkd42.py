@@ -1,31 +1,36 @@
 # qkd42_auto_refill.py
 # 段階42：QKD鍵レジャー + 自動補充 + エポック切替 + AEAD暗号（AAD対応）
-# 依存：標準ライブラリのみ
+# 依存：標準ライブラリのみ（cryptography があれば AES-CTR を使う）
 
 from __future__ import annotations
 import hmac, hashlib, secrets, struct
 from typing import Tuple, Optional
 
+try:
+    from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+    HAVE_CRYPTO = True
+except ImportError:
+    HAVE_CRYPTO = False
+
 # ================= ユーティリティ（HKDF / PRF / XOR） =================
 
 def hkdf_extract(salt: bytes, ikm: bytes) -> bytes:
     return hmac.new(salt, ikm, hashlib.sha256).digest()  # 32 bytes
 
 def hkdf_expand(prk: bytes, info: bytes, out_len: int) -> bytes:
-    out = b""; t = b""; ctr = 1
-    while len(out) < out_len:
-        t = hmac.new(prk, t + info + bytes([ctr]), hashlib.sha256).digest()
-        out += t; ctr += 1
-    return out[:out_len]
-
-def hmac256(key: bytes, *chunks: bytes) -> bytes:
-    hm = hmac.new(key, b"", hashlib.sha256)
-    for c in chunks: hm.update(c)
-    return hm.digest()
-
-def xor_bytes(a: bytes, b: bytes) -> bytes:
-    m = min(len(a), len(b))
-    return bytes([a[i] ^ b[i] for i in range(m)])
+    base = hmac.new(prk, b"", hashlib.sha256)  # PRK の鍵スケジュールは1回だけ
+    blocks = []; t = b""
+    for ctr in range(1, (out_len + 31) // 32 + 1):
+        h = base.copy()
+        h.update(t + info + bytes([ctr]))
+        t = h.digest()
+        blocks.append(t)
+    return b"".join(blocks)[:out_len]
+
+def _xor_equal(a: bytes, b: bytes) -> bytes:
+    # 同じ長さ前提（平文とキーストリーム）。多倍長整数の XOR で一括処理
+    x = int.from_bytes(a, "little") ^ int.from_bytes(b, "little")
+    return x.to_bytes(len(a), "little")
 
 # ======================= QKD 鍵レジャー（消費型） ======================
 
@@ -88,14 +93,27 @@ class RandomQKDSource(QKDSource):
 class AEADChannel:
     """
     各エポックで IKM(=QKD鍵の一部) を消費し、HKDFで (enc_key, mac_key) を導出。
-    暗号：XORストリーム（HMACベースPRF）＋ HMAC-SHA256 タグ（先頭16B）。
+    暗号：cipher で選ぶ。"aes-ctr"（cryptography 必須）/ "hmac-prf"（HMACベースPRF の XORストリーム）。
+    None（既定）なら cryptography があれば "aes-ctr"、無ければ "hmac-prf"。
+    タグ：HMAC-SHA256（先頭16B）。暗号方式IDもタグに含めるので、方式が食い違う相手とは必ず検証失敗になる。
     AAD対応。counterは64bit。rekey時に不足なら QKDSource から自動補充。
     """
     IKM_LEN  = 32     # 1エポックで消費する IKM バイト数
     TAG_LEN  = 16
     NONCE_LEN = 12
-
-    def __init__(self, ledger: QKDLedger, source: Optional[QKDSource] = None, context: bytes = b"AEAD-CHAN"):
+    _SALT_PREFIX = b"epoch:"
+    CIPHER_IDS = {"aes-ctr": b"\x01", "hmac-prf": b"\x02"}   # タグに入れる方式ID（固定長1B）
+
+    def __init__(self, ledger: QKDLedger, source: Optional[QKDSource] = None, context: bytes = b"AEAD-CHAN",
+                 cipher: Optional[str] = None):
+        if cipher is None:
+            cipher = "aes-ctr" if HAVE_CRYPTO else "hmac-prf"
+        if cipher not in self.CIPHER_IDS:
+            raise ValueError(f"未知の暗号方式: {cipher!r}（{', '.join(self.CIPHER_IDS)} のどれか）")
+        if cipher == "aes-ctr" and not HAVE_CRYPTO:
+            raise RuntimeError("cipher='aes-ctr' には cryptography が必要です（pip install cryptography）")
+        self.cipher = cipher
+        self._cipher_id = self.CIPHER_IDS[cipher]
         self.ledger = ledger
         self.source = source
         self.context = context
@@ -103,23 +121,45 @@ class AEADChannel:
         self.counter = 0
         self.enc_key = b""
         self.mac_key = b""
+        # エポック内で不変な鍵の HMAC 状態（ipad/opad 吸収済み）
+        self._enc_hm = None
+        self._mac_hm = None
+        self._aes = None
+        self._nonce_prefix = b""
 
     # ---- 内部：鍵導出・ノンス・キーストリーム ----
     def _derive_from_ikm(self, ikm: bytes, epoch: int) -> Tuple[bytes, bytes]:
-        prk = hkdf_extract(salt=f"epoch:{epoch}".encode(), ikm=ikm)
+        prk = hkdf_extract(salt=self._SALT_PREFIX + str(epoch).encode(), ikm=ikm)
         okm = hkdf_expand(prk, self.context + b"|keys", 64)
         return okm[:32], okm[32:]
 
     def _nonce(self, epoch: int, counter: int) -> bytes:
-        m = struct.pack(">Q", counter) + struct.pack(">I", epoch & 0xffffffff)
-        return hashlib.sha256(m).digest()[:self.NONCE_LEN]
-
-    def _keystream(self, key: bytes, nonce: bytes, n: int) -> bytes:
-        out = b""; blk = 0
-        while len(out) < n:
-            out += hmac256(key, nonce, struct.pack(">I", blk))
-            blk += 1
-        return out[:n]
+        # counter(8B) + エポック由来の固定部(4B)。エポック内では counter だけで一意
+        return struct.pack(">Q", counter) + self._nonce_prefix
+
+    def _keystream(self, nonce: bytes, n: int) -> bytes:
+        # エポック鍵の HMAC 状態にノンスを吸収し、ブロックごとに copy して counter だけ足す
+        base = self._enc_hm.copy()
+        base.update(nonce)
+        blocks = []
+        for blk in range((n + 31) // 32):
+            h = base.copy()
+            h.update(struct.pack(">I", blk))
+            blocks.append(h.digest())
+        return b"".join(blocks)[:n]
+
+    def _xcrypt(self, nonce: bytes, data: bytes) -> bytes:
+        """暗号化・復号共通（ストリームとの XOR）。"""
+        if self._aes is not None:
+            # 12B ノンス + 32bit ブロックカウンタ(0始まり) を CTR の初期値にする
+            enc = Cipher(self._aes, modes.CTR(nonce + bytes(4))).encryptor()
+            return enc.update(data) + enc.finalize()
+        return _xor_equal(data, self._keystream(nonce, len(data)))
+
+    def _tag(self, aad: bytes, nonce: bytes, ct: bytes) -> bytes:
+        hm = self._mac_hm.copy()
+        hm.update(b"".join((self._cipher_id, aad, nonce, ct)))
+        return hm.digest()[:self.TAG_LEN]
 
     # ---- 公開API ----
     def start_epoch(self, auto_refill: bool = True) -> bool:
@@ -141,6 +181,10 @@ class AEADChannel:
         self.epoch = next_epoch
         self.counter = 0
         self.enc_key, self.mac_key = enc, mac
+        self._enc_hm = hmac.new(enc, b"", hashlib.sha256)
+        self._mac_hm = hmac.new(mac, b"", hashlib.sha256)
+        self._aes = algorithms.AES(enc) if self.cipher == "aes-ctr" else None
+        self._nonce_prefix = hashlib.sha256(struct.pack(">I", next_epoch & 0xffffffff)).digest()[:4]
         print(f"[rekey] 新エポックへ切替：epoch={self.epoch}, 残り鍵={self.ledger.remaining_bits()}ビット")
         return True
 
@@ -151,9 +195,8 @@ class AEADChannel:
     def encrypt(self, pt: bytes, aad: bytes = b"") -> Tuple[int, int, bytes]:
         assert self.epoch >= 0 and self.enc_key and self.mac_key, "先に start_epoch() を呼んでください"
         nonce = self._nonce(self.epoch, self.counter)
-        ks = self._keystream(self.enc_key, nonce, len(pt))
-        ct = xor_bytes(pt, ks)
-        tag = hmac256(self.mac_key, aad, nonce, ct)[:self.TAG_LEN]
+        ct = self._xcrypt(nonce, pt)
+        tag = self._tag(aad, nonce, ct)
         out = ct + tag
         ep, cnt = self.epoch, self.counter
         self.counter += 1
@@ -163,11 +206,10 @@ class AEADChannel:
         assert epoch == self.epoch, "現在のエポックと一致しません"
         nonce = self._nonce(epoch, counter)
         ct, tag = ct_and_tag[:-self.TAG_LEN], ct_and_tag[-self.TAG_LEN:]
-        chk = hmac256(self.mac_key, aad, nonce, ct)[:self.TAG_LEN]
+        chk = self._tag(aad, nonce, ct)
         if not hmac.compare_digest(tag, chk):
             raise ValueError("認証タグ不一致（破損 or 改ざん）")
-        ks = self._keystream(self.enc_key, nonce, len(ct))
-        return xor_bytes(ct, ks)
+        return self._xcrypt(nonce, ct)
 
 # ============================== デモ ===============================
 
@@ -179,7 +221,9 @@ def main():
 
     print(f"初期残り鍵 = {ledger.remaining_bits()} ビット（{ledger.remaining_bytes()}B）")
 
+    # cryptography があれば AES-CTR。送受信側で同じ方式になること（違えばタグ検証で失敗する）
     chan = AEADChannel(ledger, source)
+    print(f"暗号方式 = {chan.cipher}")
 
     # エポック0（足りなければ自動補充して開始）
     chan.start_epoch(auto_refill=True)
@@ -1,30 +1,45 @@
 # qkd43.py  — 段階43 修正版（鍵枯渇エラー対応）
 
-import numpy as np
+import secrets
 from typing import List
 
 # ===== 簡易 QKD 鍵レジャー =====
 class QKDKeyLedger:
+    """鍵ビットを bytearray に 8ビット/バイトで詰めて保持（先頭から消費）。"""
     def __init__(self, pool_bits: int = 0):
-        self.qkd_bytes = np.random.randint(0, 2, pool_bits, dtype=np.uint8).tolist()
+        self._buf = bytearray()
+        self._nbits = 0   # 有効ビット数
+        self._pos = 0     # 消費済みビット数（先頭インデックス）
+        self.add_keys(pool_bits)
 
     def add_keys(self, n_bits: int):
         # 疑似的に pipeline で新しい鍵を補充したことにする
-        new_bits = np.random.randint(0, 2, n_bits, dtype=np.uint8).tolist()
-        self.qkd_bytes.extend(new_bits)
+        # 末尾バイトの未使用ビットも乱数なので、足りない分のバイトだけ追加すればよい
+        spare = 8 * len(self._buf) - self._nbits
+        self._buf.extend(secrets.token_bytes(max(0, n_bits - spare + 7) // 8))
+        self._nbits += n_bits
 
     def need(self, n_bits: int):
-        if len(self.qkd_bytes) < n_bits:
+        if self.remaining() < n_bits:
             raise RuntimeError("QKD鍵が不足 (レジャー)")
 
     def take(self, n_bits: int) -> List[int]:
         self.need(n_bits)
-        out = self.qkd_bytes[:n_bits]
-        self.qkd_bytes = self.qkd_bytes[n_bits:]
-        return out
+        s = self._pos; e = s + n_bits
+        lo, hi = s // 8, (e + 7) // 8
+        v = int.from_bytes(self._buf[lo:hi], "big")
+        self._pos = e
+        if self._pos > self._nbits // 2:
+            # 消費済みが半分を超えたら先頭を詰める（take ごとのコピーはしない）
+            drop = self._pos // 8
+            del self._buf[:drop]
+            self._pos -= 8 * drop; self._nbits -= 8 * drop
+        # 取り出した範囲を MSB 側から1ビットずつ並べる
+        v >>= 8 * hi - e
+        return [(v >> k) & 1 for k in range(n_bits - 1, -1, -1)]
 
     def remaining(self) -> int:
-        return len(self.qkd_bytes)
+        return self._nbits - self._pos
 
 # ===== 簡易 チャネル（AES-GCM風ダミー） =====
 class SecureChannel:
@@ -50,6 +65,14 @@ class SecureChannel:
     def decrypt(self, ct: bytes, aad: bytes = b"meta"):
         return ct[::-1]
 
+    def encrypt_batch(self, msgs: List[bytes], aads: List[bytes]) -> List[bytes]:
+        # まとめて暗号化（counter は件数分まとめて進める）
+        self.counter += len(msgs)
+        return [m[::-1] for m in msgs]
+
+    def decrypt_batch(self, cts: List[bytes], aads: List[bytes]) -> List[bytes]:
+        return [c[::-1] for c in cts]
+
 # ===== コントローラ（メッセージ自動処理） =====
 class AutoQKDController:
     def __init__(self, ledger: QKDKeyLedger, chan: SecureChannel):
@@ -61,20 +84,20 @@ class AutoQKDController:
         self.queue.append((msg, aad))
 
     def process_queue(self):
-        results = []
-        for i, (msg, aad) in enumerate(self.queue):
-            try:
-                ct = self.chan.encrypt(msg, aad=aad)
-                pt = self.chan.decrypt(ct, aad=aad)
-                results.append(pt.decode("utf-8"))
-            except RuntimeError:
-                # 鍵不足なら新しいエポックで補充して再試行
-                print("[AutoQKD] QKD鍵不足 → 自動rekeyで補充します")
-                self.chan.start_epoch()
-                ct = self.chan.encrypt(msg, aad=aad)
-                pt = self.chan.decrypt(ct, aad=aad)
-                results.append(pt.decode("utf-8"))
-        return results
+        if not self.queue:
+            return []
+        msgs = [m for m, _ in self.queue]
+        aads = [a for _, a in self.queue]
+        # キュー全体を1回で暗号化（try/except もバッチに1回だけ）
+        try:
+            cts = self.chan.encrypt_batch(msgs, aads)
+        except RuntimeError:
+            # 鍵不足なら新しいエポックで補充して再試行
+            print("[AutoQKD] QKD鍵不足 → 自動rekeyで補充します")
+            self.chan.start_epoch()
+            cts = self.chan.encrypt_batch(msgs, aads)
+        pts = self.chan.decrypt_batch(cts, aads)
+        return [pt.decode("utf-8") for pt in pts]
 
 # ===== メイン =====
 def main():
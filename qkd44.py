@@ -7,7 +7,7 @@
 # 依存: cryptography
 # 実行: pip install cryptography && python qkd44_superlight.py
 
-import os, time, random, hmac, hashlib, collections
+import os, time, random, hmac, hashlib, collections, struct, heapq, itertools
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
 from cryptography.hazmat.primitives.ciphers.aead import AESGCM
@@ -55,6 +55,7 @@ class QKDAEADChannel:
         self.enc_key= None
         self.auth_key=None
         self.nonce_base=None
+        self._nonce_buf = bytearray(12)  # counter(4B) + nonce_base(8B) を書き込む使い回しバッファ
         self.epoch_msg_limit = epoch_msg_limit
 
     def start_epoch(self):
@@ -66,12 +67,15 @@ class QKDAEADChannel:
         self.enc_key    = okm[:32]
         self.auth_key   = okm[32:64]
         self.nonce_base = okm[64:72]  # 8B
+        self._nonce_buf[4:] = self.nonce_base
         self.aesgcm = AESGCM(self.enc_key)
         self.epoch += 1
         self.counter = 0
 
     def _nonce(self) -> bytes:
-        return self.counter.to_bytes(4, "big") + self.nonce_base
+        struct.pack_into(">I", self._nonce_buf, 0, self.counter)
+        # バッファは次の呼び出しで上書きされるので、呼び出し側には不変な bytes で渡す
+        return bytes(self._nonce_buf)
 
     def encrypt(self, pt: bytes, aad: bytes = b""):
         if self.aesgcm is None:
@@ -95,19 +99,19 @@ class UnreliableChannel:
     def __init__(self, drop=0.10, reorder=0.25, max_delay=0.03):
         random.seed(7)
         self.drop = drop; self.reorder=reorder; self.max_delay=max_delay
-        self.buf = []
+        self.buf = []                    # heap of (配達時刻, 通し番号, packet)
+        self._seq = itertools.count()    # 同時刻のとき packet 同士を比較させないため
     def send(self, packet):
         if random.random() < self.drop: return
         d = random.random()*self.max_delay
         if random.random() < self.reorder: d += random.random()*self.max_delay
-        self.buf.append((time.time()+d, packet))
+        heapq.heappush(self.buf, (time.time()+d, next(self._seq), packet))
     def recv_ready(self):
         now = time.time()
-        out, keep = [], []
-        for t, pk in self.buf:
-            (out if t <= now else keep).append((t, pk))
-        self.buf = keep
-        return [pk for _, pk in out]
+        out = []
+        while self.buf and self.buf[0][0] <= now:
+            out.append(heapq.heappop(self.buf)[2])
+        return out
 
 # ====== 信頼配送（ACK/再送/順序整列/重複排除） ======
 class ReliableSender:
@@ -118,6 +122,7 @@ class ReliableSender:
         self.base = 0
         self.next = 0
         self.inflight = {}         # seq -> (t_send, (ep,cnt,ct,aad))
+        self._expiry = []          # heap of (deadline, seq)。ACK済みの seq は tick で読み捨て
         self.pending = collections.deque()
         self.net_send = None       # set from outside
 
@@ -140,7 +145,9 @@ class ReliableSender:
                     self.chan.start_epoch(); continue
                 raise
             seq = self.next
-            self.inflight[seq] = (time.time(), (ep, cnt, ct, aad))
+            t0 = time.time()
+            self.inflight[seq] = (t0, (ep, cnt, ct, aad))
+            heapq.heappush(self._expiry, (t0 + self.timeout, seq))
             self.pending.popleft()
             self.net_send(("DATA", seq, ep, cnt, ct, aad))
             self.next += 1
@@ -154,10 +161,15 @@ class ReliableSender:
 
     def tick(self):
         now = time.time()
-        for seq, (t0, payload) in list(self.inflight.items()):
-            if now - t0 > self.timeout:
-                self.inflight[seq] = (now, payload)
-                self.net_send(("DATA", seq, *payload))
+        # 期限切れの先頭だけを見る（全 inflight の走査はしない）
+        while self._expiry and self._expiry[0][0] < now:
+            _, seq = heapq.heappop(self._expiry)
+            if seq not in self.inflight:
+                continue
+            payload = self.inflight[seq][1]
+            self.inflight[seq] = (now, payload)
+            heapq.heappush(self._expiry, (now + self.timeout, seq))
+            self.net_send(("DATA", seq, *payload))
 
 class ReliableReceiver:
     def __init__(self, chan: QKDAEADChannel, deliver_cb):
@@ -8,6 +8,7 @@ faulthandler.dump_traceback_later(30, repeat=True, file=sys.stderr)  # 30秒ご
 
 # ---- Matplotlib は非GUIバックエンドにしてブロック回避 ----
 os.environ.setdefault("MPLBACKEND", "Agg")  # GUIが無い環境でもOK
+import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 
@@ -20,6 +21,19 @@ try:
 except Exception:
     pass  # Qiskitが無ければスキップ。下の run_qiskit_demo() は呼ばれない想定
 
+try:
+    from numba import njit
+    HAVE_NUMBA = True
+except ImportError:
+    HAVE_NUMBA = False
+    def njit(*args, **kwargs):
+        # numba が無ければ素の Python 関数として使う
+        if args and callable(args[0]):
+            return args[0]
+        return lambda f: f
+
+WALK_PER_STEP = False  # run_stage45 の既定。True: 1ステップずつ回す版（分岐ロジックを足す用、numba があれば JIT）
+
 
 # ===================== ここに段階45の本処理を入れる =====================
 
@@ -32,52 +46,58 @@ def run_qiskit_demo(n_circs=50, shots=256, seed=45):
         print("[Qiskit] 未導入のためスキップ", flush=True)
         return []
 
-    rng = random.Random(seed)
-    circs = []
-    for _ in range(n_circs):
-        qc = QuantumCircuit(1, 1)
-        if rng.random() < 0.5:
-            qc.x(0)
-        qc.h(0)
-        qc.measure(0, 0)
-        circs.append(qc)
+    # 回路は X の有無の2種類だけなので、テンプレを2つ作って transpile も2回路分だけ
+    tpl = QuantumCircuit(1, 1)
+    tpl.h(0)
+    tpl.measure(0, 0)
+    tpl_x = QuantumCircuit(1, 1)
+    tpl_x.x(0)
+    tpl_x.compose(tpl, inplace=True)
 
     sim = AerSimulator(method="stabilizer")  # 速いメソッド
-    tc = transpile(circs, sim, optimization_level=1)  # transpileは1回だけ
-    res = sim.run(tc, shots=shots).result()
+    tc, tc_x = transpile([tpl, tpl_x], sim, optimization_level=1)  # transpileは1回だけ
+
+    rng = random.Random(seed)
+    circs = [tc_x if rng.random() < 0.5 else tc for _ in range(n_circs)]
+    res = sim.run(circs, shots=shots).result()
     counts = [res.get_counts(i) for i in range(len(circs))]
     return counts
 
 
-def run_stage45(N=200_000, progress_every=5_000):
+@njit(cache=True)
+def _walk(steps):
+    """1ステップずつのランダムウォーク（numba ではネイティブコードになる）。
+    乱数は呼び出し側の Generator で引いた steps を使う（グローバル乱数には触らない）。"""
+    ys = np.empty(steps.size)
+    s = 0.0
+    for i in range(steps.size):
+        s += steps[i]
+        ys[i] = s
+    return ys
+
+
+def run_stage45(N=200_000, per_step=None):
     """
     段階45の重計算をここに入れる。
     今はダミーで“計算→配列に記録→グラフ化”を行う。
+    per_step=True なら _walk（1ステップずつ）、None なら WALK_PER_STEP に従う。
+    どちらも同じ乱数列を使うので、同じ seed なら同じウォークになる。
     """
+    if per_step is None:
+        per_step = WALK_PER_STEP
     print(f"[RUN] stage45 start: N={N}", flush=True)
-    rng = random.Random(2025)
-
-    xs, ys = [], []
-    SAFETY_MAX_STEPS = N + 10_000  # 無限ループ保険
-    steps = 0
-
-    s = 0.0
-    for i in range(N):
-        # --- ここにあなたの計算ロジックを入れる（ダミーはランダムウォーク）---
-        s += rng.uniform(-1.0, 1.0)
-        xs.append(i)
-        ys.append(s)
-
-        # 進捗ログ
-        if (i + 1) % progress_every == 0:
-            print(f"  progress: {i+1}/{N}", flush=True)
-
-        # 安全ブレーク
-        steps += 1
-        if steps > SAFETY_MAX_STEPS:
-            raise RuntimeError("safety break: loop too long")
-
-    print("[RUN] stage45 main loop done.", flush=True)
+    rng = np.random.default_rng(2025)
+
+    # --- ここにあなたの計算ロジックを入れる（ダミーはランダムウォーク）---
+    xs = np.arange(N)
+    steps = rng.uniform(-1.0, 1.0, N)
+    if per_step:
+        ys = _walk(steps)
+    else:
+        # 一様乱数の累積和で一括計算（ステップごとの Python ループ無し）
+        ys = np.cumsum(steps)
+
+    print(f"[RUN] stage45 main loop done: {N} steps.", flush=True)
     return xs, ys
 
 
@@ -114,7 +134,7 @@ def main():
     _ = run_qiskit_demo(n_circs=30, shots=128)  # 無ければ自動スキップ
 
     # 2) 本計算
-    xs, ys = run_stage45(N=120_000, progress_every=4_000)
+    xs, ys = run_stage45(N=120_000)
 
     # 3) 可視化（保存が既定。画面表示したいなら show=True）
     plot_and_finish(xs, ys, title="Stage45 Random Walk (demo)", show=False)